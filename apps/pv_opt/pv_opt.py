@@ -1,9 +1,13 @@
 # %%
 import math
+import os
 import re
 import time
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
 from datetime import datetime, timedelta
 from json import dumps
+from multiprocessing import get_context
 
 import appdaemon.adbase as ad
 import appdaemon.plugins.hass.hassapi as hass
@@ -77,6 +81,7 @@ WRITE_POLL_SLEEP = 0.5
 WRITE_POLL_TIME_SLEEP = 2  # added for Solarman_V2 integration that writes to HA entities of type time.
 # Using WRITE_POLL_SLEEP value of 0.5 is not sufficient)
 WRITE_POLL_RETRIES = 5
+PREFETCH_INTERVAL = 600  # Time between background tariff downloads (s)
 GET_STATE_RETRIES = 5
 GET_STATE_WAIT = 0.5
 
@@ -260,6 +265,42 @@ DEFAULT_CONFIG = {
         },
         "domain": "number",
     },
+    "optimiser_engine": {
+        "default": "heuristic",
+        "domain": "select",
+        "attributes": {"options": pv.OPTIMISER_ENGINES},
+    },
+    "max_optimiser_seconds": {
+        "default": 0,
+        "attributes": {
+            "min": 0,
+            "max": 300,
+            "step": 5,
+            "mode": "box",
+        },
+        "domain": "number",
+    },
+    "optimiser_plan_cache": {"default": False, "domain": "switch"},
+    "optimiser_workers": {
+        "default": 1,
+        "attributes": {
+            "min": 1,
+            "max": 3,
+            "step": 1,
+            "mode": "slider",
+        },
+        "domain": "number",
+    },
+    "optimiser_polish_seconds": {
+        "default": 0,
+        "attributes": {
+            "min": 0,
+            "max": 30,
+            "step": 1,
+            "mode": "slider",
+        },
+        "domain": "number",
+    },
     "octopus_auto": {"default": True, "domain": "switch"},
     "battery_capacity_wh": {
         "default": 10000,
@@ -558,6 +599,10 @@ class PVOpt(hass.Hass):
         self.debug_cat = DEBUG_CATEGORIES
         self.redact_regex = REDACT_REGEX
         self.contract_last_loaded = pd.Timestamp("1970-01-01", tz="UTC")
+        self.optimiser_pool = None
+        self.optimiser_pool_workers = 0
+        self.optimiser_budget_hit = False
+        self.timer = pv.StageTimer()
         try:
             subver = int(VERSION.split(".")[2])
         except:
@@ -592,6 +637,9 @@ class PVOpt(hass.Hass):
             self.redact_regex.append(self.inverter_sn)
 
         self.redact = self.args.pop("redact_personal_data_from_log", True)
+        self.rate_cache_file = self.args.pop(
+            "rate_cache", os.path.join(os.path.dirname(os.path.abspath(__file__)), pv.RATE_CACHE_FILE)
+        )
         self._load_inverter()
 
         retry_count = 0
@@ -651,6 +699,7 @@ class PVOpt(hass.Hass):
 
         # self._estimate_capacity()
         self._load_pv_system_model()
+        self._open_rate_cache()
         self._load_contract()
         self.ev = (
             self.get_config("ev_charger") in DEFAULT_CONFIG["ev_charger"]["attributes"]["options"][1:]
@@ -683,6 +732,7 @@ class PVOpt(hass.Hass):
         self.log("Running initial Optimisation:")
         self.optimise()
         self._setup_schedule()
+        self._setup_prefetch_schedule()
 
         ### SVB new function
         # Optimise if car starts charging on IOG (intelligent dispatcing sensor changes from off to on)
@@ -1463,6 +1513,159 @@ class PVOpt(hass.Hass):
             f"Optimiser will run every {self.get_config('optimise_frequency_minutes')} minutes from {start_opt.strftime('%H:%M %Z')} or on {EVENT_TRIGGER} Event"
         )
 
+    def _setup_prefetch_schedule(self):
+        start = (pd.Timestamp.now() + pd.Timedelta(PREFETCH_INTERVAL, "seconds")).to_pydatetime()
+        self.timer_handle_prefetch = self.run_every(
+            self._prefetch_tariffs,
+            start=start,
+            interval=PREFETCH_INTERVAL,
+        )
+
+    def _prefetch_tariffs(self, cb_args):
+        # Not locked so it runs alongside optimise(). Nothing optimise() uses is changed here: when the contract
+        # needs reloading a new one is built by _prepare_contract and _swap_contract is queued to put it in place
+        # in between optimiser runs. Tariffs are only downloaded when they are due: the contract's when
+        # _contract_reload_due says so and the alt_tariffs' before the next comparison
+        reload = self._contract_reload_due()
+        codes = {}
+        if reload is not None and self.contract is not None:
+            codes = {
+                tariff.name: tariff.export
+                for tariff in self.contract.tariffs.values()
+                if tariff is not None and tariff.octopus and not tariff.manual
+            }
+
+        to_compare = pd.Timestamp.now(tz="UTC").ceil("60min") - pd.Timedelta("2min") - pd.Timestamp.now(tz="UTC")
+        if self.timer_handle_compare is not None and to_compare <= pd.Timedelta(PREFETCH_INTERVAL, "seconds"):
+            for tariff_set in self.get_config("alt_tariffs") or []:
+                for imp_exp in IMPEXP:
+                    codes.setdefault(tariff_set[f"octopus_{imp_exp}_tariff_code"], imp_exp == "export")
+
+        if pv.rate_cache.enabled and len(codes) > 0:
+            # New Agile rates are checked for every time until they are published
+            max_age = pd.Timedelta(0) if reload == "refresh" else pv.RATE_CACHE_MAX_AGE
+            try:
+                pv.prefetch_rates(codes, host=self, max_age=max_age)
+            except Exception as e:
+                self.log(f"Unable to prefetch tariff rates: {e}", level="WARNING")
+
+        if reload is not None:
+            try:
+                contract, new_rates = self._prepare_contract(reload)
+            except Exception as e:
+                self.log(f"Unable to reload the contract: {e}. Keeping the current one.", level="WARNING")
+                return
+            self.run_in(self._swap_contract, 0, reload=reload, contract=contract, new_rates=new_rates)
+
+    def _prepare_contract(self, reload):
+        # Builds the contract that _swap_contract will put in place without changing anything optimise() uses, so
+        # any downloads (all of them if the rate cache is off) happen here rather than under the app lock. For a
+        # "refresh" the new Agile rates are added to copies of the tariffs and their number is returned as well.
+        # Returns None for the contract if it needs loading from scratch because there isn't one or the Octopus
+        # Energy integration has a different tariff.
+        if self.contract is None:
+            return None, None
+
+        codes = {
+            key: tariff.name
+            for key, tariff in self.contract.tariffs.items()
+            if tariff is not None and tariff.octopus and not tariff.manual
+        }
+        if self.get_config("octopus_auto"):
+            for key, entity in self.bottlecap_entities.items():
+                if entity is not None:
+                    attributes = self.get_state_retry(entity, attribute="all")["attributes"]
+                    if attributes.get(BOTTLECAP_DAVE["tariff_code"]) != codes.get(key):
+                        return None, None
+
+        tariffs = dict(self.contract.tariffs)
+        if reload == "refresh":
+            try:
+                new_rates = 0
+                for key, tariff in tariffs.items():
+                    if tariff is not None:
+                        tariffs[key] = copy(tariff)
+                        tariffs[key].clear_cache()
+                        new_rates += tariffs[key].refresh()
+                return pv.Contract("current", imp=tariffs["import"], exp=tariffs["export"], host=self), new_rates
+
+            except Exception as e:
+                self.log(f"  Unable to load new Agile rates: {e}. Reloading contract.", level="WARNING")
+                tariffs = dict(self.contract.tariffs)
+
+        tariffs |= pv.load_tariffs(
+            {key: {"name": code, "export": tariffs[key].export} for key, code in codes.items()},
+            host=self,
+            update_host=False,
+        )
+        return pv.Contract("current", imp=tariffs["import"], exp=tariffs["export"], host=self), None
+
+    def _contract_reload_due(self):
+        # Returns "refresh" when tomorrow's Agile rates are due, "reload" when the whole contract should be reloaded
+        # or None
+        now = pd.Timestamp.now(tz=self.tz)
+        if self.contract is None:
+            return "reload"
+
+        elif self.agile:
+            if (self.contract.tariffs["import"].end().day == pd.Timestamp.now().day) and (now.hour >= 16):
+                return "refresh"
+
+        elif self.intelligent:
+            # IOG rates are reloaded once at 16:40, 00:00 - 00:20 and 05:10
+            if (
+                ((now.hour == 16) and (now.minute >= 40))
+                or ((now.hour == 0) and (now.minute <= 20))
+                or ((now.hour == 5) and (now.minute >= 10))
+            ) and (pd.Timestamp.now(tz="UTC") - self.contract_last_loaded) > pd.Timedelta("30min"):
+                return "reload"
+
+        elif ((pd.Timestamp.now(tz="UTC") - self.contract_last_loaded).total_seconds() / 3600) > 6:
+            # Reload every 6 hours
+            return "reload"
+
+        return None
+
+    @ad.app_lock
+    def _swap_contract(self, cb_args):
+        # Holds the app lock so the contract never changes part way through optimise(). The new contract was built
+        # by _prepare_contract so it only has to be put in place, unless it needs loading from scratch
+        contract = cb_args.get("contract")
+        if contract is None:
+            self.log("About to reload Contract")
+            self._load_contract()
+            return
+
+        if cb_args.get("new_rates") is not None:
+            self.log(f"Contract end day: {self.contract.tariffs['import'].end().day} Today:{pd.Timestamp.now().day}")
+            self.log(f"  Loaded {cb_args['new_rates']} new Agile rates")
+            if cb_args["new_rates"] > 0:
+                self.agile_prices_updated = True
+            self.contract = contract
+
+        else:
+            self.log("Reloaded Contract")
+            if cb_args.get("reload") == "refresh":
+                self.agile_prices_updated = True
+            self.contract = contract
+            self.io_prices = {}
+            for tariff in contract.tariffs.values():
+                if tariff is not None:
+                    tariff.update_host(clear=False)
+            self.contract_last_loaded = pd.Timestamp.now(tz="UTC")
+            self._load_saving_events()
+
+    def _open_rate_cache(self):
+        # Downloaded tariff rates are kept in a file next to the app unless rate_cache is set to another file or false
+        path = self.rate_cache_file
+        try:
+            pv.rate_cache.open(path or None)
+            if path:
+                self.log(f"Using tariff rate cache {path}")
+        except Exception as e:
+            self.log(f"Unable to open tariff rate cache {path}: {e}. Rates will always be downloaded", level="WARNING")
+            pv.rate_cache.open(None)
+
     def _load_contract(self):
         self.rlog("")
         self.rlog("Loading Contract:")
@@ -1611,24 +1814,24 @@ class PVOpt(hass.Hass):
                 ):
                     self.rlog(f"Trying to load tariff codes: Import: {self.config['octopus_import_tariff_code']}")
                     # try:
-                    # First load the import as we always need that
-                    tariffs["import"] = pv.Tariff(
-                        self.config[f"octopus_import_tariff_code"],
-                        export=False,
-                        host=self,
-                    )
+                    # First load the import as we always need that. The export tariff code is downloaded with it
+                    codes = {"import": {"name": self.config[f"octopus_import_tariff_code"], "export": False}}
+                    if "octopus_export_tariff_code" in self.config:
+                        self.rlog(f"Trying to load tariff codes: Export: {self.config['octopus_export_tariff_code']}")
+                        codes["export"] = {"name": self.config[f"octopus_export_tariff_code"], "export": False}
+                    tariffs |= pv.load_tariffs(codes, host=self)
                 elif self.get_config("manual_import_tariff", False):
                     tariffs["import"] = self._manual_tariff("import")
 
                 if tariffs["import"] is not None:
-                    if "octopus_export_tariff_code" in self.config:
+                    if tariffs["export"] is None and "octopus_export_tariff_code" in self.config:
                         self.rlog(f"Trying to load tariff codes: Export: {self.config['octopus_export_tariff_code']}")
                         tariffs["export"] = pv.Tariff(
                             self.config[f"octopus_export_tariff_code"],
                             export=False,
                             host=self,
                         )
-                    elif self.get_config("manual_export_tariff", False):
+                    elif tariffs["export"] is None and self.get_config("manual_export_tariff", False):
                         tariffs["export"] = self._manual_tariff("export")
 
                     self.contract = pv.Contract(
@@ -1670,7 +1873,10 @@ class PVOpt(hass.Hass):
             self._load_saving_events()
 
         self.log("")
-        self.log("Finished loading contract")
+        stats = pv.http_client.stats()
+        self.log(
+            f"Finished loading contract. HTTP requests since start: {stats['calls']} ({stats['bytes'] / 1024:0.0f} kB, {stats['retries']} retries, {stats['errors']} errors)"
+        )
 
     def _manual_tariff(self, direction="import"):
         name = self.get_config(f"manual_{direction}_tariff_name")
@@ -2322,12 +2528,42 @@ class PVOpt(hass.Hass):
         self.log(f"Version: v{VERSION}")
         self.optimise()
 
+    def terminate(self):
+        # Not locked so that the worker pool is cancelled straight away rather than after a running optimisation
+        self._stop_optimiser_pool()
+        pv.http_client.close()
+
+    def _stop_optimiser_pool(self):
+        if self.optimiser_pool is not None:
+            self.optimiser_pool.shutdown(wait=False, cancel_futures=True)
+            self.optimiser_pool = None
+
+    def _optimiser_pool(self):
+        # Worker processes are spawned rather than forked as AppDaemon is multi-threaded. They are kept between
+        # runs so that pandas is only imported once.
+        workers = int(self.get_config("optimiser_workers", 1))
+        if workers < 2:
+            self._stop_optimiser_pool()
+            return None
+
+        if (self.optimiser_pool is None) or (self.optimiser_pool_workers != workers):
+            self._stop_optimiser_pool()
+            self.optimiser_pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+            self.optimiser_pool_workers = workers
+
+        return self.optimiser_pool
+
     @ad.app_lock
     def optimise(self):
         # initialse a DataFrame to cover today and tomorrow at 30 minute frequency
 
+        # Each stage is booked to self.timer with a lap when it finishes and the breakdown is published as
+        # attributes of the optimiser_elapsed sensor at the end
+        self.timer.reset()
+
         self.log("")
         self._load_saving_events()
+        self.timer.lap("saving_events")
 
         if self.get_config("forced_discharge") and (self.get_config("supports_forced_discharge", True)):
             discharge_enable = "enabled"
@@ -2350,31 +2586,9 @@ class PVOpt(hass.Hass):
         # Reload EV Charge plan control
         self.car_charging = self.get_config("control_car_charging")
 
-        if self.agile:
-            if (self.contract.tariffs["import"].end().day == pd.Timestamp.now().day) and (
-                pd.Timestamp.now(tz=self.tz).hour >= 16
-            ):
-                self.log(
-                    f"Contract end day: {self.contract.tariffs['import'].end().day} Today:{pd.Timestamp.now().day}"
-                )
-                self._load_contract()
-                self.agile_prices_updated = True
-
-        elif self.intelligent:
-            # self.log("Printing time.....")
-            # self.log(pd.Timestamp.now(tz=self.tz).hour)
-            if (pd.Timestamp.now(tz=self.tz).hour == 16) and (pd.Timestamp.now(tz=self.tz).minute >= 40):
-                self.log("   About to reload Contract - 16:40")
-                self._load_contract()
-
-            if (pd.Timestamp.now(tz=self.tz).hour == 0) and (pd.Timestamp.now(tz=self.tz).minute <= 20):
-                self.log("   About to reload Contract- 00:20")
-                self._load_contract()
-
-            if (pd.Timestamp.now(tz=self.tz).hour == 5) and (pd.Timestamp.now(tz=self.tz).minute >= 10):
-                self.log("   About to reload Contract - 05:10")
-                self._load_contract()
-
+        # New rates are downloaded and the contract reloaded in the background by _prefetch_tariffs, so the
+        # contract is only reloaded here when the car is plugged in on IOG or the tariffs are wrong
+        if self.intelligent:
             if self.car_plugin_detected == 1:
                 self.log("Car plugin detected or charge to add value changed. About to reload Contract")
                 self._load_contract()
@@ -2388,10 +2602,6 @@ class PVOpt(hass.Hass):
 
             self.io_prices = self.get_io_tariffs(self.octopus_import_entity[0])
 
-        elif ((pd.Timestamp.now(tz="UTC") - self.contract_last_loaded).total_seconds() / 3600) > 6:
-            # Reload every 6 hours
-            self._load_contract()
-
         if self._check_tariffs():
             self.log("")
             self.log("  Tariff error detected. Attempting to re-load.")
@@ -2401,6 +2611,7 @@ class PVOpt(hass.Hass):
             self.log("  Tariffs OK")
             self.log("")
 
+        self.timer.lap("tariffs")
         self.t0 = pd.Timestamp.now()
         self.pv_system.static_flows = pd.DataFrame(
             index=pd.date_range(
@@ -2413,6 +2624,7 @@ class PVOpt(hass.Hass):
 
         # Load Solcast
         solcast = self.load_solcast()
+        self.timer.lap("solcast")
 
         if solcast is None:
             self.log("")
@@ -2423,6 +2635,7 @@ class PVOpt(hass.Hass):
             pd.Timestamp.utcnow().normalize(),
             pd.Timestamp.utcnow().normalize() + pd.Timedelta(days=2),
         )
+        self.timer.lap("consumption")
 
         if consumption is None:
             self.log("")
@@ -2574,9 +2787,18 @@ class PVOpt(hass.Hass):
             self.selected_case = "Forced Discharge"
 
         self.status("Optimising charge plan")
+        self.timer.lap("base_flows")
 
         self.pv_system.contract = self.contract
 
+        max_seconds = self.get_config("max_optimiser_seconds")
+        deadline = time.time() + max_seconds if max_seconds > 0 else None
+        budget_hit = False
+
+        # The first case (Optimised Charging) is only the high cost usage swaps, which don't depend on export or
+        # discharge, so its result is shared with the later cases rather than being repeated.
+        stage1 = None
+
         # log all plans if debug_cat is A
         if self.debug and "A" in self.debug_cat:
             for case in cases:
@@ -2587,7 +2809,11 @@ class PVOpt(hass.Hass):
                     log=True,
                     use_export=cases[case]["export"],
                     discharge=cases[case]["discharge"],
+                    stage1=stage1,
+                    deadline=deadline,
                 )
+                stage1 = self.pv_system.stage1
+                budget_hit = budget_hit or self.pv_system.budget_hit
 
                 self.optimised_cost[case] = self.contract.net_cost(self.flows[case], sum=False)
 
@@ -2596,23 +2822,79 @@ class PVOpt(hass.Hass):
                 self.log("")
 
         else:
+            # With more than one worker the cases that aren't selected are sent to the pool on detached copies of
+            # the model before the selected case is run here, so that its plan is logged while they run. Each
+            # worker runs its own first stage. Cases run here share the first stage of the first one.
+            plan_cache = self.get_config("optimiser_plan_cache")
+            pool = self._optimiser_pool()
+            futures = {}
+            if pool is not None:
+                model = self.pv_system.detached()
+                for case in cases:
+                    if case != self.selected_case:
+                        futures[case] = pool.submit(
+                            pv.optimise_case,
+                            model,
+                            {
+                                "use_export": cases[case]["export"],
+                                "discharge": cases[case]["discharge"],
+                                "plan_cache": plan_cache,
+                                "deadline": deadline,
+                            },
+                        )
+
             for case in cases:
-                self.flows[case] = self.pv_system.optimised_force(
-                    log=(case == self.selected_case),
-                    use_export=cases[case]["export"],
-                    discharge=cases[case]["discharge"],
-                )
+                if case not in futures:
+                    self.flows[case] = self.pv_system.optimised_force(
+                        log=(case == self.selected_case),
+                        use_export=cases[case]["export"],
+                        discharge=cases[case]["discharge"],
+                        stage1=stage1,
+                        plan_cache=plan_cache,
+                        deadline=deadline,
+                    )
+                    if stage1 is None:
+                        stage1 = self.pv_system.stage1
+                    budget_hit = budget_hit or self.pv_system.budget_hit
+
+            for case, future in futures.items():
+                try:
+                    self.flows[case], plans, hit, timer = future.result()
+                    self.pv_system.last_plans.update(plans)
+                    self.timer.merge(timer)
+                    budget_hit = budget_hit or hit
+                except Exception as e:
+                    self.log(f"Optimiser worker failed for {case}: {e}. Running it here instead.", level="WARNING")
+                    self._stop_optimiser_pool()
+                    self.flows[case] = self.pv_system.optimised_force(
+                        log=False,
+                        use_export=cases[case]["export"],
+                        discharge=cases[case]["discharge"],
+                        stage1=stage1,
+                        deadline=deadline,
+                    )
+                    budget_hit = budget_hit or self.pv_system.budget_hit
 
+            for case in cases:
                 self.optimised_cost[case] = self.contract.net_cost(self.flows[case], sum=False)
 
-        # test = self.pv_system.optimised_force_de(
-        #     self.contract,
-        #     solar="solar",
-        #     export=cases[self.selected_case]["export"],
-        #     discharge=cases[self.selected_case]["discharge"],
-        #     log=True,
-        #     init=self.flows[self.selected_case].to_numpy(),
-        # )
+        self.optimiser_budget_hit = budget_hit
+        if budget_hit:
+            self.log(f"Optimiser stopped early after reaching the {max_seconds}s time limit", level="WARNING")
+
+        self.timer.lap("optimiser")
+
+        polish_seconds = self.get_config("optimiser_polish_seconds")
+        if polish_seconds > 0:
+            self.flows[self.selected_case] = self.pv_system.optimised_force_de(
+                log=True,
+                use_export=cases[self.selected_case]["export"],
+                discharge=cases[self.selected_case]["discharge"],
+                flows=self.flows[self.selected_case],
+                max_seconds=polish_seconds if deadline is None else min(polish_seconds, deadline - time.time()),
+            )
+            self.optimised_cost[self.selected_case] = self.contract.net_cost(self.flows[self.selected_case], sum=False)
+            self.timer.lap("polish")
 
         self.ulog("Optimisation Summary")
         self.log(f"  {'Base cost:':40s} {self.optimised_cost['Base'].sum():6.1f}p")
@@ -2855,18 +3137,19 @@ class PVOpt(hass.Hass):
         self.log(f"Optimiser elapsed time {optimiser_elapsed:0.1f} seconds")
         self.log("")
         self.log("")
+        self.timer.lap("plan_summary")
         self.write_to_hass(
-            entity=f"sensor.{self.prefix}_optimiser_elapsed",
-            state=optimiser_elapsed,
+            entity=f"binary_sensor.{self.prefix}_optimiser_budget_hit",
+            state="on" if self.optimiser_budget_hit else "off",
             attributes={
-                "state_class": "measurement",
-                "state_class": "duration",
-                "unit_of_measurement": "s",
+                "friendly_name": "Optimiser Time Limit Reached",
+                "max_optimiser_seconds": self.get_config("max_optimiser_seconds"),
             },
         )
 
         self.status("Writing to HA")
         self._write_output()
+        self.timer.lap("write_output")
 
         if self.get_config("read_only"):
             self.log("Read only mode enabled. Not querying inverter.")
@@ -3172,6 +3455,20 @@ class PVOpt(hass.Hass):
                 self._control_EV_charger()
                 self.log("")
 
+            self.timer.lap("inverter")
+
+        self.write_to_hass(
+            entity=f"sensor.{self.prefix}_optimiser_elapsed",
+            state=optimiser_elapsed,
+            attributes={
+                "state_class": "measurement",
+                "state_class": "duration",
+                "unit_of_measurement": "s",
+            }
+            | self.timer.attributes()
+            | {f"http_{name}": value for name, value in pv.http_client.stats().items()},
+        )
+
     def _create_windows(self):
 
         tolerance = self.get_config("forced_power_group_tolerance")
@@ -4140,19 +4437,26 @@ class PVOpt(hass.Hass):
         if self.debug and "T" in self.debug_cat:
             self.log(f">>> Yesterday's data:\n{self.pv_system.static_flows.to_string()}")
 
+        # Download every alternative tariff at once rather than one after another
+        tariffs = pv.load_tariffs(
+            {
+                (tariff_set["name"], imp_exp): {
+                    "name": tariff_set[f"octopus_{imp_exp}_tariff_code"],
+                    "export": (imp_exp == "export"),
+                }
+                for tariff_set in self.config["alt_tariffs"]
+                for imp_exp in IMPEXP
+            },
+            host=self,
+        )
+
         for tariff_set in self.config["alt_tariffs"]:
-            code = {}
-            tariffs = {}
             name = tariff_set["name"]
-            for imp_exp in IMPEXP:
-                code[imp_exp] = tariff_set[f"octopus_{imp_exp}_tariff_code"]
-                tariffs[imp_exp] = pv.Tariff(code[imp_exp], export=(imp_exp == "export"), host=self)
-
             contracts.append(
                 pv.Contract(
                     name=name,
-                    imp=tariffs["import"],
-                    exp=tariffs["export"],
+                    imp=tariffs[(name, "import")],
+                    exp=tariffs[(name, "export")],
                     host=self,
                 )
             )
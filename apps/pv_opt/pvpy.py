@@ -1,4 +1,11 @@
 # %%
+import heapq
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import copy
 from datetime import datetime
 
@@ -7,11 +14,55 @@ import pandas as pd
 import requests
 from numpy import isnan
 
+try:
+    from scipy import sparse
+    from scipy.optimize import Bounds, LinearConstraint, milp
+except ImportError:
+    milp = None
+
 OCTOPUS_PRODUCT_URL = r"https://api.octopus.energy/v1/products/"
 AGILE_PREDICT_URL = r"https://agilepredict.com/api/"
 
 TIME_FORMAT = "%d/%m %H:%M %Z"
 MAX_ITERS = 3
+TARIFF_CACHE_SIZE = 16
+RATE_HISTORY = pd.Timedelta(days=2)  # Rates downloaded before today's UTC midnight, enough for _compare_tariffs
+RATE_CACHE_FILE = "pv_opt_rates.sqlite"
+RATE_CACHE_MAX_AGE = pd.Timedelta(minutes=20)  # Cached rates downloaded more recently are used without a request
+HTTP_TIMEOUT = (5, 30)  # Connect and read timeouts (s)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5  # Wait before the first retry (s), doubled for each one after
+HTTP_RETRY_STATUS = [429, 500, 502, 503, 504]
+HTTP_POOL_SIZE = 8
+OPTIMISER_ENGINES = ["heuristic", "lp", "dp", "flow"]
+OPTIMISER_CONFIG = [
+    "optimiser_engine",
+    "allow_cyclic",
+    "slot_threshold_p",
+    "pass_threshold_p",
+    "discharge_threshold_p",
+    "maximum_soc",
+]
+PLAN_CACHE_SOC_TOLERANCE = 2
+PLAN_CACHE_POWER_TOLERANCE = 10
+PLAN_CACHE_MAX_REUSE = 3
+DP_SOC_STATES = 201
+DE_POPULATION = 32
+DE_MAX_SECONDS = 5
+DE_MAX_STALE = 50
+DE_INIT_SPREAD = 0.25
+DE_MIN_POWER = 50
+DE_F = 0.6
+DE_CR = 0.2
+TRACE_SIZE = 256
+# Most candidate slots costed together by one net_cost_batch call in the charging and discharging phases
+CANDIDATE_BATCH = 16
+# Lowest forced power (W) in an LP or DP plan. Smaller differences from the unforced flow are ignored and a plan that
+# leaves the battery idle forces a charge at this power.
+MIN_FORCED_POWER = 10
+# Cost (p/kWh) added to grid imports and exports in the LP so that ties are broken towards the unforced flow
+LP_GRID_PENALTY = 0.01
+NAT = np.iinfo(np.int64).min
 
 AGILE_FACTORS = {
     "import": {
@@ -66,7 +117,509 @@ def get_dt_hours(df: pd.DataFrame | pd.Series) -> pd.Series:
     return df["dt_hours"].ffill()
 
 
+def simulate_flows(
+    solar,
+    consumption,
+    forced,
+    dt_hours,
+    initial_chg: float,
+    capacity: float,
+    max_dod: float,
+    inverter_efficiency: float,
+    charger_efficiency: float,
+    start: int = 0,
+    chg_path=None,
+) -> dict:
+    """Steps the battery charge through each slot using plain float arrays.
+
+    Slots with a non-zero forced power are charged (or discharged if negative) at that AC power. All other
+    slots use the battery to meet the difference between consumption and solar. The charge is clipped to
+    max_dod * capacity and capacity and rounded to 0.1 Wh at every step.
+
+    If chg_path from an earlier result is given, the charge before slot start is taken from it and only the
+    slots from start onwards are stepped. This is only valid if nothing before start has changed.
+
+    Returns a dict of arrays: chg and chg_end (Wh at the start and end of each slot), battery (W, positive
+    when discharging), grid (W, positive when importing), soc and soc_end (%) and chg_path (the raw charge
+    at each slot boundary).
+    """
+    solar = np.asarray(solar, dtype=float)
+    consumption = np.asarray(consumption, dtype=float)
+    forced = np.asarray(forced)
+    dt_hours = np.asarray(dt_hours, dtype=float)
+
+    battery_grid_requirement = consumption - solar
+    battery_temp = np.where(forced != 0, -forced, battery_grid_requirement)
+    flow = np.where(
+        battery_temp > 0,
+        battery_temp / inverter_efficiency,
+        battery_temp * charger_efficiency,
+    )
+
+    min_chg = max_dod * capacity
+    if chg_path is None:
+        start = 0
+        chg = [initial_chg]
+    else:
+        chg = chg_path[: start + 1].tolist()
+    c = chg[-1]
+    for step in (flow[start:] * dt_hours[start:]).tolist():
+        c = max(min(c - step, capacity), min_chg)
+        # Same rounding as numpy.round(c, 1). NaN flows propagate as they did with the pandas model
+        if c == c:
+            c = round(c * 10) / 10
+        chg.append(c)
+
+    chg = np.array(chg, dtype=float)
+    battery = (chg[:-1] - chg[1:]) / dt_hours
+    battery = np.where(
+        battery > 0,
+        battery * inverter_efficiency,
+        np.where(battery < 0, battery / charger_efficiency, battery),
+    )
+
+    chg_start = chg[:-1]
+    chg_end = chg[1:]
+    if np.isnan(chg).any():
+        chg_start = pd.Series(chg_start).ffill().to_numpy()
+        chg_end = pd.Series(chg_end).bfill().to_numpy()
+
+    return {
+        "battery_grid_requirement": battery_grid_requirement,
+        "battery_temp": battery_temp,
+        "chg": chg_start,
+        "chg_end": chg_end,
+        "battery": battery,
+        "grid": np.round(battery_grid_requirement - battery, 0),
+        "soc": (chg_start / capacity) * 100,
+        "soc_end": (chg_end / capacity) * 100,
+        "chg_path": chg,
+    }
+
+
+def simulate_flows_batch(
+    solar,
+    consumption,
+    forced,
+    dt_hours,
+    initial_chg: float,
+    capacity: float,
+    max_dod: float,
+    inverter_efficiency: float,
+    charger_efficiency: float,
+) -> dict:
+    """Runs simulate_flows for a 2D array of forced powers (candidates x slots) in one pass.
+
+    The slots are stepped in turn but each step is a single array operation over all the candidates. Returns
+    the same keys as simulate_flows (except chg_path) with one row per candidate.
+    """
+    solar = np.asarray(solar, dtype=float)
+    consumption = np.asarray(consumption, dtype=float)
+    forced = np.atleast_2d(np.asarray(forced))
+    dt_hours = np.asarray(dt_hours, dtype=float)
+
+    battery_grid_requirement = consumption - solar
+    battery_temp = np.where(forced != 0, -forced, battery_grid_requirement)
+    flow = np.where(
+        battery_temp > 0,
+        battery_temp / inverter_efficiency,
+        battery_temp * charger_efficiency,
+    )
+    step = flow * dt_hours
+
+    min_chg = max_dod * capacity
+    chg = np.empty((forced.shape[0], forced.shape[1] + 1))
+    chg[:, 0] = initial_chg
+    for i in range(forced.shape[1]):
+        chg[:, i + 1] = np.round(np.maximum(np.minimum(chg[:, i] - step[:, i], capacity), min_chg), 1)
+
+    battery = (chg[:, :-1] - chg[:, 1:]) / dt_hours
+    battery = np.where(
+        battery > 0,
+        battery * inverter_efficiency,
+        np.where(battery < 0, battery / charger_efficiency, battery),
+    )
+
+    chg_start = chg[:, :-1]
+    chg_end = chg[:, 1:]
+
+    return {
+        "battery_grid_requirement": np.broadcast_to(battery_grid_requirement, forced.shape),
+        "battery_temp": battery_temp,
+        "chg": chg_start,
+        "chg_end": chg_end,
+        "battery": battery,
+        "grid": np.round(battery_grid_requirement - battery, 0),
+        "soc": (chg_start / capacity) * 100,
+        "soc_end": (chg_end / capacity) * 100,
+    }
+
+
+class StageTimer:
+    """Accumulates the time spent in named stages of a run and the number of calls to named functions.
+
+    The app keeps one as host.timer and resets it at the start of each optimise(). Stages are timed either with
+    the stage context manager or, for consecutive blocks of code, with lap, which books the time since the last
+    lap (or reset) to a stage. PVsystemModel, Contract and Tariff time and count their work against their
+    host's timer (see timer_for).
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.started = time.perf_counter()
+        self._mark = self.started
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - t0
+
+    def lap(self, name: str):
+        t = time.perf_counter()
+        self.seconds[name] = self.seconds.get(name, 0) + t - self._mark
+        self._mark = t
+
+    def count(self, name: str, n=1):
+        self.calls[name] = self.calls.get(name, 0) + n
+
+    def merge(self, other: "StageTimer"):
+        """Adds the stage times and call counts from another timer, such as one returned by a worker process."""
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+        for name, n in other.calls.items():
+            self.count(name, n)
+
+    def attributes(self) -> dict:
+        """Returns the stage times (s) and call counts as {stage}_seconds and {function}_calls."""
+        return (
+            {"total_seconds": round(time.perf_counter() - self.started, 3)}
+            | {f"{name}_seconds": round(seconds, 3) for name, seconds in self.seconds.items()}
+            | {f"{name}_calls": n for name, n in self.calls.items()}
+        )
+
+
+def timer_for(host) -> StageTimer:
+    """Returns the host's StageTimer, or one that is never read if the host doesn't have one."""
+    timer = getattr(host, "timer", None)
+    return _UNUSED_TIMER if timer is None else timer
+
+
+_UNUSED_TIMER = StageTimer()
+
+
+class HttpClient:
+    """A shared requests.Session with connection pooling, timeouts and retries that counts what it fetches.
+
+    Connection errors, timeouts and the statuses in HTTP_RETRY_STATUS are retried up to retries times, waiting
+    backoff seconds before the first retry and twice as long before each one after. The last response is
+    returned whatever its status so callers can still use raise_for_status.
+
+    The session is created on first use and is never pickled, so objects that are sent to worker processes
+    must not hold a reference to the client; pvpy uses the module level http_client instead.
+    """
+
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, pool_size=HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+            return self._session
+
+    def reset_stats(self):
+        self.calls = 0
+        self.retried = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "retries": self.retried, "errors": self.errors, "bytes": self.bytes}
+
+    def _count(self, retry: bool, error: bool, size=0):
+        with self._lock:
+            self.calls += 1
+            self.retried += int(retry)
+            self.errors += int(error)
+            self.bytes += size
+
+    def get(self, url, params=None, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                r = self.session.get(url, params=params, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._count(retry=attempt > 0, error=True)
+                if attempt == self.retries:
+                    raise
+                continue
+
+            retryable = r.status_code in HTTP_RETRY_STATUS
+            self._count(retry=attempt > 0, error=retryable, size=len(r.content))
+            if not retryable or attempt == self.retries:
+                return r
+
+    def get_all(self, urls, params=None, **kwargs) -> list:
+        """Gets each of urls at the same time and returns the responses in the same order.
+
+        The requests share the session's connection pool so the whole batch takes about as long as the slowest
+        request. params is either used for every request or is a list with the params for each url. If any
+        request raises, the first such exception is re-raised once all have finished.
+        """
+        if not isinstance(params, list):
+            params = [params] * len(urls)
+
+        if len(urls) < 2:
+            return [self.get(url, params=p, **kwargs) for url, p in zip(urls, params)]
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="pv_opt_http")
+            executor = self._executor
+
+        futures = [executor.submit(self.get, url, params=p, **kwargs) for url, p in zip(urls, params)]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __getstate__(self):
+        raise TypeError("HttpClient holds a requests.Session and can't be pickled")
+
+
+http_client = HttpClient()
+
+
+class RateCache:
+    """Keeps the Octopus rates that have been downloaded in a SQLite file so they survive a restart.
+
+    Rates are stored by tariff code and endpoint (standing-charges, standard-unit-rates etc) along with the
+    earliest period_from that has been downloaded and when the last download was. Published rates don't change,
+    so a tariff only needs the rates after the last one cached, or after the last download if the last rate is
+    open-ended as it may have been replaced since. If the download fails the cached rates are used on their own.
+
+    The cache is disabled until open is called with a path. A connection is made for each call so a RateCache can
+    be used from several threads.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = None
+        self._lock = threading.Lock()
+        if path:
+            self.open(path)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def open(self, path):
+        """Uses the cache file at path, creating it if needed. A path of None disables the cache."""
+        self.path = path
+        if path is not None:
+            with self._connect() as db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS rates (code TEXT, endpoint TEXT, valid_from INTEGER, "
+                    "valid_to INTEGER, value_inc_vat REAL, payment_method TEXT, "
+                    "PRIMARY KEY (code, endpoint, valid_from, payment_method))"
+                )
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS downloads (code TEXT, endpoint TEXT, period_from INTEGER, "
+                    "downloaded INTEGER, PRIMARY KEY (code, endpoint))"
+                )
+
+    @contextmanager
+    def _connect(self):
+        """Yields a connection that commits if the block succeeds, rolls back if it raises and is then closed."""
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def since(self, code: str, endpoint: str, period_from: pd.Timestamp, max_age=None) -> pd.Timestamp | None:
+        """Returns the time from which rates need downloading to bring the cache up to date for a download from
+        period_from, or None if the cache doesn't cover period_from and everything needs downloading.
+
+        If the last download was less than max_age ago the cache is taken to be up to date and pd.NaT is returned.
+        """
+        if not self.enabled:
+            return None
+
+        with self._connect() as db:
+            download = db.execute(
+                "SELECT period_from, downloaded FROM downloads WHERE code = ? AND endpoint = ?", (code, endpoint)
+            ).fetchone()
+            if download is None or (period_from is not None and download[0] > period_from.value):
+                return None
+
+            if max_age is not None and pd.Timestamp.now(tz="UTC") - pd.Timestamp(download[1], tz="UTC") < max_age:
+                return pd.NaT
+
+            last = db.execute(
+                "SELECT valid_to FROM rates WHERE code = ? AND endpoint = ? ORDER BY valid_from DESC LIMIT 1",
+                (code, endpoint),
+            ).fetchone()
+
+        if last is None or last[0] is None:
+            return pd.Timestamp(download[1], tz="UTC")
+        return pd.Timestamp(last[0], tz="UTC")
+
+    def store(self, code: str, endpoint: str, rates: list, period_from: pd.Timestamp | None):
+        """Adds rates downloaded from period_from (None if from the start), replacing any with the same start."""
+        if not self.enabled:
+            return
+
+        rows = [
+            (
+                code,
+                endpoint,
+                pd.Timestamp(x["valid_from"]).value,
+                None if x.get("valid_to") is None else pd.Timestamp(x["valid_to"]).value,
+                x["value_inc_vat"],
+                x.get("payment_method") or "",
+            )
+            for x in rates
+        ]
+        period_from = 0 if period_from is None else period_from.value
+        with self._lock, self._connect() as db:
+            db.executemany("INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?, ?, ?)", rows)
+            db.execute(
+                "INSERT INTO downloads VALUES (?, ?, ?, ?) ON CONFLICT (code, endpoint) DO UPDATE SET "
+                "period_from = MIN(period_from, excluded.period_from), downloaded = excluded.downloaded",
+                (code, endpoint, period_from, pd.Timestamp.now(tz="UTC").value),
+            )
+
+    def load(self, code: str, endpoint: str, period_from: pd.Timestamp | None = None) -> list:
+        """Returns the cached rates still in force at or after period_from in the Octopus API format."""
+        if not self.enabled:
+            return []
+
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT valid_from, valid_to, value_inc_vat, payment_method FROM rates "
+                "WHERE code = ? AND endpoint = ? AND (valid_to IS NULL OR valid_to > ?) ORDER BY valid_from",
+                (code, endpoint, 0 if period_from is None else period_from.value),
+            ).fetchall()
+
+        return [
+            {
+                "value_inc_vat": value,
+                "valid_from": pd.Timestamp(valid_from, tz="UTC").isoformat(),
+                "valid_to": None if valid_to is None else pd.Timestamp(valid_to, tz="UTC").isoformat(),
+                "payment_method": payment_method or None,
+            }
+            for valid_from, valid_to, value, payment_method in rows
+        ]
+
+
+rate_cache = RateCache()
+
+
+class RateTable:
+    """Holds a list of Octopus rates as sorted arrays.
+
+    Attributes:
+        valid_from: An int64 array of the UTC start of each rate in ns since the epoch, sorted.
+        valid_to: An int64 array of the UTC end of each rate in ns (NaT where the rate is open-ended).
+        value: A float64 array of the rate including VAT in p/kWh (p/day for standing charges).
+    """
+
+    def __init__(self, rates) -> None:
+        valid_from = pd.to_datetime([x["valid_from"] for x in rates], utc=True).asi8
+        valid_to = pd.to_datetime([x.get("valid_to") for x in rates], utc=True).asi8
+        value = np.array([x["value_inc_vat"] for x in rates], dtype=float)
+
+        order = np.argsort(valid_from, kind="stable")
+        self.valid_from = valid_from[order]
+        self.valid_to = valid_to[order]
+        self.value = value[order]
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        for valid_from, valid_to, value in zip(self.valid_from, self.valid_to, self.value):
+            yield {
+                "value_inc_vat": value,
+                "valid_from": pd.Timestamp(valid_from, tz="UTC"),
+                "valid_to": pd.Timestamp(valid_to, tz="UTC") if valid_to != NAT else None,
+            }
+
+    def merge(self, rates) -> "RateTable":
+        """Returns a table with rates added. Rates here that start at the same time as one of them are replaced."""
+        other = rates if isinstance(rates, RateTable) else RateTable(rates)
+        keep = ~np.isin(self.valid_from, other.valid_from)
+        table = RateTable([])
+        order = np.argsort(np.concatenate([self.valid_from[keep], other.valid_from]), kind="stable")
+        for name in ["valid_from", "valid_to", "value"]:
+            setattr(table, name, np.concatenate([getattr(self, name)[keep], getattr(other, name)])[order])
+        return table
+
+    def start(self) -> pd.Timestamp:
+        return pd.Timestamp(self.valid_from[0], tz="UTC")
+
+    def end(self) -> pd.Timestamp:
+        valid_to = self.valid_to[self.valid_to != NAT]
+        if len(valid_to) == 0:
+            return pd.NaT
+        return pd.Timestamp(valid_to.max(), tz="UTC")
+
+    def lookup(self, times) -> np.ndarray:
+        """Returns the rate in force at each time (the last one starting at or before it), NaN before the first."""
+        times = pd.DatetimeIndex(times).asi8
+        i = np.searchsorted(self.valid_from, times, side="right") - 1
+        return np.where(i >= 0, self.value[np.maximum(i, 0)], np.nan)
+
+
+def _rates_property(name):
+    """A Tariff attribute that stores a list of Octopus rates as a RateTable and clears the to_df cache when set."""
+
+    def fget(self):
+        return getattr(self, f"_{name}", None)
+
+    def fset(self, rates):
+        if not (self.manual or isinstance(rates, RateTable)):
+            rates = RateTable(rates)
+        setattr(self, f"_{name}", rates)
+        self.clear_cache()
+
+    return property(fget, fset)
+
+
 class Tariff:
+    unit = _rates_property("unit")
+    fixed = _rates_property("fixed")
+    day = _rates_property("day")
+    night = _rates_property("night")
+
     def __init__(
         self,
         name,
@@ -81,6 +634,7 @@ class Tariff:
         eco7_start="01:00",
         host=None,
         manual=False,
+        update_host=True,
         **kwargs,
     ) -> None:
         self.name = name
@@ -108,11 +662,13 @@ class Tariff:
         self.agile_predict = None
         self.eco7_start = pd.Timestamp(eco7_start, tz="UTC")
         self.manual = manual
+        self._df_cache = OrderedDict()
+        self._df_cache_state = (None, None)
 
-        self.host.io_prices = {}
-
+        self.octopus = octopus
         if octopus:
-            self.get_octopus_from_website(**kwargs)
+            with timer_for(self.host).stage("octopus_download"):
+                self.get_octopus_from_website(**kwargs)
             # self.log("")
             # self.log("Returned from get_octopus_from_website")
         else:
@@ -127,7 +683,16 @@ class Tariff:
                     self.day = [{"value_inc_vat": day, "valid_from": valid_from}]
                     self.night = [{"value_inc_vat": night, "valid_from": valid_from}]
 
-        if "INTELLI" in name and not self.export:
+        if update_host:
+            self.update_host()
+
+    def update_host(self, clear=True):
+        """Clears the host's io_prices (unless clear is False) and, for an Intelligent import tariff, reloads them
+        from the Octopus Energy integration. Tariff does this when it is created unless update_host is False."""
+        if clear:
+            self.host.io_prices = {}
+
+        if "INTELLI" in self.name and not self.export:
             if self.host.get_config("octopus_auto"):
                 try:
                     self.log(f"    Trying to find Octopus Intelligent Entities from Octopus Energy Integration:")
@@ -152,57 +717,118 @@ class Tariff:
                         level="WARNING",
                     )
 
-    def _oct_time(self, d):
-        # print(d)
-        return datetime(
-            year=pd.Timestamp(d).year,
-            month=pd.Timestamp(d).month,
-            day=pd.Timestamp(d).day,
-        )
+    @staticmethod
+    def _utc(d) -> pd.Timestamp:
+        d = pd.Timestamp(d)
+        return d.tz_localize("UTC") if d.tzinfo is None else d.tz_convert("UTC")
 
     def get_octopus_from_website(self, **kwargs):
+        """Downloads the standing charges and unit rates from the Octopus product API.
+
+        Only rates in force from period_from to period_to are downloaded. period_from defaults to RATE_HISTORY
+        before today's UTC midnight, which covers yesterday for _compare_tariffs and everything the optimiser
+        needs. Pass period_from=None to download the most recent 500 rates instead. Rates in the rate cache that
+        were downloaded less than max_age (default RATE_CACHE_MAX_AGE) ago are used without a request.
+        """
         code = self.name
-        product = code[5:-2]
+        self.product = code[5:-2]
         self.eco7 = code[:4] == "E-2R"
         self.area = code[-1]
+        self.clear_cache()
 
-        params = {
-            "page_size": 500,
-            "order_by": "period",
-        } | {
-            k: self._oct_time(kwargs.get(k, None))
-            for k in ["period_from", "period_to"]
-            if kwargs.get(k, None) is not None
-        }
+        kwargs.setdefault("period_from", pd.Timestamp.now(tz="UTC").normalize() - RATE_HISTORY)
+        period = {k: None if kwargs.get(k) is None else self._utc(kwargs[k]) for k in ["period_from", "period_to"]}
+
+        # The standing charges and unit rates are independent so they are fetched together
+        endpoints = [] if self.export else ["standing-charges"]
+        max_age = kwargs.get("max_age", RATE_CACHE_MAX_AGE)
+        results = self._download(endpoints + self._unit_endpoints(), **period, max_age=max_age)
 
         if not self.export:
-            url = f"{OCTOPUS_PRODUCT_URL}{product}/electricity-tariffs/{code}/standing-charges/"
-            self.fixed = [
-                x
-                for x in requests.get(url, params=params).json()["results"]
-                if x["payment_method"] != "NON_DIRECT_DEBIT"
-            ]
+            self.fixed = [x for x in results["standing-charges"] if x["payment_method"] != "NON_DIRECT_DEBIT"]
 
         if self.eco7:
-            url = f"{OCTOPUS_PRODUCT_URL}{product}/electricity-tariffs/{code}/day-unit-rates/"
-
-            self.day = [
-                x for x in requests.get(url, params=params).json()["results"] if x["payment_method"] == "DIRECT_DEBIT"
-            ]
-            url = f"{OCTOPUS_PRODUCT_URL}{product}/electricity-tariffs/{code}/night-unit-rates/"
-            self.night = [
-                x for x in requests.get(url, params=params).json()["results"] if x["payment_method"] == "DIRECT_DEBIT"
-            ]
+            self.day = results["day-unit-rates"]
+            self.night = results["night-unit-rates"]
             self.unit = self.day
 
         else:
-            url = f"{OCTOPUS_PRODUCT_URL}{product}/electricity-tariffs/{code}/standard-unit-rates/"
-            self.unit = requests.get(url, params=params).json()["results"]
-            # SVB logging
-            # self.log("")
-            # self.log("Printing self.unit")
-            # self.log(self.unit)
-            # self.log("")
+            self.unit = results["standard-unit-rates"]
+
+    def refresh(self) -> int:
+        """Downloads the unit rates published since end() and adds them to the rates already held.
+
+        This is how new Agile prices are picked up each afternoon without downloading the whole tariff again.
+        Tariffs that weren't loaded from Octopus, or whose rates have no end, are left as they are.
+
+        Returns:
+            The number of new rates.
+        """
+        if self.manual or not self.octopus or pd.isnull(self.end()):
+            return 0
+
+        with timer_for(self.host).stage("octopus_download"):
+            results = self._download(self._unit_endpoints(), period_from=self.end())
+
+        if sum(len(rates) for rates in results.values()) == 0:
+            return 0
+
+        n = len(self.unit)
+        if self.eco7:
+            self.day = self.day.merge(results["day-unit-rates"])
+            self.night = self.night.merge(results["night-unit-rates"])
+            self.unit = self.day
+        else:
+            self.unit = self.unit.merge(results["standard-unit-rates"])
+
+        # The predicted prices were for the slots that now have published rates
+        self.agile_predict = None
+        return len(self.unit) - n
+
+    def _unit_endpoints(self) -> list:
+        return ["day-unit-rates", "night-unit-rates"] if self.eco7 else ["standard-unit-rates"]
+
+    def _download(self, endpoints, period_from=None, period_to=None, max_age=RATE_CACHE_MAX_AGE) -> dict:
+        # Returns the rates from each endpoint in force from period_from to period_to. Only the rates that aren't
+        # in the rate cache are downloaded, and nothing is if it was downloaded less than max_age ago. Eco 7 day and
+        # night rates are filtered to Direct Debit
+        since = {endpoint: rate_cache.since(self.name, endpoint, period_from, max_age) for endpoint in endpoints}
+        stale = [endpoint for endpoint in endpoints if since[endpoint] is not pd.NaT]
+        params = []
+        for endpoint in stale:
+            period = {
+                "period_from": period_from if since[endpoint] is None else since[endpoint],
+                "period_to": period_to,
+            }
+            params.append(
+                {"page_size": 500, "order_by": "period"}
+                | {k: t.strftime("%Y-%m-%dT%H:%M:%SZ") for k, t in period.items() if t is not None}
+            )
+
+        url = f"{OCTOPUS_PRODUCT_URL}{self.product}/electricity-tariffs/{self.name}"
+        try:
+            responses = http_client.get_all([f"{url}/{endpoint}/" for endpoint in stale], params=params)
+            results = {endpoint: r.json()["results"] for endpoint, r in zip(stale, responses)}
+        except Exception as e:
+            if any(since[endpoint] is None for endpoint in stale):
+                raise
+            self.log(f"Unable to download rates for {self.name} ({e}). Using cached rates", level="WARNING")
+            results = {}
+
+        if rate_cache.enabled:
+            for endpoint, rates in results.items():
+                rate_cache.store(self.name, endpoint, rates, period_from)
+            results = {endpoint: rate_cache.load(self.name, endpoint, period_from) for endpoint in endpoints}
+            if period_to is not None:
+                results = {
+                    endpoint: [x for x in rates if pd.Timestamp(x["valid_from"]) < period_to]
+                    for endpoint, rates in results.items()
+                }
+
+        for endpoint in ["day-unit-rates", "night-unit-rates"]:
+            if endpoint in results:
+                results[endpoint] = [x for x in results[endpoint] if x["payment_method"] == "DIRECT_DEBIT"]
+        return results
 
     def __str__(self):
         if self.export:
@@ -219,13 +845,13 @@ class Tariff:
         if self.manual:
             return pd.Timestamp("2020-01-01", tz=self.tz)
         else:
-            return min([pd.Timestamp(x["valid_from"]) for x in self.unit])
+            return self.unit.start()
 
     def end(self):
         if self.manual:
             return pd.Timestamp.now(tz=self.tz)
         else:
-            return max([pd.Timestamp(x["valid_to"]) for x in self.unit])
+            return self.unit.end()
 
     def to_df(self, start=None, end=None, **kwargs):
 
@@ -237,38 +863,72 @@ class Tariff:
 
         if start is None:
             if self.eco7:
-                start = min([pd.Timestamp(x["valid_from"]) for x in self.day])
+                start = self.day.start()
 
             elif self.manual:
                 start = pd.Timestamp.now(tz=self.tz).floor("1D")
 
             else:
-                start = min([pd.Timestamp(x["valid_from"]) for x in self.unit])
+                start = self.unit.start()
 
         if end is None:
             end = pd.Timestamp.now(tz=start.tzinfo).ceil("30min")
 
         use_day_ahead = kwargs.get("day_ahead", ((start > time_now) or (end > time_now)))
 
+        self._check_df_cache()
+        key = (start, str(start.tzinfo), end, str(end.tzinfo), bool(use_day_ahead))
+        if key in self._df_cache:
+            self._df_cache.move_to_end(key)
+        else:
+            df = self._build_df(start, end, use_day_ahead)
+            self._df_cache[key] = (
+                df.index,
+                {col: self._read_only(df[col]) for col in df.columns},
+            )
+            if len(self._df_cache) > TARIFF_CACHE_SIZE:
+                self._df_cache.popitem(last=False)
+
+        index, data = self._df_cache[key]
+        return pd.DataFrame(data, index=index, copy=False)
+
+    @staticmethod
+    def _read_only(x: pd.Series) -> np.ndarray:
+        x = x.to_numpy(copy=True)
+        x.flags.writeable = False
+        return x
+
+    def _cache_state(self):
+        if self.host is None:
+            return None, None
+        events = tuple(
+            sorted(
+                (str(id), str(e.get("start")), str(e.get("end")), str(e.get("octopoints_per_kwh")))
+                for id, e in self.host.saving_events.items()
+            )
+        )
+        return self.host.io_prices, events
+
+    def _check_df_cache(self):
+        # io_prices is replaced rather than modified when it is reloaded but saving_events is added to in place
+        io_prices, events = self._cache_state()
+        if io_prices is not self._df_cache_state[0] or events != self._df_cache_state[1]:
+            self.clear_cache()
+            self._df_cache_state = (io_prices, events)
+
+    def clear_cache(self):
+        """Empties the to_df cache. Call this after changing the rates directly."""
+        self._df_cache = OrderedDict()
+
+    def _build_df(self, start, end, use_day_ahead):
         if self.eco7:
-            df = pd.concat(
-                [pd.DataFrame(x).set_index("valid_from")["value_inc_vat"] for x in [self.day, self.night]],
-                axis=1,
-            ).set_axis(["unit", "Night"], axis=1)
-            df.index = pd.to_datetime(df.index)
-            df = df.sort_index()
-            df = df.reindex(
-                index=pd.date_range(
-                    min([pd.Timestamp(x["valid_from"]) for x in self.day]),
-                    end,
-                    freq="30min",
-                )
-            ).ffill()
-            mask = (df.index.time >= self.eco7_start.time()) & (
-                df.index.time < (self.eco7_start + pd.Timedelta(7, "hours")).time()
+            index = pd.date_range(self.day.start(), end, freq="30min")
+            mask = (index.time >= self.eco7_start.time()) & (
+                index.time < (self.eco7_start + pd.Timedelta(7, "hours")).time()
             )
-            df.loc[mask, "unit"] = df.loc[mask, "Night"]
-            df = df["unit"].loc[start:end]
+            unit = np.where(mask, self.night.lookup(index), self.day.lookup(index))
+            window = (index >= start) & (index <= end)
+            df = pd.Series(index=index[window], data=unit[window], name="unit")
 
         elif self.manual:
             df = (
@@ -291,39 +951,38 @@ class Tariff:
             )
 
         else:
-            df = pd.DataFrame(self.unit).set_index("valid_from")["value_inc_vat"]
-            df.index = pd.to_datetime(df.index)
-            df = df.sort_index()
+            times = self.unit.valid_from
+            values = self.unit.value
             if "AGILE" in self.name and use_day_ahead:
                 if self.agile_predict is None:
                     self.agile_predict = self._get_agile_predict()
 
                 if self.agile_predict is not None:
-                    df = pd.concat(
-                        [
-                            df,
-                            self.agile_predict.loc[df.index[-1] + pd.Timedelta("30min") : end],
-                        ]
-                    )
+                    predict = self.agile_predict.loc[pd.Timestamp(times[-1], tz="UTC") + pd.Timedelta("30min") : end]
+                    times = np.concatenate([times, predict.index.asi8])
+                    values = np.concatenate([values, predict.to_numpy(dtype=float)])
 
+            slot = pd.Timedelta("30min").value
+            end_ns = end.value
             # If the index frequency >30 minutes so we need to just extend it:
-            if (len(df) > 1 and ((df.index[-1] - df.index[-2]).total_seconds() / 60) > 30) or len(df) == 1:
-                newindex = pd.date_range(df.index[0], end, freq="30min")
-                df = df.reindex(index=newindex).ffill().loc[start:]
+            if (len(times) > 1 and (times[-1] - times[-2]) > slot) or len(times) == 1:
+                index = pd.date_range(pd.Timestamp(times[0], tz="UTC"), end, freq="30min")
+                i = np.searchsorted(times, index.asi8, side="right") - 1
+                values = values[i]
+                window = index >= start
             else:
+                # Repeat the last 24 hours of rates (by position) for up to a week to reach the end
                 i = 0
-                while df.index[-1] < end and i < 7:
+                while times[-1] < end_ns and i < 7:
                     i += 1
-                    extended_index = pd.date_range(
-                        df.index[-1] + pd.Timedelta(30, "minutes"),
-                        df.index[-1] + pd.Timedelta(24, "hours"),
-                        freq="30min",
-                    )
-                    dfx = pd.concat([df, pd.DataFrame(index=extended_index)]).shift(48).loc[extended_index[0] :]
-                    df = pd.concat([df, dfx])
-                    df = df[df.columns[0]]
-                df = df.loc[start:end]
-            df.name = "unit"
+                    times = np.concatenate([times, times[-1] + slot * np.arange(1, 49)])
+                    repeat = values[-48:]
+                    if len(repeat) < 48:
+                        repeat = np.concatenate([np.full(48 - len(repeat), np.nan), repeat])
+                    values = np.concatenate([values, repeat])
+                index = pd.to_datetime(times, utc=True)
+                window = (index >= start) & (index <= end)
+            df = pd.Series(index=index[window], data=values[window], name="unit")
 
             # SVB logging
             # self.log("")
@@ -353,11 +1012,7 @@ class Tariff:
         # Add a column "fixed" for the standing charge.
         if not self.export:
             if not self.manual:
-                x = pd.DataFrame(self.fixed).set_index("valid_from")["value_inc_vat"].sort_index()
-                x.index = pd.to_datetime(x.index)
-                newindex = pd.date_range(x.index[0], df.index[-1], freq="30min")
-                x = x.reindex(newindex).sort_index()
-                x = x.ffill().loc[df.index[0] :]
+                x = pd.Series(index=df.index, data=self.fixed.lookup(df.index))
             else:
                 x = pd.DataFrame(index=df.index, data={"fixed": self.fixed})
 
@@ -403,7 +1058,7 @@ class Tariff:
     def _get_agile_predict(self):
         url = f"{AGILE_PREDICT_URL}{self.area}?days=2&high_low=false"
         try:
-            r = requests.get(url)
+            r = http_client.get(url)
             r.raise_for_status()  # Raise an exception for unsuccessful HTTP status codes
 
         except requests.exceptions.RequestException as e:
@@ -417,7 +1072,7 @@ class Tariff:
         url = "https://www.nordpoolgroup.com/api/marketdata/page/325?currency=GBP"
 
         try:
-            r = requests.get(url)
+            r = http_client.get(url)
             r.raise_for_status()  # Raise an exception for unsuccessful HTTP status codes
 
         except requests.exceptions.RequestException as e:
@@ -462,6 +1117,65 @@ class Tariff:
         return price.resample("30min").ffill().loc[start:]
 
 
+def load_tariffs(tariffs: dict, host=None, update_host=True) -> dict:
+    """Creates several Octopus tariffs at the same time so that their downloads overlap.
+
+    Args:
+        tariffs: The keyword arguments for each Tariff by key, e.g. {"import": {"name": code}, ...}.
+        host: The host passed to every Tariff.
+        update_host: If False the host is left unchanged and update_host must be called on each Tariff before it
+            is used, as when tariffs are loaded in the background.
+
+    Returns:
+        The Tariffs by the same keys. If any of them raises, the first exception is re-raised.
+    """
+    if len(tariffs) < 2:
+        return {key: Tariff(host=host, update_host=update_host, **kwargs) for key, kwargs in tariffs.items()}
+
+    # Only the downloads run at the same time. The host's io_prices are then cleared once and each Tariff makes
+    # its changes to the host in turn on this thread
+    with ThreadPoolExecutor(max_workers=len(tariffs), thread_name_prefix="pv_opt_tariff") as pool:
+        futures = {key: pool.submit(Tariff, host=host, update_host=False, **kwargs) for key, kwargs in tariffs.items()}
+        loaded = {key: future.result() for key, future in futures.items()}
+
+    if update_host:
+        host.io_prices = {}
+        for tariff in loaded.values():
+            tariff.update_host(clear=False)
+    return loaded
+
+
+class _PrefetchHost:
+    # Stands in for the app while prefetching so that creating the Tariffs doesn't reset its io_prices or look up
+    # Octopus Intelligent entities
+    debug = False
+    debug_cat = ""
+
+    def __init__(self, host) -> None:
+        self.log = host.log
+        self.rlog = host.rlog
+        self.tz = host.tz
+        self.io_prices = {}
+        self.saving_events = {}
+
+    def get_config(self, item, default=None):
+        return default
+
+
+def prefetch_rates(codes: dict, host, max_age=RATE_CACHE_MAX_AGE):
+    """Brings the rate cache up to date for several tariffs at once without changing anything the host uses.
+
+    Args:
+        codes: Whether each tariff code is an export tariff, by code.
+        host: The app, used for logging.
+        max_age: Tariffs downloaded more recently than this aren't downloaded again.
+    """
+    load_tariffs(
+        {code: {"name": code, "export": export, "max_age": max_age} for code, export in codes.items()},
+        host=_PrefetchHost(host),
+    )
+
+
 class InverterModel:
     """Describes the inverter
 
@@ -600,7 +1314,7 @@ class Contract:
             url = f"https://api.octopus.energy/v1/accounts/{octopus_account.account_number}/"
             self.rlog(f"Connecting to {url}")
             try:
-                r = requests.get(url, auth=(octopus_account.api_key, ""))
+                r = http_client.get(url, auth=(octopus_account.api_key, ""))
                 r.raise_for_status()  # Raise an exception for unsuccessful HTTP status codes
 
             except requests.exceptions.RequestException as e:
@@ -638,7 +1352,12 @@ class Contract:
             str += f"{tariff.__str__()}\n"
         return str
 
+    @property
+    def timer(self) -> StageTimer:
+        return timer_for(self.host)
+
     def net_cost(self, grid_flow, sum=True, decimals=1, **kwargs):
+        self.timer.count("net_cost")
         if len(grid_flow) == 0:
             return pd.Series()
 
@@ -650,7 +1369,6 @@ class Contract:
 
         # SVB debugging
         # self.log(f"Start = {start}, End = {end}")
-        
 
         if (
             isinstance(grid_flow, pd.DataFrame)
@@ -667,15 +1385,13 @@ class Contract:
             grid_exp = grid_flow.clip(upper=0)
 
         dt = get_dt_hours(grid_flow)
-         
 
         # imp_df = self.tariffs["import"].to_df(start, end, **kwargs)
         imp_df = self.tariffs["import"].to_df(start=start.floor("30min"), end=end, **kwargs)
         imp_df.index = [start] + list(imp_df.index[1:])
 
-
         # SVB logging
-        #self.log("dt = ")
+        # self.log("dt = ")
         # self.log(f"\n{dt.to_string()}")
         # self.log("imp_df = ")
         # self.log(f"\n{imp_df.to_string()}")
@@ -684,7 +1400,7 @@ class Contract:
         # self.log("grid_exp = ")
         # self.log(f"\n{grid_exp.to_string()}")
 
-        nc = imp_df["fixed"]
+        nc = imp_df["fixed"].copy()
         nc += imp_df["unit"] * grid_imp / 1000 * dt
 
         if self.tariffs["export"] is not None:
@@ -692,7 +1408,6 @@ class Contract:
             exp_df.index = [start] + list(exp_df.index[1:])
             nc += exp_df["unit"] * grid_exp / 1000 * dt
 
-
         if kwargs.get("log") and (self.host.debug and "F" in self.host.debug_cat):
             self.rlog(f">>> Import{self.tariffs['import'].to_df(start,end).to_string()}")
             self.rlog(f">>> Export{self.tariffs['export'].to_df(start,end).to_string()}")
@@ -702,7 +1417,6 @@ class Contract:
             self.log(">>> Return from net_cost routine")
             self.log(f">>> net_cost returned is {nc}")
 
-
         # SVB logging
         # self.log("nc.sum = ")
         # self.log(nc.sum().round(decimals))
@@ -714,6 +1428,45 @@ class Contract:
         else:
             return nc
 
+    def price_arrays(self, index, **kwargs) -> dict:
+        """Returns the import unit, import fixed and export unit prices aligned to index as float arrays.
+
+        The prices are built the same way as in net_cost, so that net_cost_array over them gives the same
+        answer. Slots without a price are NaN.
+        """
+        index = pd.DatetimeIndex(index)
+        start = index[0]
+        end = index[-1]
+
+        imp_df = self.tariffs["import"].to_df(start=start.floor("30min"), end=end, **kwargs)
+        imp_df.index = [start] + list(imp_df.index[1:])
+        imp_df = imp_df.reindex(index)
+
+        if self.tariffs["export"] is not None:
+            exp_df = self.tariffs["export"].to_df(start=start.floor("30min"), end=end, **kwargs)
+            exp_df.index = [start] + list(exp_df.index[1:])
+            export = exp_df["unit"].reindex(index).to_numpy(dtype=float)
+        else:
+            export = np.zeros(len(index))
+
+        return {
+            "import": imp_df["unit"].to_numpy(dtype=float),
+            "fixed": imp_df["fixed"].to_numpy(dtype=float),
+            "export": export,
+            "dt_hours": get_dt_hours(pd.Series(index=index, data=0.0)).to_numpy(),
+        }
+
+    @staticmethod
+    def net_cost_array(grid, price_arrays: dict, decimals=1):
+        """Returns the net cost of one grid flow array, or of each row of a 2D array, using price_arrays."""
+        grid = np.asarray(grid, dtype=float)
+        nc = (
+            price_arrays["fixed"]
+            + price_arrays["import"] * grid.clip(0) / 1000 * price_arrays["dt_hours"]
+            + price_arrays["export"] * grid.clip(max=0) / 1000 * price_arrays["dt_hours"]
+        )
+        return np.nansum(nc, axis=-1).round(decimals)
+
     def prices(self, start=None, end=None):
         prices = pd.concat(
             [
@@ -729,6 +1482,198 @@ class Contract:
         return prices
 
 
+class DecisionTrace:
+    """Records the decisions made by the optimiser phases as rows of a preallocated structured array.
+
+    Recording a decision only stores numbers, so it costs the same whether the plan is being logged or not. The
+    rows are turned into the log lines the phases print by render_row, either as each one is recorded (when the
+    phase is logging) or all together with render. The array doubles in size when it is full.
+
+    Fields that don't apply to a phase are left at zero. Slots are positions in the index passed to clear.
+    """
+
+    PHASES = ["high_cost_swaps", "low_cost_charging", "discharging"]
+    OUTCOMES = ["accepted", "rejected", "no_cheaper_slots", "no_search_window"]
+    DTYPE = np.dtype(
+        [
+            ("phase", np.int8),
+            ("outcome", np.int8),
+            ("step", np.int32),
+            ("available", np.int32),
+            ("slot", np.int32),
+            ("energy", np.float64),
+            ("price", np.float64),
+            ("power", np.float64),
+            ("window", np.int32),
+            ("window_price", np.float64),
+            ("window_cost", np.float64),
+            ("soc", np.float64),
+            ("soc_end", np.float64),
+            ("new_soc", np.float64),
+            ("new_soc_end", np.float64),
+            ("max_export", np.float64),
+            ("net_cost", np.float64),
+        ]
+    )
+
+    def __init__(self, size=TRACE_SIZE) -> None:
+        self.rows = np.zeros(size, dtype=self.DTYPE)
+        self.n = 0
+        self.index = None
+        self.tz = "GB"
+
+    def __len__(self):
+        return self.n
+
+    def clear(self, index=None, tz=None):
+        self.n = 0
+        self.index = index
+        if tz is not None:
+            self.tz = tz
+
+    def record(self, phase: str, outcome: str, **values) -> np.void:
+        if self.n == len(self.rows):
+            self.rows = np.concatenate([self.rows, np.zeros(len(self.rows), dtype=self.DTYPE)])
+
+        row = self.rows[self.n]
+        row.fill(0)
+        row["phase"] = self.PHASES.index(phase)
+        row["outcome"] = self.OUTCOMES.index(outcome)
+        for field, value in values.items():
+            row[field] = value
+        self.n += 1
+        return row
+
+    def records(self, phase=None) -> np.ndarray:
+        """Returns a copy of the recorded rows, optionally only those for one phase."""
+        rows = self.rows[: self.n].copy()
+        if phase is not None:
+            rows = rows[rows["phase"] == self.PHASES.index(phase)]
+        return rows
+
+    def _time(self, slot, local=False) -> str:
+        t = self.index[slot]
+        if local:
+            t = t.tz_convert(self.tz)
+        return t.strftime(TIME_FORMAT)
+
+    def render_row(self, row) -> str:
+        phase = self.PHASES[row["phase"]]
+        outcome = self.OUTCOMES[row["outcome"]]
+        if phase == "high_cost_swaps":
+            text = f"{row['step']:3d} {row['available']:3d} {self._time(row['slot'], local=True)}:"
+            text += f" {row['energy']:5.2f} kWh at {row['price']:6.2f}p. "
+            if outcome == "no_search_window":
+                return text + "No search window"
+
+            text += f"<==> {self._time(row['window'], local=True)}: {row['window_price']:5.2f}p/kWh {row['window_cost']:5.2f}p "
+            text += f" SOC: {row['soc']:5.1f}%->{row['soc_end']:5.1f}% "
+            if outcome == "no_cheaper_slots":
+                return text + "No cheaper slots"
+
+            text += f"New SOC: {row['new_soc']:5.1f}%->{row['new_soc_end']:5.1f}% "
+            return text + f"Net: {row['net_cost']:6.1f}"
+
+        if phase == "low_cost_charging":
+            text = f"{row['available']:>2d} Min import price {row['price']:5.2f}p/kWh at {self._time(row['slot'])} {row['power']:4.0f}W "
+        else:
+            text = f"{row['available']:>2d} Max export price {row['price']:5.2f}p/kWh at {self._time(row['slot'])} "
+        text += "  "
+        text += f"SOC: {row['soc']:5.1f}%->{row['soc_end']:5.1f}% "
+        text += f"Net: {row['net_cost']:5.1f} "
+        if outcome == "accepted":
+            text += f"New SOC: {row['new_soc']:5.1f}%->{row['new_soc_end']:5.1f}% "
+            text += f"Max export: {row['max_export']:0.0f}W "
+        return text
+
+    def render(self, phase=None, accepted_only=False) -> list:
+        """Returns the log lines for the recorded rows, optionally for one phase or only the accepted changes."""
+        rows = self.records(phase)
+        if accepted_only:
+            rows = rows[rows["outcome"] == self.OUTCOMES.index("accepted")]
+        return [self.render_row(row) for row in rows]
+
+
+class SlotQueue:
+    """Slot positions in a fixed order, taken one at a time.
+
+    available is shared with the caller. Slots that the caller has marked as unavailable, or that fail the
+    eligible check when they are reached, are skipped and not returned again.
+    """
+
+    def __init__(self, order: np.ndarray, available: np.ndarray) -> None:
+        self.order = order
+        self.available = available
+        self.position = 0
+
+    def next(self, eligible=None):
+        while self.position < len(self.order):
+            i = self.order[self.position]
+            if self.available[i] and (eligible is None or eligible(i)):
+                return i
+            self.position += 1
+        return None
+
+    def peek(self, count: int, eligible=None) -> list:
+        """Returns up to count of the slots that next would return in turn, as long as none is marked unavailable or
+        becomes ineligible in between, without taking them."""
+        peeked = []
+        for i in self.order[self.position :]:
+            if len(peeked) == count:
+                break
+            if self.available[i] and (eligible is None or eligible(i)):
+                peeked.append(i)
+        return peeked
+
+
+class OptimiserHost:
+    """A picklable snapshot of the parts of the app that the optimiser reads.
+
+    Used by PVsystemModel.detached so that a copy of the model can be run in a worker process. The settings in
+    OPTIMISER_CONFIG are read once when it is created and logging is discarded.
+    """
+
+    def __init__(self, host) -> None:
+        self.tz = host.tz
+        self.debug = False
+        self.debug_cat = ""
+        self.config = {item: host.get_config(item) for item in OPTIMISER_CONFIG}
+        self.io_prices = getattr(host, "io_prices", {})
+        self.saving_events = getattr(host, "saving_events", {})
+        self.timer = StageTimer()
+
+    def log(self, *args, **kwargs):
+        pass
+
+    def rlog(self, *args, **kwargs):
+        pass
+
+    def get_config(self, item, default=None):
+        value = self.config.get(item)
+        return default if value is None else value
+
+
+def _rehost(obj, host):
+    """Returns a shallow copy of a Tariff, Contract or PVsystemModel that uses host instead of its own."""
+    obj = copy(obj)
+    obj.host = host
+    obj.log = host.log
+    if hasattr(obj, "rlog"):
+        obj.rlog = host.rlog
+    return obj
+
+
+def optimise_case(model, kwargs: dict):
+    """Runs optimised_force on a detached model without logging. Used as the target for worker processes.
+
+    Returns the flows, the plan kept in the plan cache so that it can be passed back to the original model,
+    whether the deadline was hit and the worker's StageTimer.
+    """
+    flows = model.optimised_force(log=False, **kwargs)
+    plans = {key: plan for key, plan in model.last_plans.items() if plan["flows"] is flows}
+    return flows, plans, model.budget_hit, model.timer
+
+
 class PVsystemModel:
     def __init__(self, name: str, inverter: InverterModel, battery: BatteryModel, host=None) -> None:
         self.name = name
@@ -747,76 +1692,114 @@ class PVsystemModel:
         self.consumption_id = "consumption"
         self.flows = None
         self.contract = None
+        self._last_sim = None
+        self._checkpoint = None
+        self._price_arrays = None
+        self.stage1 = None
+        self.last_plans = {}
+        self.deadline = None
+        self.budget_hit = False
+        self.trace = DecisionTrace()
 
     def __str__(self):
         pass
 
-    def calculate_flows(self, slots=[], solar_id="solar", consumption_id="consumption", **kwargs):
-        # solar = self.static_flows[solar_id]
-        # consumption = self.static_flows[consumption_id]
-
-        self.flows = self.static_flows.copy()[[solar_id, consumption_id]].set_axis(["solar", "consumption"], axis=1)
-        self.flows["dt_hours"] = get_dt_hours(self.flows)
-        self.flows["battery_grid_requirement"] = self.flows["consumption"] - self.flows["solar"]
-        self.flows["forced"] = 0
-        self.flows["battery_temp"] = self.flows["consumption"] - self.flows["solar"]
-        # forced_charge = pd.Series(index=self.flows.index, data=0)
-
+    @property
+    def timer(self) -> StageTimer:
+        return timer_for(self.host)
+
+    def detached(self):
+        """Returns a copy of the model, its contract and tariffs that refers to an OptimiserHost rather than the
+        app so that it can be pickled and optimised in another process without touching this model's state.
+        """
+        host = OptimiserHost(self.host)
+        model = _rehost(self, host)
+        model._last_sim = None
+        model._checkpoint = None
+        model._price_arrays = None
+        model.stage1 = None
+        model.trace = DecisionTrace()
+        if self.contract is not None:
+            model.contract = _rehost(self.contract, host)
+            model.contract.tariffs = {
+                direction: None if tariff is None else _rehost(tariff, host)
+                for direction, tariff in self.contract.tariffs.items()
+            }
+        return model
+
+    def _slot_power(self, slots) -> np.ndarray:
+        """Sums the forced power in each (time, power) slot onto the static_flows index as an int array.
+
+        Raises:
+            KeyError: If a slot's time isn't in the static_flows index.
+        """
+        forced = np.zeros(len(self.static_flows), dtype=np.int64)
         if len(slots) > 0:
-            timed_slot_flows = pd.Series(index=self.flows.index, data=0)
-
-            for t, c in slots:
+            positions = self.static_flows.index.get_indexer([t for t, c in slots])
+            if (positions < 0).any():
+                missing = [t for i, (t, c) in zip(positions, slots) if i < 0]
+                raise KeyError(f"Slot times not in static_flows: {missing}")
+            for i, (t, c) in zip(positions, slots):
                 if not isnan(c):
-                    timed_slot_flows.loc[t] += int(c)
-
-            chg_mask = timed_slot_flows != 0
-            # self.flows["battery_temp"][chg_mask] = -timed_slot_flows[chg_mask]
-            # self.flows["forced"][chg_mask] = timed_slot_flows[chg_mask]
-
-            self.flows.loc[chg_mask, "battery_temp"] = -timed_slot_flows[chg_mask]
-            self.flows.loc[chg_mask, "forced"] = timed_slot_flows[chg_mask]
-
-        chg = [self.initial_soc / 100 * self.battery.capacity]
-
-        for idx in self.flows.index:
-            flow = self.flows["battery_temp"].loc[idx]
-            dt_hours = self.flows["dt_hours"].loc[idx]
+                    forced[i] += int(c)
+        return forced
+
+    def simulate(self, forced, solar_id="solar", consumption_id="consumption", **kwargs) -> dict:
+        """Runs simulate_flows over static_flows for an array of forced powers without building a DataFrame."""
+        return simulate_flows(
+            solar=self.static_flows[solar_id].to_numpy(dtype=float),
+            consumption=self.static_flows[consumption_id].to_numpy(dtype=float),
+            forced=forced,
+            dt_hours=get_dt_hours(self.static_flows).to_numpy(),
+            initial_chg=self.initial_soc / 100 * self.battery.capacity,
+            capacity=self.battery.capacity,
+            max_dod=self.battery.max_dod,
+            inverter_efficiency=self.inverter.inverter_efficiency,
+            charger_efficiency=self.inverter.charger_efficiency,
+            **kwargs,
+        )
 
-            if flow > 0:
-                flow = flow / self.inverter.inverter_efficiency
-            else:
-                flow = flow * self.inverter.charger_efficiency
-
-            chg.append(
-                round(
-                    max(
-                        [
-                            min(
-                                [
-                                    chg[-1] - flow * dt_hours,
-                                    self.battery.capacity,
-                                ]
-                            ),
-                            self.battery.max_dod * self.battery.capacity,
-                        ]
-                    ),
-                    1,
-                )
+    def calculate_flows(self, slots=[], solar_id="solar", consumption_id="consumption", resume=False, **kwargs):
+        """Simulates the plan given by slots and stores the result in self.flows.
+
+        With resume=True the previous simulation is reused up to the first slot whose forced power differs,
+        provided it was run on the same static_flows, initial_soc and columns.
+        """
+        self.timer.count("calculate_flows")
+        forced = self._slot_power(slots)
+        key = (self.static_flows, self.initial_soc, solar_id, consumption_id)
+
+        last = self._last_sim
+        if resume and last is not None and last["key"][0] is key[0] and last["key"][1:] == key[1:]:
+            changed = np.flatnonzero(forced != last["forced"])
+            start = changed[0] if len(changed) > 0 else len(forced)
+            sim = self.simulate(
+                forced,
+                solar_id=solar_id,
+                consumption_id=consumption_id,
+                start=start,
+                chg_path=last["sim"]["chg_path"],
             )
-
-        self.flows["chg"] = chg[:-1]
-        self.flows["chg"] = self.flows["chg"].ffill()
-        self.flows["chg_end"] = chg[1:]
-        self.flows["chg_end"] = self.flows["chg_end"].bfill()
-        self.flows["battery"] = pd.Series(chg).diff(-1)[:-1].to_list()
-        self.flows["battery"] /= self.flows["dt_hours"]
-        self.flows.loc[self.flows["battery"] > 0, "battery"] = (
-            self.flows["battery"] * self.inverter.inverter_efficiency
+        else:
+            sim = self.simulate(forced, solar_id=solar_id, consumption_id=consumption_id)
+
+        self.flows = pd.DataFrame(
+            {
+                "solar": self.static_flows[solar_id],
+                "consumption": self.static_flows[consumption_id],
+                "dt_hours": get_dt_hours(self.static_flows),
+                "battery_grid_requirement": sim["battery_grid_requirement"],
+                "forced": forced,
+                "battery_temp": sim["battery_temp"],
+                "chg": sim["chg"],
+                "chg_end": sim["chg_end"],
+                "battery": sim["battery"],
+                "grid": sim["grid"],
+                "soc": sim["soc"],
+                "soc_end": sim["soc_end"],
+            },
+            index=self.static_flows.index,
         )
-        self.flows.loc[self.flows["battery"] < 0, "battery"] = self.flows["battery"] / self.inverter.charger_efficiency
-        self.flows["grid"] = (self.flows["battery_grid_requirement"] - self.flows["battery"]).round(0)
-        self.flows["soc"] = (self.flows["chg"] / self.battery.capacity) * 100
-        self.flows["soc_end"] = (self.flows["chg_end"] / self.battery.capacity) * 100
 
         if self.prices is not None:
             self.flows = pd.concat(
@@ -824,18 +1807,110 @@ class PVsystemModel:
                 axis=1,
             )
 
+        self._last_sim = {
+            "key": key,
+            "slots": list(slots),
+            "forced": forced,
+            "sim": sim,
+            "flows": self.flows,
+        }
+
+    def _save_checkpoint(self):
+        """Keeps the most recent simulation so that a rejected trial slot can be rolled back to it."""
+        self._checkpoint = self._last_sim
+
+    def _restore_checkpoint(self, slots):
+        """Restores self.flows for slots from the checkpoint, or re-simulates if the checkpoint is for another plan."""
+        if self._checkpoint is not None and self._checkpoint["slots"] == slots:
+            self._last_sim = self._checkpoint
+            self.flows = self._checkpoint["flows"]
+        else:
+            self.calculate_flows(slots=slots, resume=True)
+
+    def _candidate_costs(self, candidates) -> np.ndarray:
+        """Returns the net cost of the current plan with each (position, power) candidate added to it.
+
+        The candidates are costed together with net_cost_batch. Their powers are added to the current forced power
+        in the same way as _slot_power, so each cost is the one calculate_flows and net_cost would give.
+        """
+        trial = np.repeat(self.flows["forced"].to_numpy(dtype=np.int64)[None, :], len(candidates), axis=0)
+        for row, (k, power) in enumerate(candidates):
+            if not isnan(power):
+                trial[row, k] += int(power)
+        return self.net_cost_batch(trial)
+
+    def net_cost_batch(self, forced, price_arrays=None, **kwargs):
+        """Returns the net cost of each row of a (candidates x slots) array of forced powers.
+
+        All the candidates are simulated together with simulate_flows_batch and costed with
+        Contract.net_cost_array, so scoring a set of trial plans needs one call rather than one calculate_flows
+        and net_cost per plan. price_arrays can be passed to cost with other prices than the contract's.
+        """
+        self.timer.count("net_cost_batch")
+        sim = simulate_flows_batch(
+            solar=self.static_flows[self.solar_id].to_numpy(dtype=float),
+            consumption=self.static_flows[self.consumption_id].to_numpy(dtype=float),
+            forced=forced,
+            dt_hours=get_dt_hours(self.static_flows).to_numpy(),
+            initial_chg=self.initial_soc / 100 * self.battery.capacity,
+            capacity=self.battery.capacity,
+            max_dod=self.battery.max_dod,
+            inverter_efficiency=self.inverter.inverter_efficiency,
+            charger_efficiency=self.inverter.charger_efficiency,
+        )
+        if price_arrays is None:
+            if self._price_arrays_valid() and not kwargs:
+                price_arrays = self._price_arrays["prices"]
+            else:
+                price_arrays = self.contract.price_arrays(self.static_flows.index, **kwargs)
+        return self.contract.net_cost_array(sim["grid"], price_arrays)
+
     @property
     def net_cost(self):
         if self.flows is not None:
+            if self._price_arrays_valid():
+                self.timer.count("net_cost")
+                return self.contract.net_cost_array(self.flows["grid"].to_numpy(), self._price_arrays["prices"])
             return self.contract.net_cost(self.flows)
 
+    def _price_arrays_valid(self):
+        pa = self._price_arrays
+        return pa is not None and pa["static_flows"] is self.static_flows and pa["contract"] is self.contract
+
+    def _load_price_arrays(self):
+        """Builds the import/export/fixed price arrays for the current horizon once so that every trial plan
+        in optimised_force can be costed with Contract.net_cost_array instead of rebuilding the tariffs."""
+        self._price_arrays = {
+            "static_flows": self.static_flows,
+            "contract": self.contract,
+            "prices": self.contract.price_arrays(self.static_flows.index),
+        }
+
     def optimised_force(
         self,
         log=True,
         discharge=False,
         use_export=True,
         max_iters=MAX_ITERS,
+        stage1=None,
+        plan_cache=False,
+        deadline=None,
     ):
+        """Optimises the forced charge and discharge slots and returns the resulting flows.
+
+        The first stage (the high cost usage swaps) only depends on the import prices so its result is kept in
+        self.stage1. Passing that as stage1 to a later call with the same static_flows, initial_soc and contract
+        skips the stage and carries on from its slots, best_cost and flows.
+
+        With plan_cache the plan from the last call with the same use_export, discharge, engine, battery, inverter
+        and thresholds (see _plan_key) is moved onto the new horizon and used as it is if nothing it was based on
+        has changed (see cached_plan). Otherwise the plan is optimised from scratch.
+
+        deadline is a time.time() by which the optimiser should finish. Each phase stops when it is passed and
+        the best plan so far is kept, setting self.budget_hit.
+        """
+        self.deadline = deadline
+        self.budget_hit = False
 
         if log and (self.host.debug and "B" in self.host.debug_cat):
             self.log("Called optimised_force")
@@ -867,6 +1942,8 @@ class PVsystemModel:
             )
 
         self.calculate_flows()
+        self._load_price_arrays()
+        self.trace.clear(self.static_flows.index, self.tz)
         self.base_cost = self.net_cost
         self.best_cost = self.base_cost
         self.net_costs = [self.base_cost]
@@ -874,7 +1951,47 @@ class PVsystemModel:
         if log:
             self.log(f"Base cost:  {self.base_cost}")
 
-        self._high_cost_swaps(log=log)
+        self.stage1 = None
+        engine = self.host.get_config("optimiser_engine", "heuristic")
+        key = self._plan_key(use_export, discharge, engine)
+
+        plan = self.cached_plan(key) if plan_cache else None
+        if plan is not None:
+            slots = plan
+            self.calculate_flows(slots=slots, resume=True)
+            self.slots = slots
+            self.best_cost = self.net_cost
+            if log:
+                self.log("")
+                self.log(
+                    f"Nothing has changed since the last plan. Re-using its {len(slots)} slots. Net: {self.best_cost:6.1f}"
+                )
+
+            # Without export the plan is only the first stage
+            if not use_export:
+                self.stage1 = {"slots": list(self.slots), "best_cost": self.best_cost, "flows": self.flows}
+            return self.remember_plan(key, reused=self.last_plans[key]["reused"] + 1)
+
+        if engine == "lp":
+            with self.timer.stage("lp"):
+                solved = self._optimise_lp(log=log, discharge=discharge)
+            if solved:
+                return self.remember_plan(key)
+        elif engine == "dp":
+            with self.timer.stage("dp"):
+                self._optimise_dp(log=log, discharge=discharge)
+            return self.remember_plan(key)
+
+        if stage1 is not None:
+            self._apply_stage1(stage1, log=log)
+        elif engine == "flow":
+            with self.timer.stage("min_cost_flow_swaps"):
+                self._min_cost_flow_swaps(log=log)
+        else:
+            with self.timer.stage("high_cost_swaps"):
+                self._high_cost_swaps(log=log)
+
+        self.stage1 = {"slots": list(self.slots), "best_cost": self.best_cost, "flows": self.flows}
 
         # Only do the rest if there is an export tariff:
         # self.log(f"Sum of Export Prices = {prices['export'].sum()}")
@@ -885,21 +2002,23 @@ class PVsystemModel:
 
         self.slots_added = 999
 
-        while (self.slots_added > 0) and (j < max_iters):
+        while (self.slots_added > 0) and (j < max_iters) and not self._out_of_time():
             j += 1
             # No need to iterate if this is charge only
             if not discharge:
                 j += max_iters
 
-            self._low_cost_charging(log=log)
+            with self.timer.stage("low_cost_charging"):
+                self._low_cost_charging(log=log)
 
             if log:
                 self.log(f"Iteration {j:2d}: Slots added: {self.slots_added:3d}")
 
             if discharge:
-                self._discharging(log=log)
+                with self.timer.stage("discharging"):
+                    self._discharging(log=log)
 
-        self.calculate_flows(slots=self.slots)
+        self.calculate_flows(slots=self.slots, resume=True)
 
         # df.index = pd.to_datetime(df.index)
 
@@ -931,25 +2050,571 @@ class PVsystemModel:
                     if i == len(new_slots) - 2:
                         revised_slots.append(x[1])
 
-            self.calculate_flows(slots=revised_slots)
+            self.calculate_flows(slots=revised_slots, resume=True)
 
             best_cost_new = self.net_cost
             if log:
                 self.log(f"  Net cost revised from {self.best_cost:0.1f}p to {best_cost_new:0.1f}p")
             slots = revised_slots
             # self.flows.index = pd.to_datetime(df.index)
+        return self.remember_plan(key)
+
+    def _plan_key(self, use_export, discharge, engine) -> tuple:
+        """Returns the key under which a plan is kept in the plan cache.
+
+        As well as the case and engine it holds everything else the optimisers read so that a plan is never
+        re-used once the battery, the inverter or any of the thresholds have changed.
+        """
+        config = tuple(
+            self.host.get_config(item)
+            for item in [
+                "slot_threshold_p",
+                "pass_threshold_p",
+                "discharge_threshold_p",
+                "maximum_soc",
+                "allow_cyclic",
+            ]
+        )
+        return (
+            use_export,
+            discharge,
+            engine,
+            tuple(sorted(vars(self.battery).items())),
+            tuple(sorted(vars(self.inverter).items())),
+            config,
+        )
+
+    def remember_plan(self, key, flows=None, reused=0):
+        """Keeps flows (by default self.flows) as the last plan for key so that cached_plan can re-use it."""
+        if flows is None:
+            flows = self.flows
+        # Plans for the same case made with other inputs can't be re-used any more
+        for old in [k for k in self.last_plans if k[:3] == key[:3]]:
+            self.last_plans.pop(old)
+        if not self.budget_hit:
+            # A plan cut short by the deadline isn't worth re-using
+            self.last_plans[key] = {"flows": flows, "reused": reused}
+        return flows
+
+    def _out_of_time(self) -> bool:
+        """Returns True, and sets budget_hit, once the deadline passed to optimised_force has gone."""
+        if (self.deadline is not None) and (time.time() > self.deadline):
+            self.budget_hit = True
+        return self.budget_hit
+
+    def cached_plan(self, key) -> list:
+        """Moves the last plan for key onto the current static_flows and returns its slots if it is still valid.
+
+        The plan is valid if the new horizon lies within the old one, the solar, consumption and prices are
+        the same in every slot after the first (which may be a different part of a half hour), and the initial
+        SOC is within PLAN_CACHE_SOC_TOLERANCE of where the old plan had the battery at the new start. As the
+        heuristic doesn't always find the same plan on a shorter horizon a plan is only re-used
+        PLAN_CACHE_MAX_REUSE times in a row. Returns None if there is no valid plan.
+        """
+        if key not in self.last_plans or self.last_plans[key]["reused"] >= PLAN_CACHE_MAX_REUSE:
+            return None
+        last = self.last_plans[key]["flows"]
+
+        index = self.static_flows.index
+        rest = index[1:]
+        if not rest.isin(last.index).all():
+            return None
+
+        old = last.loc[rest]
+        new = self.static_flows.loc[rest]
+        for column in [self.solar_id, self.consumption_id]:
+            if not np.allclose(old[column], new[column], rtol=0, atol=PLAN_CACHE_POWER_TOLERANCE):
+                return None
+
+        for column in self.prices.columns:
+            if not np.allclose(old[column], self.prices.loc[rest, column], rtol=0, atol=0.01, equal_nan=True):
+                return None
+
+        # Where the old plan had the battery at the new start, part way through one of its slots
+        i = last.index.searchsorted(index[0], side="right") - 1
+        if i < 0:
+            return None
+        row = last.iloc[i]
+        fraction = (index[0] - last.index[i]).total_seconds() / 3600 / row["dt_hours"]
+        soc = row["soc"] + (row["soc_end"] - row["soc"]) * min(fraction, 1)
+        if abs(soc - self.initial_soc) > PLAN_CACHE_SOC_TOLERANCE:
+            return None
+
+        slots = []
+        for t, power in last.loc[last["forced"] != 0, "forced"].items():
+            if t in rest:
+                slots.append((t, power))
+            elif t.floor("30min") == index[0].floor("30min") and t <= index[0]:
+                slots.append((index[0], power))
+        return slots
+
+    def _apply_stage1(self, stage1: dict, log=True):
+        """Carries on from a stage1 result from an earlier call, swapping in this call's prices."""
+        if log:
+            self.log("")
+            self.log("High Cost Usage Swaps")
+            self.log("---------------------")
+            self.log("")
+            self.log(
+                f"Using the result from an earlier case: {len(stage1['slots'])} slots. Net: {stage1['best_cost']:6.1f}"
+            )
+
+        self.slots = list(stage1["slots"])
+        self.best_cost = stage1["best_cost"]
+        self.net_costs.append(self.best_cost)
+        self.flows = pd.concat([stage1["flows"].drop(columns=self.prices.columns), self.prices], axis=1)
+
+    def optimised_force_de(
+        self,
+        log=True,
+        discharge=False,
+        use_export=True,
+        init=None,
+        max_seconds=DE_MAX_SECONDS,
+        population=DE_POPULATION,
+        seed=None,
+        flows=None,
+    ):
+        """Polishes a plan with differential evolution over the forced power in each slot.
+
+        flows is the plan to polish, by default self.flows. As the model keeps the prices of the last case it
+        optimised, the returned flows take their prices from it and its forced power (or
+        init if given) seeds the population along with perturbed copies of it. Each generation every trial plan
+        is simulated and costed together with net_cost_batch. Each forced slot costs slot_threshold_p so that
+        slots which don't save at least that are dropped. Without discharge only charging is forced. The search
+        stops after max_seconds or when it stops improving and the best plan is kept only if it beats init by
+        more than pass_threshold_p and costs no more than init without the slot penalty.
+        """
+        if log:
+            self.log("")
+            self.log("Differential Evolution")
+            self.log("----------------------")
+
+        t0 = time.time()
+        if self.deadline is not None:
+            max_seconds = min(max_seconds, self.deadline - t0)
+        rng = np.random.default_rng(seed)
+        n = len(self.static_flows)
+        if flows is None:
+            flows = self.flows
+        if init is None:
+            init = flows["forced"].to_numpy()
+        init = np.asarray(init, dtype=float)
+        self.prices = flows[[t for t in self.contract.tariffs.keys() if self.contract.tariffs[t] is not None]]
+
+        price_arrays = self.contract.price_arrays(self.static_flows.index)
+        if not use_export:
+            discharge = False
+            price_arrays["export"] = np.zeros(n)
+
+        upper = float(min(self.inverter.charger_power, self.battery.max_charge_power))
+        lower = -float(min(self.inverter.inverter_power, self.battery.max_discharge_power)) if discharge else 0.0
+        penalty = self.host.get_config("slot_threshold_p")
+
+        def tidy(forced):
+            # Round to 10W and drop anything too small to be worth forcing
+            forced = np.round(forced.clip(lower, upper), -1)
+            forced[np.abs(forced) < DE_MIN_POWER] = 0
+            return forced
+
+        def score(forced):
+            return self.net_cost_batch(forced, price_arrays=price_arrays) + penalty * (forced != 0).sum(axis=1)
+
+        # Only the perturbed or crossed over slots are tidied so that MIN_FORCED_POWER charges in init survive
+        pop = np.repeat(init[None, :], population, axis=0)
+        spread = (upper - lower) * DE_INIT_SPREAD
+        perturb = rng.random((population, n)) < 0.2
+        perturb[0] = False
+        pop = np.where(perturb, tidy(pop + rng.normal(0, spread, size=(population, n))), pop)
+        cost = score(pop)
+        init_cost = cost[0]
+
+        generations = 0
+        stale = 0
+        while (time.time() - t0 < max_seconds) and (stale < DE_MAX_STALE):
+            generations += 1
+            # Three distinct members for each target, none of them the target itself
+            others = np.argsort(rng.random((population, population - 1)), axis=1)[:, :3]
+            others += others >= np.arange(population)[:, None]
+            a, b, c = others.T
+            mutant = pop[a] + DE_F * (pop[b] - pop[c])
+            cross = rng.random((population, n)) < DE_CR
+            cross[np.arange(population), rng.integers(0, n, population)] = True
+            trial = np.where(cross, tidy(mutant), pop)
+
+            trial_cost = score(trial)
+            better = trial_cost < cost
+            pop[better] = trial[better]
+            best_before = cost.min()
+            cost[better] = trial_cost[better]
+            stale = stale + 1 if cost.min() >= best_before - 0.05 else 0
+
+        best = pop[np.argmin(cost)]
+        if log:
+            self.log(
+                f"{generations} generations of {population} in {time.time() - t0:0.2f}s. Net (including slot penalty): {init_cost:0.1f}p -> {cost.min():0.1f}p"
+            )
+
+        # Dropping a slot saves its penalty, so the plan without the penalty mustn't cost more than init either
+        unpenalised = self.net_cost_batch(np.stack([init, best]), price_arrays=price_arrays)
+        if (init_cost - cost.min() > self.host.get_config("pass_threshold_p")) and (unpenalised[1] <= unpenalised[0]):
+            slots = [(self.static_flows.index[i], best[i]) for i in np.flatnonzero(best)]
+        else:
+            if log:
+                self.log(
+                    f"Improvement < Pass Threshold ({self.host.get_config('pass_threshold_p'):0.1f}p) => Plan unchanged"
+                )
+            slots = [(self.static_flows.index[i], init[i]) for i in np.flatnonzero(init)]
+
+        self.calculate_flows(slots=slots, resume=True)
+        self.slots = slots
+        self.best_cost = self.net_cost
         return self.flows
 
-    def _search_window(self, df: pd.DataFrame, available: pd.Series, max_slot):
-        # Need to check why this .iloc[:-1] is here....
-        x = df.loc[: max_slot - pd.Timedelta("30min")].copy()
-        if len(x) > 0:
-            x = x[available.loc[: max_slot - pd.Timedelta("30min")]]
-            x["countback"] = (x["soc_end"] >= 97).sum() - (x["soc_end"] >= 97).cumsum()
-            x = x[x["countback"] == 0]
-            x = x[x["forced"] < (self.inverter.charger_power)]
-            x = x[x["soc_end"] <= 97]
-        return x
+    def _slots_from_battery(self, battery) -> list:
+        """Converts a planned AC battery flow per slot (W, positive when discharging) into forced slots.
+
+        The plan is followed through simulate_flows one slot at a time. Slots where it is within
+        MIN_FORCED_POWER of what the battery would do unforced from there are left unforced. Where it leaves the
+        battery idle the slot is forced to charge at MIN_FORCED_POWER, so that it becomes an ordinary charge
+        window. All others are forced to the planned power.
+        """
+        dt = self.flows["dt_hours"].to_numpy()
+        load = (self.static_flows[self.consumption_id] - self.static_flows[self.solar_id]).to_numpy(dtype=float)
+        solar = self.static_flows[self.solar_id].to_numpy(dtype=float)
+        consumption = self.static_flows[self.consumption_id].to_numpy(dtype=float)
+
+        def step(t, chg, forced=0):
+            return simulate_flows(
+                solar=solar[t : t + 1],
+                consumption=consumption[t : t + 1],
+                forced=[forced],
+                dt_hours=dt[t : t + 1],
+                initial_chg=chg,
+                capacity=self.battery.capacity,
+                max_dod=self.battery.max_dod,
+                inverter_efficiency=self.inverter.inverter_efficiency,
+                charger_efficiency=self.inverter.charger_efficiency,
+            )
+
+        slots = []
+        chg = self.initial_soc / 100 * self.battery.capacity
+        for t, b in enumerate(battery):
+            sim = step(t, chg)
+            if abs(b - sim["battery"][0]) >= MIN_FORCED_POWER:
+                forced = MIN_FORCED_POWER if abs(b) < MIN_FORCED_POWER else round(-b, 0)
+                slots.append((self.static_flows.index[t], forced))
+                sim = step(t, chg, forced=forced)
+            chg = sim["chg_end"][0]
+        return slots
+
+    def _accept_plan(self, slots, engine: str, log=True) -> bool:
+        """Simulates slots and keeps them as the optimised plan if they beat the base cost by pass_threshold_p."""
+        self.calculate_flows(slots=slots)
+        net_cost = self.net_cost
+        if log:
+            self.log(f"{engine} net cost: {net_cost:6.1f}p with {len(slots)} forced slots")
+
+        if self.base_cost - net_cost <= self.host.get_config("pass_threshold_p"):
+            if log:
+                self.log(
+                    f"Charge net cost delta:  {self.base_cost - net_cost:0.1f}p: < Pass Threshold ({self.host.get_config('pass_threshold_p'):0.1f}p) => Slots Excluded"
+                )
+            slots = []
+            net_cost = self.base_cost
+            self.calculate_flows()
+
+        self.slots = slots
+        self.best_cost = net_cost
+        return True
+
+    def _optimise_lp(self, log=True, discharge=False) -> bool:
+        """Solves the whole horizon as a mixed-integer linear programme with HiGHS (scipy.optimize.milp).
+
+        For each slot the variables are the AC charge and discharge power, grid import and export power and the
+        battery charge at the end of the slot. The grid balances the load, the charge follows the efficiencies
+        in calculate_flows and is kept between max_dod and capacity, and the cost uses the optimiser prices plus
+        LP_GRID_PENALTY on all grid flows so that the unforced flow is preferred where it costs the same.
+        Without discharge the battery can only discharge to meet the load. Binaries per slot keep the grid and
+        the battery flowing one way and only let the battery idle where it would unforced, so the optimum is the
+        cheapest plan calculate_flows can give. Returns False if the LP can't be used so that the heuristic runs
+        instead.
+        """
+        if milp is None:
+            self.log(
+                "scipy is not installed so the LP optimiser is unavailable. Using the heuristic instead.",
+                level="WARNING",
+            )
+            return False
+
+        if log:
+            self.log("")
+            self.log("Linear Programme")
+            self.log("----------------")
+
+        n = len(self.static_flows)
+        dt = self.flows["dt_hours"].to_numpy()
+        load = (self.static_flows[self.consumption_id] - self.static_flows[self.solar_id]).to_numpy(dtype=float)
+        import_price = np.nan_to_num(self.flows["import"].to_numpy(dtype=float))
+        export_price = np.nan_to_num(self.flows["export"].to_numpy(dtype=float))
+
+        capacity = self.battery.capacity
+        initial_chg = self.initial_soc / 100 * capacity
+        min_chg = self.battery.max_dod * capacity
+        max_charge = min(self.inverter.charger_power, self.battery.max_charge_power)
+        max_discharge = min(self.inverter.inverter_power, self.battery.max_discharge_power)
+
+        # As in simulate_flows, a battery that starts below max_dod is charged up to it in the first slot
+        charge_limit = np.full(n, float(max_charge))
+        charge_limit[0] += max(min_chg - initial_chg, 0) / (self.inverter.charger_efficiency * dt[0])
+
+        # Unforced, the battery meets the whole load in simulate_flows, even above the inverter's power
+        if discharge:
+            discharge_limit = np.maximum(load, max_discharge)
+        else:
+            discharge_limit = load.clip(0)
+        import_limit = load.clip(0) + charge_limit
+        export_limit = (-load).clip(0) + discharge_limit
+
+        # Variable blocks: charge, discharge, import, export and chg_end and the binaries importing, charging and
+        # idle. Each constraint row is built from the blocks it uses.
+        blocks = ["charge", "discharge", "import", "export", "chg_end", "importing", "charging", "idle"]
+
+        def row(**terms):
+            zero = sparse.csr_matrix((n, n))
+            return sparse.hstack([terms.get(block, zero) for block in blocks])
+
+        def diag(x):
+            return sparse.diags(np.broadcast_to(np.asarray(x, dtype=float), (n,)))
+
+        c = np.concatenate(
+            [
+                np.zeros(2 * n),
+                (import_price + LP_GRID_PENALTY) * dt / 1000,
+                -(export_price - LP_GRID_PENALTY) * dt / 1000,
+                np.zeros(4 * n),
+            ]
+        )
+
+        b_charge = np.zeros(n)
+        b_charge[0] = initial_chg
+        equal = sparse.vstack(
+            [
+                row(charge=diag(-1), discharge=diag(1), **{"import": diag(1)}, export=diag(-1)),
+                row(
+                    charge=diag(-self.inverter.charger_efficiency * dt),
+                    discharge=diag(dt / self.inverter.inverter_efficiency),
+                    chg_end=sparse.identity(n) - sparse.eye(n, k=-1),
+                ),
+            ],
+            format="csr",
+        )
+
+        # As in calculate_flows the grid only flows one way in each slot and the battery is either charged or
+        # discharged: import <= import_limit * importing, export <= export_limit * (1 - importing) and the same
+        # for charge and discharge with charging.
+        #
+        # The battery can only be left idle where it would be idle unforced, at capacity with surplus solar or at
+        # max_dod with a load. Anywhere else _slots_from_battery has to force a MIN_FORCED_POWER charge, so the
+        # plan has to charge or discharge at least that: charge + discharge >= MIN_FORCED_POWER * (1 - idle).
+        surplus = load < 0
+        demand = load > 0
+        upper = sparse.vstack(
+            [
+                row(**{"import": diag(1)}, importing=diag(-import_limit)),
+                row(export=diag(1), importing=diag(export_limit)),
+                row(charge=diag(1), charging=diag(-charge_limit)),
+                row(discharge=diag(1), charging=diag(discharge_limit)),
+                row(charge=diag(-1), discharge=diag(-1), idle=diag(-MIN_FORCED_POWER)),
+                row(chg_end=diag(-1.0 * surplus), idle=diag(capacity * surplus)),
+                row(chg_end=diag(1.0 * demand), idle=diag((capacity - min_chg) * demand)),
+            ],
+            format="csr",
+        )
+        b_upper = np.concatenate(
+            [
+                np.zeros(n),
+                export_limit,
+                np.zeros(n),
+                discharge_limit,
+                np.full(n, -MIN_FORCED_POWER),
+                np.zeros(n),
+                np.where(demand, capacity, np.inf),
+            ]
+        )
+
+        constraints = [
+            LinearConstraint(equal, np.concatenate([load, b_charge]), np.concatenate([load, b_charge])),
+            LinearConstraint(upper, -np.inf, b_upper),
+        ]
+        bounds = Bounds(
+            np.concatenate([np.zeros(4 * n), np.full(n, min_chg), np.zeros(3 * n)]),
+            np.concatenate(
+                [charge_limit, discharge_limit, import_limit, export_limit, np.full(n, capacity), np.ones(3 * n)]
+            ),
+        )
+        integrality = np.concatenate([np.zeros(5 * n), np.ones(3 * n)])
+
+        options = {"disp": False}
+        if self.deadline is not None:
+            options["time_limit"] = max(self.deadline - time.time(), 0)
+        result = milp(c, constraints=constraints, bounds=bounds, integrality=integrality, options=options)
+
+        if (result.status == 1) and (result.x is not None) and self._out_of_time():
+            self.log("LP optimiser ran out of time. Using the best plan found so far.", level="WARNING")
+        elif result.status != 0:
+            self.log(f"LP optimiser failed: {result.message}. Using the heuristic instead.", level="WARNING")
+            return False
+
+        battery = result.x[n : 2 * n] - result.x[:n]
+        return self._accept_plan(self._slots_from_battery(battery), "LP", log=log)
+
+    def _optimise_dp(self, log=True, discharge=False, states=DP_SOC_STATES) -> bool:
+        """Finds the cheapest plan by backward induction over a grid of battery charge states.
+
+        The grid runs from max_dod to maximum_soc. In each slot the battery can either be left to meet the load
+        as it would be unforced (landing between grid points, valued by interpolation) or forced to any grid
+        point within the charger and inverter limits. Moves of less than MIN_FORCED_POWER are forced to charge at
+        MIN_FORCED_POWER. Forced slots carry a slot_threshold_p penalty so that a slot is only forced if it saves
+        at least that much, as in the heuristic. Each slot is a single array operation over all the states. The
+        plan is then found forwards from the actual initial charge.
+        """
+        if log:
+            self.log("")
+            self.log("Dynamic Programme")
+            self.log("-----------------")
+
+        n = len(self.static_flows)
+        dt = self.flows["dt_hours"].to_numpy()
+        load = (self.static_flows[self.consumption_id] - self.static_flows[self.solar_id]).to_numpy(dtype=float)
+        import_price = np.nan_to_num(self.flows["import"].to_numpy(dtype=float))
+        export_price = np.nan_to_num(self.flows["export"].to_numpy(dtype=float))
+        penalty = self.host.get_config("slot_threshold_p")
+
+        capacity = self.battery.capacity
+        ie = self.inverter.inverter_efficiency
+        ce = self.inverter.charger_efficiency
+        min_chg = self.battery.max_dod * capacity
+        max_chg = max(self.host.get_config("maximum_soc", 100) / 100 * capacity, min_chg)
+        max_charge = min(self.inverter.charger_power, self.battery.max_charge_power)
+        max_discharge = min(self.inverter.inverter_power, self.battery.max_discharge_power)
+        grid = np.linspace(min_chg, max_chg, states)
+        step = grid[1] - grid[0]
+
+        def cost(t, power):
+            # power is the AC battery power, positive when discharging
+            g = load[t] - power
+            return (import_price[t] * g.clip(0) + export_price[t] * g.clip(max=0)) * dt[t] / 1000
+
+        def natural(t, chg):
+            # As simulate_flows, the battery meets the load until it is empty or full
+            flow = load[t] / ie if load[t] > 0 else load[t] * ce
+            chg_end = np.clip(chg - flow * dt[t], min_chg, capacity)
+            power = chg - chg_end
+            power = np.where(power > 0, power * ie, power / ce) / dt[t]
+            return chg_end, cost(t, power)
+
+        def forced(t):
+            # Moves of k grid points, their AC battery power and cost. The same for every starting state.
+            kc = int(max_charge * ce * dt[t] // step)
+            if discharge:
+                kd = int(max_discharge / ie * dt[t] // step)
+            else:
+                kd = int(max(min(load[t], max_discharge), 0) / ie * dt[t] // step)
+            k = np.arange(-kd, kc + 1)
+            energy = k * step
+            power = np.where(energy > 0, -energy / ce, -energy * ie) / dt[t]
+            return k, power, cost(t, power)
+
+        # Backward pass: value[t] is the cheapest cost from the start of slot t at each grid charge
+        value = np.zeros((n + 1, states))
+        positions = np.arange(states)
+        for t in range(n - 1, -1, -1):
+            chg_end, c = natural(t, grid)
+            best = c + np.interp(chg_end, grid, value[t + 1])
+
+            k, power, c = forced(t)
+            targets = positions[:, None] + k[None, :]
+            valid = (targets >= 0) & (targets < states)
+            q = np.where(valid, c[None, :] + value[t + 1][targets.clip(0, states - 1)] + penalty, np.inf)
+            value[t] = np.minimum(best, q.min(axis=1))
+
+        # Forward pass from the actual charge, choosing between the natural move and each forced move
+        slots = []
+        chg = self.initial_soc / 100 * capacity
+        for t in range(n):
+            chg_end, c = natural(t, np.array([chg]))
+            best = c[0] + np.interp(chg_end[0], grid, value[t + 1])
+            choice = None
+
+            k, power, c = forced(t)
+            start = np.interp(chg, grid, positions)
+            targets = np.round(start + k).astype(int)
+            ok = (targets >= 0) & (targets < states)
+            if ok.any():
+                energy = grid[targets[ok]] - chg
+                power = np.where(energy > 0, -energy / ce, -energy * ie) / dt[t]
+                ok_power = (power >= -max_charge) & (power <= (max_discharge if discharge else max(load[t], 0)))
+                if ok_power.any():
+                    q = cost(t, power) + value[t + 1][targets[ok]] + penalty
+                    q[~ok_power] = np.inf
+                    i = np.argmin(q)
+                    if q[i] < best:
+                        choice = (power[i], grid[targets[ok]][i])
+
+            if choice is None:
+                chg = chg_end[0]
+            else:
+                power, chg = choice
+                forced_power = round(-power, 0)
+                if abs(forced_power) < MIN_FORCED_POWER:
+                    forced_power = MIN_FORCED_POWER
+                slots.append((self.static_flows.index[t], forced_power))
+
+        return self._accept_plan(slots, "DP", log=log)
+
+    def _search_window(self, arrays: dict, available: np.ndarray, full_count: np.ndarray, max_slot: int) -> np.ndarray:
+        """Returns the positions of the slots before max_slot that can still take charge.
+
+        Only slots from the last available slot that ends full (>= 97%) onwards are included. This is found from
+        full_count, the running count of available full slots, rather than a cumsum over a copy of the window.
+        """
+        index = self.flows.index
+        k = index.searchsorted(index[max_slot] - pd.Timedelta("30min"), side="right")
+        if k == 0:
+            return np.arange(0)
+
+        total = full_count[k - 1]
+        first = np.searchsorted(full_count[:k], total, side="left") if total > 0 else 0
+        x = np.arange(first, k)
+        x = x[available[x]]
+        x = x[arrays["forced"][x] < (self.inverter.charger_power)]
+        return x[arrays["soc_end"][x] <= 97]
+
+    def _flow_arrays(self) -> dict:
+        arrays = {col: self.flows[col].to_numpy() for col in ["forced", "grid", "soc", "soc_end", "solar"]}
+        arrays["import_cost"] = (
+            (self.flows["import"].to_numpy() * arrays["grid"]).clip(0) * self.flows["dt_hours"].to_numpy() / 1000
+        )
+        return arrays
+
+    @staticmethod
+    def _push_costs(heap: list, arrays: dict, positions):
+        # Only unforced slots are candidates for the most expensive slot. NaN costs can never be the max.
+        for i in positions:
+            cost = arrays["import_cost"][i]
+            if arrays["forced"][i] == 0 and not isnan(cost):
+                heapq.heappush(heap, (-cost, i))
+
+    @staticmethod
+    def _peek_max_cost(heap: list, arrays: dict, tested: np.ndarray):
+        # Entries are left in the heap when a slot changes and are discarded here once they are stale
+        while len(heap) > 0:
+            cost, i = heap[0]
+            if (not tested[i]) and arrays["forced"][i] == 0 and arrays["import_cost"][i] == -cost:
+                return -cost, i
+            heapq.heappop(heap)
+        return None, None
 
     def _high_cost_swaps(self, log=True):
         # --------------------------------------------------------------------------------------------
@@ -970,67 +2635,81 @@ class PVsystemModel:
         done = False
         i = 0
         slots = []
-        available = pd.Series(index=self.flows.index, data=(self.flows["forced"] == 0))
-        tested = pd.Series(index=self.flows.index, data=False)
+        index = self.flows.index
+        dt_hours = self.flows["dt_hours"].to_numpy()
+        import_price = self.flows["import"].to_numpy()
+
+        arrays = self._flow_arrays()
+        available = arrays["forced"] == 0
+        tested = np.zeros(len(index), dtype=bool)
         slot_count = [0]
         best_cost = self.base_cost
 
+        # Max-heap of (-import cost, position) so the earliest of the most expensive slots is at the top
+        heap = []
+        self._push_costs(heap, arrays, range(len(index)))
+        full_count = np.cumsum(available & (arrays["soc_end"] >= 97))
+
         while not done:
+            if self._out_of_time():
+                break
+
             i += 1
 
             if (i > 96) or (available.sum() == 0):
                 done = True
 
-            import_cost = ((self.flows["import"] * self.flows["grid"]).clip(0) * self.flows["dt_hours"] / 1000)[
-                ~tested
-            ]
+            if (~tested & (arrays["forced"] == 0)).any():
+                max_import_cost, max_slot = self._peek_max_cost(heap, arrays, tested)
+                if max_slot is not None:
+                    # A forced slot that hasn't been tested wins a tie if it is earlier
+                    forced_ties = np.flatnonzero(
+                        (arrays["forced"][:max_slot] != 0)
+                        & ~tested[:max_slot]
+                        & (arrays["import_cost"][:max_slot] == max_import_cost)
+                    )
+                    if len(forced_ties) > 0:
+                        max_slot = forced_ties[0]
 
-            if len(import_cost[self.flows["forced"] == 0]) > 0:
-                max_import_cost = import_cost[self.flows["forced"] == 0].max()
-                if len(import_cost[import_cost == max_import_cost]) > 0:
-                    max_slot = import_cost[import_cost == max_import_cost].index[0]
-                    max_slot_energy = round(
-                        self.flows["grid"].loc[max_slot] / 1000 * self.flows["dt_hours"].loc[max_slot], 2
-                    )  # kWh
-                    str_log = f"{i:3d} {available.sum():3d} {max_slot.tz_convert(self.tz).strftime(TIME_FORMAT)}:"
+                    max_slot_energy = round(arrays["grid"][max_slot] / 1000 * dt_hours[max_slot], 2)  # kWh
+                    decision = {"step": i, "available": available.sum(), "slot": max_slot, "price": max_import_cost}
 
                     if max_slot_energy > 0:
                         round_trip_energy_required = (
                             max_slot_energy / self.inverter.charger_efficiency / self.inverter.inverter_efficiency
                         )
 
-                        search_window = self._search_window(self.flows, available, max_slot)
-                        str_log += f" {round_trip_energy_required:5.2f} kWh at {max_import_cost:6.2f}p. "
+                        search_window = self._search_window(arrays, available, full_count, max_slot)
+                        decision["energy"] = round_trip_energy_required
 
                         if len(search_window) > 0:
-                            min_price = search_window["import"].min()
+                            min_price = np.nanmin(import_price[search_window])
 
-                            window = search_window[search_window["import"] == min_price].index
-                            start_window = window[0]
-                            end_window = window[-1]
+                            window = search_window[import_price[search_window] == min_price]
 
                             cost_at_min_price = round_trip_energy_required * min_price
 
-                            str_log += f"<==> {start_window.tz_convert(self.tz).strftime(TIME_FORMAT)}: {min_price:5.2f}p/kWh {cost_at_min_price:5.2f}p "
-                            str_log += f" SOC: {search_window.loc[window[0]]['soc']:5.1f}%->{search_window.loc[window[-1]]['soc_end']:5.1f}% "
+                            decision |= {
+                                "window": window[0],
+                                "window_price": min_price,
+                                "window_cost": cost_at_min_price,
+                                "soc": arrays["soc"][window[0]],
+                                "soc_end": arrays["soc_end"][window[-1]],
+                            }
 
-                            slot_power_required = (
-                                round_trip_energy_required * 1000 / search_window["dt_hours"].loc[window].sum()
-                            )
+                            slot_power_required = round_trip_energy_required * 1000 / dt_hours[window].sum()
 
                             if round(cost_at_min_price, 1) < round(max_import_cost, 1):
                                 slots_added = 0
                                 j = 1
                                 for slot in window:
                                     slot_charger_power_available = max(
-                                        self.inverter.charger_power
-                                        - search_window["forced"].loc[slot]
-                                        - search_window["solar"].loc[slot],
+                                        self.inverter.charger_power - arrays["forced"][slot] - arrays["solar"][slot],
                                         0,
                                     )
                                     slot_available_capacity = max(
-                                        ((100 - search_window["soc_end"].loc[slot]) / 100 * self.battery.capacity)
-                                        / search_window["dt_hours"].loc[slot],
+                                        ((100 - arrays["soc_end"][slot]) / 100 * self.battery.capacity)
+                                        / dt_hours[slot],
                                         0,
                                     )
                                     min_power = min(
@@ -1047,8 +2726,8 @@ class PVsystemModel:
                                         # if log:
                                         str_log_x = (
                                             # f">>> {i:3d} Slot: {slot.strftime(TIME_FORMAT)} Factor: {factor:0.3f} Forced: {search_window['forced'].loc[slot]:6.0f}W  "
-                                            f">>> {i:3d} Slot: {slot.strftime(TIME_FORMAT)} Forced: {search_window['forced'].loc[slot]:6.0f}W  "
-                                            + f"End SOC: {search_window['soc_end'].loc[slot]:4.1f}%  SPR: {slot_power_required:6.0f}W  "
+                                            f">>> {i:3d} Slot: {index[slot].strftime(TIME_FORMAT)} Forced: {arrays['forced'][slot]:6.0f}W  "
+                                            + f"End SOC: {arrays['soc_end'][slot]:4.1f}%  SPR: {slot_power_required:6.0f}W  "
                                             + f"SCPA: {slot_charger_power_available:6.0f}W  SAC: {slot_available_capacity:6.0f}W  Min Power: {min_power:6.0f}W "
                                             + f"RSC: {remaining_slot_capacity:6.0f}W"
                                         )
@@ -1058,39 +2737,52 @@ class PVsystemModel:
 
                                     slots.append(
                                         (
-                                            slot,
+                                            index[slot],
                                             round(min_power, 0),
                                         )
                                     )
                                     slots_added += 1
 
-                                self.calculate_flows(slots=slots)
+                                self.calculate_flows(slots=slots, resume=True)
                                 self.net_costs.append(self.net_cost)
 
+                                # Only the slots whose cost or forced power has changed need to go back on the heap
+                                new_arrays = self._flow_arrays()
+                                changed = np.flatnonzero(
+                                    (new_arrays["import_cost"] != arrays["import_cost"])
+                                    | (new_arrays["forced"] != arrays["forced"])
+                                )
+                                arrays = new_arrays
+                                self._push_costs(heap, arrays, changed)
+                                full_count = np.cumsum(available & (arrays["soc_end"] >= 97))
+
                                 slot_count.append(len(window))
 
-                                str_log += f"New SOC: {self.flows.loc[start_window]['soc']:5.1f}%->{self.flows.loc[end_window]['soc_end']:5.1f}% "
                                 best_cost = self.net_costs[-1]
-                                str_log += f"Net: {best_cost:6.1f}"
-
-                                if log:
-                                    self.log(str_log)
-
+                                row = self.trace.record(
+                                    "high_cost_swaps",
+                                    "accepted",
+                                    new_soc=arrays["soc"][window[0]],
+                                    new_soc_end=arrays["soc_end"][window[-1]],
+                                    net_cost=best_cost,
+                                    **decision,
+                                )
                             else:
-                                if log:
-                                    self.log(str_log + "No cheaper slots")
-                                tested.loc[max_slot] = True
+                                row = self.trace.record("high_cost_swaps", "no_cheaper_slots", **decision)
+                                tested[max_slot] = True
                         else:
-                            if log:
-                                self.log(str_log + "No search window")
-                            tested.loc[max_slot] = True
+                            row = self.trace.record("high_cost_swaps", "no_search_window", **decision)
+                            tested[max_slot] = True
+
+                        if log:
+                            self.log(self.trace.render_row(row))
                 else:
                     done = True
             else:
                 self.log("No slots available")
                 done = True
 
-        self.calculate_flows(slots=slots)
+        self.calculate_flows(slots=slots, resume=True)
         self.best_cost = self.net_cost
 
         if self.base_cost - best_cost <= self.host.get_config("pass_threshold_p"):
@@ -1104,10 +2796,170 @@ class PVsystemModel:
 
         self.slots = slots
 
+    def _min_cost_flow_swaps(self, log=True):
+        """Replaces the high cost usage swaps with a single min-cost-flow pass.
+
+        The plan is a flow network over the slots: source arcs into each slot for charging it (at its import price
+        over the charger efficiency per kWh stored) or for keeping what it would discharge unforced (at its import
+        price), a storage arc from each slot to the next limited by the headroom above the unforced SOC at its
+        end, and a sink arc out of each slot with grid import worth its import price per kWh discharged. The flow
+        is built by successive shortest paths, each found with a heap based Dijkstra search on reduced costs,
+        until the cheapest path no longer saves anything. As simulate_flows discharges the battery into the
+        first import it reaches, a slot that the flow passes without feeding, or that only keeps its energy, is
+        forced to charge at MIN_FORCED_POWER. The result is accepted using the same pass_threshold_p rule as
+        _high_cost_swaps.
+        """
+        if log:
+            self.log("")
+            self.log("Min Cost Flow Swaps")
+            self.log("-------------------")
+            self.log("")
+
+        index = self.flows.index
+        dt_hours = self.flows["dt_hours"].to_numpy()
+        import_price = self.flows["import"].to_numpy(dtype=float)
+        arrays = self._flow_arrays()
+        ie = self.inverter.inverter_efficiency
+        ce = self.inverter.charger_efficiency
+        n = len(index)
+
+        # Flows are kWh stored in the battery. Forcing a charge at a slot replaces what the battery would do there
+        # unforced: where it would charge from solar the forced power has to cover that first and where it would
+        # discharge that energy is kept in the battery and the load is imported instead
+        battery = self.flows["battery"].to_numpy(dtype=float) * (arrays["forced"] == 0)
+        natural = (-battery).clip(0)
+        supply = (self.inverter.charger_power - natural).clip(0) * dt_hours / 1000 * (arrays["forced"] == 0)
+        kept = battery.clip(0) * dt_hours / 1000 / ie
+        demand = arrays["grid"].clip(0) * dt_hours / 1000
+        headroom = (100 - arrays["soc_end"]).clip(0) / 100 * self.battery.capacity / 1000
+
+        # Nodes 0..n-1 are the slots, n is the source and n + 1 the sink. Arcs are stored in pairs so that
+        # arc ^ 1 is the residual arc of arc
+        source, sink = n, n + 1
+        head, cap, cost = [], [], []
+        out = [[] for _ in range(n + 2)]
+
+        def add_arc(u, v, capacity, unit_cost):
+            for a, b, c, w in ((u, v, capacity, unit_cost), (v, u, 0.0, -unit_cost)):
+                out[a].append(len(head))
+                head.append(b)
+                cap.append(c)
+                cost.append(w)
+
+        valid = ~np.isnan(import_price)
+        kept_arc = np.full(n, -1)
+        source_arc = np.full(n, -1)
+        sink_arc = np.full(n, -1)
+        storage_arc = np.full(n, -1)
+        for i in range(n):
+            # Keeping energy in the battery costs its import price once, charging it costs the round trip
+            if valid[i] and kept[i] > 1e-6:
+                kept_arc[i] = len(head)
+                add_arc(source, i, kept[i], import_price[i] * ie)
+            if valid[i] and supply[i] > 1e-6:
+                source_arc[i] = len(head)
+                add_arc(source, i, supply[i] * ce, import_price[i] / ce)
+            if valid[i] and demand[i] > 1e-6:
+                sink_arc[i] = len(head)
+                add_arc(i, sink, demand[i] / ie, -import_price[i] * ie)
+            if i < n - 1:
+                storage_arc[i] = len(head)
+                add_arc(i, i + 1, headroom[i], 0.0)
+
+        # The network is acyclic in slot order so the initial potentials are the shortest paths from a virtual
+        # root joined to every node, which keeps every reduced cost non-negative
+        potential = [0.0] * (n + 2)
+        for v in list(range(n)) + [sink]:
+            incoming = [potential[head[a]] + cost[a ^ 1] for a in out[v] if cap[a ^ 1] > 0]
+            potential[v] = min([0.0] + incoming)
+
+        while not self._out_of_time():
+            dist = [np.inf] * (n + 2)
+            prev = [-1] * (n + 2)
+            dist[source] = 0.0
+            heap = [(0.0, source)]
+            while heap:
+                d, u = heapq.heappop(heap)
+                if d > dist[u]:
+                    continue
+                for a in out[u]:
+                    if cap[a] <= 1e-9:
+                        continue
+                    v = head[a]
+                    nd = d + cost[a] + potential[u] - potential[v]
+                    if nd < dist[v] - 1e-12:
+                        dist[v] = nd
+                        prev[v] = a
+                        heapq.heappush(heap, (nd, v))
+
+            if np.isinf(dist[sink]):
+                break
+
+            reached = max(d for d in dist if not np.isinf(d))
+            potential = [p + (d if not np.isinf(d) else reached) for p, d in zip(potential, dist)]
+            if potential[sink] - potential[source] >= -1e-9:
+                break
+
+            path = []
+            v = sink
+            while v != source:
+                path.append(prev[v])
+                v = head[prev[v] ^ 1]
+            q = min(cap[a] for a in path)
+            for a in path:
+                cap[a] -= q
+                cap[a ^ 1] += q
+
+        def flow(arcs):
+            return np.array([cap[a ^ 1] if a >= 0 else 0.0 for a in arcs])
+
+        charge = flow(source_arc) / ce
+        fed = flow(sink_arc)
+        stored = flow(storage_arc)
+        planned = np.where(charge * 1000 / dt_hours >= 1, charge * 1000 / dt_hours + natural, 0)
+        # A slot that only keeps its energy, or that the flow passes without feeding, is held with a small charge
+        passed = np.zeros(n, dtype=bool)
+        passed[1:] = (stored[:-1] > 1e-6) & (stored[1:] > 1e-6) & (demand[1:] > 1e-6) & (fed[1:] <= 1e-6)
+        held = ((flow(kept_arc) > 1e-6) | passed) & (arrays["forced"] == 0)
+        planned = np.where(held, planned.clip(MIN_FORCED_POWER), planned)
+
+        slots = [(index[i], round(planned[i], 0)) for i in np.flatnonzero(planned > 0)]
+
+        if log and (self.host.debug and "C" in self.host.debug_cat):
+            for slot, power in slots:
+                self.log(f">>> Slot: {slot.strftime(TIME_FORMAT)} Forced: {power:6.0f}W")
+
+        self.calculate_flows(slots=slots, resume=True)
+        self.net_costs.append(self.net_cost)
+        best_cost = self.net_cost
+        self.best_cost = best_cost
+
+        if log:
+            self.log(f"{len(slots):3d} slots forced. Net: {best_cost:6.1f}")
+
+        if self.base_cost - best_cost <= self.host.get_config("pass_threshold_p"):
+            if log:
+                self.log(
+                    f"Charge net cost delta:  {self.base_cost - best_cost:0.1f}p: < Pass Threshold ({self.host.get_config('pass_threshold_p'):0.1f}p) => Slots Excluded"
+                )
+            slots = []
+            self.best_cost = self.base_cost
+            self.calculate_flows()
+
+        self.slots = slots
+
+    @staticmethod
+    def _candidate_queue(prices: np.ndarray, available: np.ndarray, descending=False):
+        """Sorts the available slots by price once so that each phase can take them in order."""
+        positions = np.flatnonzero(available)
+        keys = -prices[positions] if descending else prices[positions]
+        return SlotQueue(positions[np.argsort(keys, kind="stable")], available)
+
     def _low_cost_charging(self, log=True):
         slots = [slot for slot in self.slots]
         best_cost = self.best_cost
         slots_added = 0
+        self._save_checkpoint()
 
         # Check how many slots which aren't full are at an import price less than any export price:
         max_export_price = self.flows[self.flows["forced"] <= 0]["export"].max()
@@ -1127,7 +2979,9 @@ class PVsystemModel:
             (self.flows["import"] < max_export_price)
             & (self.flows["forced"] < self.inverter.charger_power)
             & (self.flows["forced"] >= 0)
-        )
+        ).to_numpy()
+        # Slots are tried cheapest first (to 0.01p, earliest first on ties)
+        queue = self._candidate_queue(self.flows["import"].round(2).to_numpy(), available)
 
         a0 = available.sum()
         if log:
@@ -1142,96 +2996,93 @@ class PVsystemModel:
             self.log("")
 
         while not done:
-            x = (
-                self.flows.loc[available]
-                .loc[self.flows["import"] < max_export_price]
-                .loc[self.flows["forced"] < self.inverter.charger_power]
-                .loc[self.flows["forced"] >= 0]
-                .copy()
-            )
-            i += 1
-            done = i > a0
-
-            min_price = x["import"].min()
-
-            # Add rounding to ensure matching (may not be needed)
-            x["import"] = x["import"].round(2)
-            min_price = min_price.round(2)
+            if self._out_of_time():
+                break
 
-            if len(x[x["import"] == min_price]) > 0:
-                start_window = x[x["import"] == min_price].index[0]
-                available.loc[start_window] = False
-                str_log = ""
-                str_log = f"{available.sum():>2d} Min import price {min_price:5.2f}p/kWh at {start_window.strftime(TIME_FORMAT)} {x.loc[start_window]['forced']:4.0f}W "
+            forced = self.flows["forced"].to_numpy()
 
-                str_log += "  "
-
-                str_log += f"SOC: {x.loc[start_window]['soc']:5.1f}%->{x.loc[start_window]['soc_end']:5.1f}% "
-
-                if self.host.debug and "C" in self.host.debug_cat:
-                    self.log(
-                        f"SOC (before modelling Forced Charge): {x.loc[start_window]['soc']:5.1f}%->{x.loc[start_window]['soc_end']:5.1f}% "
-                    )
+            def eligible(j):
+                return (forced[j] < self.inverter.charger_power) and (forced[j] >= 0)
 
+            # The next slots in the queue are costed together. They are then taken in turn as before, until one is
+            # accepted: the slots after it are costed again against the new plan.
+            candidates = []
+            for k in queue.peek(CANDIDATE_BATCH, eligible):
+                x = {col: self.flows[col].to_numpy()[k] for col in ["forced", "solar", "soc_end", "dt_hours"]}
                 forced_charge = min(
-                    min(self.battery.max_charge_power, self.inverter.charger_power)- x["forced"].loc[start_window] - x["solar"].loc[start_window],
-                    ((100 - x["soc_end"].loc[start_window]) / 100 * self.battery.capacity) / x["dt_hours"].loc[start_window],
+                    min(self.battery.max_charge_power, self.inverter.charger_power) - x["forced"] - x["solar"],
+                    ((100 - x["soc_end"]) / 100 * self.battery.capacity) / x["dt_hours"],
                 )
+                candidates.append((k, forced_charge))
+            costs = self._candidate_costs(candidates) if len(candidates) > 0 else []
+
+            for (k, forced_charge), net_cost in zip(candidates, costs):
+                queue.next(eligible)
+                i += 1
+                start_window = self.flows.index[k]
+                x = {
+                    col: self.flows[col].to_numpy()[k]
+                    for col in ["import", "forced", "solar", "soc", "soc_end", "dt_hours"]
+                }
+                min_price = round(x["import"], 2)
+                available[k] = False
+                decision = {
+                    "available": available.sum(),
+                    "slot": k,
+                    "price": min_price,
+                    "power": x["forced"],
+                    "soc": x["soc"],
+                    "soc_end": x["soc_end"],
+                }
 
                 if self.host.debug and "C" in self.host.debug_cat:
-                    value1 = min(self.battery.max_charge_power, self.inverter.charger_power)- x["forced"].loc[start_window] - x["solar"].loc[start_window]
-                    value2 = ((100 - x["soc_end"].loc[start_window]) / 100 * self.battery.capacity) 
-                    value3 = x["dt_hours"].loc[start_window]
-                    value4 = ((100 - x["soc_end"].loc[start_window]) / 100 * self.battery.capacity) / x["dt_hours"].loc[start_window]
+                    self.log(f"SOC (before modelling Forced Charge): {x['soc']:5.1f}%->{x['soc_end']:5.1f}% ")
+                    value1 = min(self.battery.max_charge_power, self.inverter.charger_power) - x["forced"] - x["solar"]
+                    value2 = (100 - x["soc_end"]) / 100 * self.battery.capacity
+                    value3 = x["dt_hours"]
+                    value4 = ((100 - x["soc_end"]) / 100 * self.battery.capacity) / x["dt_hours"]
                     self.log(f"Start window = {start_window}")
-                    self.log(f"Value 1 = {value1:6.1f}, Value2 = {value2:6.1f}, Value3 = {value3:6.1f}, Value4 = {value4:6.1f}")
+                    self.log(
+                        f"Value 1 = {value1:6.1f}, Value2 = {value2:6.1f}, Value3 = {value3:6.1f}, Value4 = {value4:6.1f}"
+                    )
                     self.log(f"Forced Charge = {forced_charge}")
-                slot = (
-                    start_window,
-                    forced_charge,
-                )
-
-                slots.append(slot)
-
-                self.calculate_flows(slots=slots)
-            
-
-                if self.host.debug and "F" in self.host.debug_cat:
-                    self.log("self.flows after flows called = ")
-                    self.log(f"\n{self.flows.to_string()}")
+                    self.log(f"Cost = {net_cost:5.1f}")
 
-                net_cost = self.net_cost
+                if net_cost < best_cost - self.host.get_config("slot_threshold_p"):
+                    slots.append((start_window, forced_charge))
+                    self.calculate_flows(slots=slots, resume=True)
+                    net_cost = self.net_cost
 
-                if self.host.debug and "C" in self.host.debug_cat:
-                    self.log(f"Cost = {net_cost:5.1f}")
-                    if net_cost < best_cost:
-                        self.log("Cost reduction found - printing flows")
+                    if self.host.debug and "F" in self.host.debug_cat:
+                        self.log("self.flows after flows called = ")
                         self.log(f"\n{self.flows.to_string()}")
 
-
-                str_log += f"Net: {net_cost:5.1f} "
-                if net_cost < best_cost - self.host.get_config("slot_threshold_p"):
-                    str_log += f"New SOC: {self.flows.loc[start_window]['soc']:5.1f}%->{self.flows.loc[start_window]['soc_end']:5.1f}% "
-                    str_log += f"Max export: {-self.flows['grid'].min():0.0f}W "
+                    row = self.trace.record(
+                        "low_cost_charging",
+                        "accepted",
+                        new_soc=self.flows["soc"].to_numpy()[k],
+                        new_soc_end=self.flows["soc_end"].to_numpy()[k],
+                        max_export=-self.flows["grid"].min(),
+                        net_cost=net_cost,
+                        **decision,
+                    )
                     best_cost = net_cost
                     slots_added += 1
+                    self._save_checkpoint()
                     if log:
-                        self.log(str_log)
+                        self.log(self.trace.render_row(row))
+                    break
                 else:
-                    # done = True
-                    slots = slots[:-1]
-                    self.calculate_flows(slots=slots)
+                    self.trace.record("low_cost_charging", "rejected", net_cost=net_cost, **decision)
 
-                done = available.sum() == 0
-            else:
-                done = True
+            done = len(candidates) == 0 or i > a0 or available.sum() == 0
 
         cost_delta = best_cost - self.best_cost
         str_log = f"Charge net cost delta:{(-cost_delta):5.1f}p"
         if cost_delta > -self.host.get_config("pass_threshold_p"):
             self.slots_added = 0
             str_log += f": < Pass Threshold {self.host.get_config('pass_threshold_p'):0.1f}p => Slots Excluded"
-            self.calculate_flows(slots=self.slots)
+            self.calculate_flows(slots=self.slots, resume=True)
         else:
             str_log += f": > Pass Threshold {self.host.get_config('pass_threshold_p'):0.1f}p => Slots Included"
             self.slots = slots
@@ -1249,6 +3100,7 @@ class PVsystemModel:
         slots = [slot for slot in self.slots]
         best_cost = self.best_cost
         slots_added = self.slots_added
+        self._save_checkpoint()
 
         # Check how many slots which aren't full are at an export price less than any import price:
         min_import_price = self.flows["import"].min()
@@ -1259,64 +3111,76 @@ class PVsystemModel:
             self.log("")
 
         i = 0
-        available = (self.flows["export"] > min_import_price) & (self.flows["forced"] == 0)
+        available = ((self.flows["export"] > min_import_price) & (self.flows["forced"] == 0)).to_numpy()
+        # Slots are tried highest export price first (earliest first on ties)
+        queue = self._candidate_queue(self.flows["export"].to_numpy(), available, descending=True)
         a0 = available.sum()
         if log:
             self.log(f"{available.sum()} slots have an export price greater than the min import price")
         done = available.sum() == 0
 
         while not done:
-            x = self.flows[available].copy()
-            i += 1
-            done = i > a0
-            max_price = x["export"].max()
-
-            if len(x[x["export"] == max_price]) > 0:
-                # self.log("Entered routine successfully")
-                start_window = x[x["export"] == max_price].index[0]
-                available.loc[start_window] = False
-                str_log = f"{available.sum():>2d} Max export price {max_price:5.2f}p/kWh at {start_window.strftime(TIME_FORMAT)} "
-                str_log += "  "
-
-                str_log += f"SOC: {x.loc[start_window]['soc']:5.1f}%->{x.loc[start_window]['soc_end']:5.1f}% "
-
-                slot = (
-                    start_window,
-                    -min(
-                        min(
-                            self.battery.max_discharge_power,
-                            self.inverter.charger_power,
-                        )
-                        - x["solar"].loc[start_window],
-                        ((x["soc_end"].loc[start_window] - self.battery.max_dod) / 100 * self.battery.capacity)
-                        / x["dt_hours"].loc[start_window],
-                    ),
+            if self._out_of_time():
+                break
+
+            # As in _low_cost_charging, the next slots are costed together and taken in turn until one is accepted
+            candidates = []
+            for k in queue.peek(CANDIDATE_BATCH):
+                x = {col: self.flows[col].to_numpy()[k] for col in ["solar", "soc_end", "dt_hours"]}
+                power = -min(
+                    min(
+                        self.battery.max_discharge_power,
+                        self.inverter.charger_power,
+                    )
+                    - x["solar"],
+                    ((x["soc_end"] - self.battery.max_dod) / 100 * self.battery.capacity) / x["dt_hours"],
                 )
+                candidates.append((k, power))
+            costs = self._candidate_costs(candidates) if len(candidates) > 0 else []
+
+            for (k, power), net_cost in zip(candidates, costs):
+                queue.next()
+                i += 1
+                start_window = self.flows.index[k]
+                x = {col: self.flows[col].to_numpy()[k] for col in ["export", "soc", "soc_end"]}
+                max_price = x["export"]
+                available[k] = False
+                decision = {
+                    "available": available.sum(),
+                    "slot": k,
+                    "price": max_price,
+                    "soc": x["soc"],
+                    "soc_end": x["soc_end"],
+                }
 
-                slots.append(slot)
-
-                self.calculate_flows(slots=slots)
-
-                if self.host.debug and "F" in self.host.debug_cat:
-                    self.log("self.flows after flows called = ")
-                    self.log(f"\n{self.flows.to_string()}")
+                if net_cost < best_cost - self.host.get_config("slot_threshold_p"):
+                    slots.append((start_window, power))
+                    self.calculate_flows(slots=slots, resume=True)
+                    net_cost = self.net_cost
 
-                net_cost = self.net_cost
+                    if self.host.debug and "F" in self.host.debug_cat:
+                        self.log("self.flows after flows called = ")
+                        self.log(f"\n{self.flows.to_string()}")
 
-                str_log += f"Net: {net_cost:5.1f} "
-                if net_cost < best_cost - self.host.get_config("slot_threshold_p"):
-                    str_log += f"New SOC: {self.flows.loc[start_window]['soc']:5.1f}%->{self.flows.loc[start_window]['soc_end']:5.1f}% "
-                    str_log += f"Max export: {-self.flows['grid'].min():0.0f}W "
+                    row = self.trace.record(
+                        "discharging",
+                        "accepted",
+                        new_soc=self.flows["soc"].to_numpy()[k],
+                        new_soc_end=self.flows["soc_end"].to_numpy()[k],
+                        max_export=-self.flows["grid"].min(),
+                        net_cost=net_cost,
+                        **decision,
+                    )
                     best_cost = net_cost
                     slots_added += 1
+                    self._save_checkpoint()
                     if log:
-                        self.log(str_log)
+                        self.log(self.trace.render_row(row))
+                    break
                 else:
-                    # done = True
-                    slots = slots[:-1]
-                    self.calculate_flows(slots=slots)
-            else:
-                done = True
+                    self.trace.record("discharging", "rejected", net_cost=net_cost, **decision)
+
+            done = len(candidates) == 0 or i > a0
 
         cost_delta = best_cost - self.best_cost
         str_log = f"Discharge net cost delta:{(-cost_delta):5.1f}p"
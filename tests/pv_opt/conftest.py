@@ -0,0 +1,28 @@
+class FakeHost:
+    """Stands in for the app as the host of a Tariff, Contract or PVsystemModel.
+
+    config is added to the optimiser settings that the tests use by default and is read back with get_config.
+    """
+
+    tz = "GB"
+    debug = False
+    debug_cat = ""
+
+    def __init__(self, **config):
+        self.io_prices = {}
+        self.saving_events = {}
+        self.config = {
+            "pass_threshold_p": 4.0,
+            "slot_threshold_p": 1.0,
+            "discharge_threshold_p": 5.0,
+            "allow_cyclic": False,
+            "octopus_auto": False,
+        } | config
+
+    def log(self, *args, **kwargs):
+        pass
+
+    rlog = log
+
+    def get_config(self, item, default=None):
+        return self.config.get(item, default)
@@ -0,0 +1,285 @@
+"""Runs PVOpt outside AppDaemon against a recorded Home Assistant snapshot.
+
+HeadlessPVOpt replaces the parts of the AppDaemon Hass API that PVOpt uses. get_state, entity_exists and
+get_history are served from the snapshot. call_service, set_state, MQTT publishes and the scheduler calls are
+recorded rather than sent anywhere. The services that PVOpt polls after calling (number, select, switch, time and
+button) update the snapshot as Home Assistant would, so inverter control runs to completion. HTTP requests are
+answered from the snapshot's "http" section so no network is needed. The tariff rate cache is off unless a
+rate_cache file is given.
+
+A snapshot is a JSON file:
+
+    {
+        "description": "...",
+        "now": "2024-06-01T04:00:00+00:00",      # when it was recorded
+        "time_zone": "Europe/London",
+        "args": {...},                           # the pv_opt section of apps.yaml
+        "states": {"sensor.x": {"state": "1", "attributes": {...}}, ...},
+        "history": {"sensor.x": [{"state": "1", "last_updated": "..."}, ...], ...},
+        "http": {"https://...": {...}, ...}      # JSON responses by URL, without the query string
+    }
+
+Every timestamp in the snapshot is moved forward by a whole number of days so that it lines up with today, as
+PVOpt plans from the current time. Run a snapshot from the command line to profile a full initialise and
+optimise:
+
+    python -m tests.pv_opt.headless snapshot.json [--profile]
+"""
+
+import json
+import re
+import sys
+import threading
+import time
+from copy import deepcopy
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parents[2] / "apps" / "pv_opt"))
+
+import pv_opt  # noqa: E402
+import pvpy  # noqa: E402
+
+ISO_TIME = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}")
+
+
+def _shift(value, delta: pd.Timedelta):
+    # Moves every ISO timestamp string found in value by delta, keeping its format
+    if isinstance(value, str) and ISO_TIME.match(value):
+        try:
+            t = pd.Timestamp(value)
+        except ValueError:
+            return value
+        fmt = "%Y-%m-%dT%H:%M:%S" if "T" in value else "%Y-%m-%d %H:%M:%S"
+        shifted = (t + delta).strftime(fmt)
+        if "." in value[19:26]:
+            shifted += (t + delta).strftime(".%f")
+        if t.tzinfo is not None:
+            offset = (t + delta).strftime("%z")
+            shifted += "Z" if value.endswith("Z") else f"{offset[:3]}:{offset[3:]}"
+        return shifted
+    elif isinstance(value, dict):
+        return {k: _shift(v, delta) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_shift(v, delta) for v in value]
+    return value
+
+
+def load_snapshot(path, now=None) -> dict:
+    """Reads a snapshot and moves it forward by whole days so that its "now" falls on the same day as now."""
+    snapshot = json.loads(Path(path).read_text())
+    if now is None:
+        now = pd.Timestamp.now(tz="UTC")
+    delta = now.normalize() - pd.Timestamp(snapshot["now"]).tz_convert("UTC").normalize()
+    return {k: (v if k in ["args", "time_zone"] else _shift(v, delta)) for k, v in snapshot.items()}
+
+
+class HttpResponse:
+    def __init__(self, url, data):
+        self.url = url
+        self.data = data
+        self.status_code = 200 if data is not None else 404
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.data is None:
+            raise pvpy.requests.exceptions.HTTPError(f"No recorded response for {self.url}")
+
+
+class HeadlessMQTT:
+    """Records MQTT publishes and turns discovery and state messages into Home Assistant entities."""
+
+    def __init__(self, host):
+        self.host = host
+        self.published = []
+        self.topics = {}
+
+    def mqtt_publish(self, topic, payload=None, **kwargs):
+        self.published.append((topic, payload))
+        domain, id, kind = topic.split("/")[1:4]
+        entity_id = f"{domain}.{id}"
+        if kind == "config":
+            self.topics[json.loads(payload)["state_topic"]] = entity_id
+        elif kind == "state" and topic in self.topics:
+            state = payload.lower() if domain == "switch" else payload
+            self.host.states.setdefault(entity_id, {"attributes": {}})["state"] = state
+
+    def mqtt_subscribe(self, topic, **kwargs):
+        pass
+
+    def listen_state(self, callback=None, **kwargs):
+        return self.host._handle("mqtt_listen_state", callback=callback, **kwargs)
+
+
+class HeadlessPVOpt(pv_opt.PVOpt):
+    """PVOpt with the AppDaemon API served from a snapshot. See the module docstring."""
+
+    # AppDaemon reads these from the app's config so they are plain attributes here
+    name = None
+    namespace = "default"
+
+    def __init__(self, snapshot: dict, name="pv_opt", echo=False, rate_cache=False):
+        self.name = name
+        self.lock = threading.RLock()
+        self.args = {"rate_cache": rate_cache} | snapshot["args"]
+        self.states = {entity_id: dict(state) for entity_id, state in snapshot["states"].items()}
+        self.history = snapshot.get("history", {})
+        self.http = snapshot.get("http", {})
+        self.time_zone = snapshot.get("time_zone", "Europe/London")
+        self.echo = echo
+
+        self.log_lines = []
+        self.services = []
+        self.set_states = []
+        self.handles_created = []
+        self.missing = set()
+        self._mqtt = HeadlessMQTT(self)
+
+    def run(self):
+        """Initialises the app, which runs the first optimisation, with HTTP requests served from the snapshot."""
+        with mock.patch.object(pvpy.http_client, "get", self._http_get), mock.patch.object(pv_opt.time, "sleep"):
+            self.initialize()
+
+    def optimise_again(self):
+        with mock.patch.object(pvpy.http_client, "get", self._http_get), mock.patch.object(pv_opt.time, "sleep"):
+            self.optimise()
+
+    def _http_get(self, url, params=None, **kwargs):
+        data = self.http.get(url)
+        if data is None:
+            self.missing.add(url)
+        return HttpResponse(url, data)
+
+    def _handle(self, kind, **kwargs):
+        handle = f"{kind}_{len(self.handles_created)}"
+        self.handles_created.append((handle, kind, kwargs))
+        return handle
+
+    # Logging
+    def log(self, msg, *args, level="INFO", **kwargs):
+        self.log_lines.append((level, str(msg)))
+        if self.echo:
+            print(f"{level:7s} {msg}")
+
+    # State. Home Assistant returns a new copy of the state on every call and pv_opt relies on that
+    def entity_exists(self, entity_id, namespace=None, **kwargs):
+        return entity_id in self.states
+
+    def get_state(self, entity_id=None, attribute=None, default=None, namespace=None, **kwargs):
+        if entity_id is None:
+            return {k: deepcopy(v) | {"entity_id": k} for k, v in self.states.items()}
+
+        if "." not in entity_id:
+            return {k: deepcopy(v) | {"entity_id": k} for k, v in self.states.items() if k.split(".")[0] == entity_id}
+
+        if entity_id not in self.states:
+            self.missing.add(entity_id)
+            return default
+
+        state = deepcopy(self.states[entity_id])
+        if attribute is None:
+            return state.get("state", default)
+        elif attribute == "all":
+            return state | {"entity_id": entity_id}
+        return state.get("attributes", {}).get(attribute, default)
+
+    def set_state(self, entity_id, state=None, attributes=None, replace=False, **kwargs):
+        self.set_states.append((entity_id, state, attributes))
+        entity = self.states.setdefault(entity_id, {"attributes": {}})
+        if state is not None:
+            entity["state"] = str(state)
+        if attributes is not None:
+            entity["attributes"] = attributes if replace else entity.get("attributes", {}) | attributes
+        return dict(entity, entity_id=entity_id)
+
+    def get_history(self, entity_id=None, days=1, **kwargs):
+        if entity_id not in self.history:
+            self.missing.add(entity_id)
+            return []
+        end = pd.Timestamp.now(tz="UTC")
+        start = end - pd.Timedelta(days=days)
+        return [[x for x in self.history[entity_id] if start <= pd.Timestamp(x["last_updated"]) <= end]]
+
+    def call_service(self, service, **kwargs):
+        self.services.append((service, kwargs))
+        domain, action = service.split("/")
+        entity_id = kwargs.get("entity_id")
+        if entity_id in self.states:
+            if action == "set_value":
+                self.states[entity_id]["state"] = str(kwargs["value"])
+            elif action == "select_option":
+                self.states[entity_id]["state"] = kwargs["option"]
+            elif action in ["turn_on", "turn_off"]:
+                self.states[entity_id]["state"] = action[5:]
+            elif domain == "button" and action == "press":
+                self.states[entity_id]["state"] = pd.Timestamp.now(tz="UTC").isoformat()
+
+    # Scheduler and listeners
+    def run_every(self, callback, start=None, interval=0, **kwargs):
+        return self._handle("run_every", callback=callback, start=start, interval=interval, **kwargs)
+
+    def run_in(self, callback, delay, **kwargs):
+        return self._handle("run_in", callback=callback, delay=delay, **kwargs)
+
+    def listen_state(self, callback=None, entity_id=None, **kwargs):
+        return self._handle("listen_state", callback=callback, entity_id=entity_id, **kwargs)
+
+    def listen_event(self, callback=None, event=None, **kwargs):
+        return self._handle("listen_event", callback=callback, event=event, **kwargs)
+
+    def cancel_timer(self, handle, **kwargs):
+        return True
+
+    def cancel_listen_state(self, handle, **kwargs):
+        return True
+
+    def info_listen_state(self, handle, **kwargs):
+        return None
+
+    # AppDaemon
+    def get_ad_api(self):
+        return self
+
+    def get_plugin_api(self, name):
+        return self._mqtt
+
+    def get_tz_offset(self):
+        return int(pd.Timestamp.now(tz=self.time_zone).utcoffset().total_seconds() / 60)
+
+    def get_timezone(self):
+        return self.time_zone
+
+
+def main(argv=None):
+    import argparse
+    import cProfile
+    import pstats
+
+    parser = argparse.ArgumentParser(description="Run PV Opt against a recorded Home Assistant snapshot")
+    parser.add_argument("snapshot")
+    parser.add_argument("--profile", action="store_true", help="Profile the run and print the slowest calls")
+    parser.add_argument("--echo", action="store_true", help="Print the PV Opt log")
+    args = parser.parse_args(argv)
+
+    app = HeadlessPVOpt(load_snapshot(args.snapshot), echo=args.echo)
+    t0 = time.perf_counter()
+    try:
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.runcall(app.run)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+        else:
+            app.run()
+        print(f"Initialise and optimise took {time.perf_counter() - t0:0.2f}s")
+        print(f"{len(app.services)} service calls, {len(app.set_states)} states written")
+    finally:
+        if app.missing:
+            print(f"Not in the snapshot: {', '.join(sorted(app.missing))}")
+
+
+if __name__ == "__main__":
+    main()
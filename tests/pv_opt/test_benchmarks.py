@@ -0,0 +1,227 @@
+"""Offline benchmarks of the optimiser using recorded fixtures.
+
+Each file in fixtures/ holds the Octopus API responses, Solcast forecast and consumption for a two day plan on one
+tariff, plus any IOG dispatch rates or saving sessions. Contract and PVsystemModel are built from them with the
+Octopus requests replayed from the file, so nothing needs AppDaemon or the network.
+
+test_plan_cost checks each plan against the net cost recorded in the fixture and test_heuristic_plan_unchanged checks
+the heuristic's forced power and SOC in every slot against fixtures/golden/heuristic_plans.json, which was recorded
+from the original heuristic before any of it was optimised for speed. test_optimiser_benchmark times
+optimised_force with pytest-benchmark and adds the time spent in each phase, the number of calculate_flows and
+net_cost calls and the net cost to extra_info:
+
+    pytest tests/pv_opt/test_benchmarks.py --benchmark-only --benchmark-columns=min,mean,rounds
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from apps.pv_opt import pvpy as pv
+from tests.pv_opt.conftest import FakeHost
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+
+    @pytest.fixture
+    def benchmark():
+        pytest.skip("pytest-benchmark is not installed")
+
+
+FIXTURES = sorted((Path(__file__).parent / "fixtures").glob("*.json"))
+
+GOLDEN = json.loads((Path(__file__).parent / "fixtures" / "golden" / "heuristic_plans.json").read_text())
+
+# Initial SOCs at which the golden heuristic plans were recorded
+GOLDEN_SOCS = [10, 50, 90]
+
+CASES = {
+    "Optimised Charging": {"use_export": False, "discharge": False},
+    "Optimised PV Export": {"use_export": True, "discharge": False},
+    "Forced Discharge": {"use_export": True, "discharge": True},
+}
+
+# Allowed increase in plan cost (p) before test_plan_cost fails
+COST_TOLERANCE = 0.5
+
+
+class ReplayResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+def _replay(fixture):
+    # Serves the recorded Octopus product API responses by path and fails on anything that wasn't recorded
+    def get(url, params=None, **kwargs):
+        path = url.replace(pv.OCTOPUS_PRODUCT_URL, "")
+        if path not in fixture["octopus"]:
+            raise AssertionError(f"No recorded response for {url}")
+        return ReplayResponse(fixture["octopus"][path])
+
+    return get
+
+
+def load_fixture(path, monkeypatch, **config):
+    """Builds a PVsystemModel with its Contract and static_flows from a fixture file."""
+    fixture = json.loads(Path(path).read_text())
+    monkeypatch.setattr(pv.http_client, "get", _replay(fixture))
+
+    host = FakeHost(**config)
+    imp = pv.Tariff(fixture["import"], host=host)
+    exp = pv.Tariff(fixture["export"], export=True, host=host)
+
+    # Tariff clears io_prices when it is created so they are loaded afterwards as pv_opt does
+    if len(fixture["io_rates"]) > 0:
+        io_rates = pd.DataFrame(fixture["io_rates"])
+        host.io_prices = pd.Series(
+            io_rates["value_inc_vat"].to_numpy() * 100, index=pd.to_datetime(io_rates["start"], utc=True)
+        )
+    host.saving_events = {event["id"]: event for event in fixture["saving_events"]}
+
+    model = pv.PVsystemModel("benchmark", pv.InverterModel(), pv.BatteryModel(fixture["battery_capacity_wh"]), host)
+    model.contract = pv.Contract("benchmark", imp=imp, exp=exp, host=host)
+
+    index = pd.date_range(fixture["start"], fixture["end"], freq="30min")
+    solar = pd.DataFrame(fixture["solcast"])
+    consumption = pd.DataFrame(fixture["consumption"])
+    model.static_flows = pd.DataFrame(
+        {
+            "solar": pd.Series(
+                solar["pv_estimate"].to_numpy() * 1000, index=pd.to_datetime(solar["period_start"], utc=True)
+            ).reindex(index),
+            "consumption": pd.Series(
+                consumption["consumption"].to_numpy(), index=pd.to_datetime(consumption["start"], utc=True)
+            ).reindex(index),
+        }
+    )
+    model.initial_soc = fixture["initial_soc"]
+    return model, fixture
+
+
+def profile(model) -> pv.StageTimer:
+    """Gives the model's host a StageTimer so that the time in each optimiser phase and the number of
+    calculate_flows, net_cost and net_cost_batch calls are recorded as they are in the app."""
+    model.host.timer = pv.StageTimer()
+    return model.host.timer
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("path", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_plan_cost(path, case, monkeypatch):
+    # Ensure that the plan for each fixture and case is no more expensive than the one recorded.
+    model, fixture = load_fixture(path, monkeypatch)
+    flows = model.optimised_force(log=False, **CASES[case])
+
+    assert model.contract.net_cost(flows) <= fixture["expected_net_cost"][case] + COST_TOLERANCE
+
+
+def test_low_solar_fixture_forces_slots(monkeypatch):
+    # Ensure that the low solar fixture keeps exercising the phases that June days leave idle: the first stage
+    # forces charging even without export and the discharge phase forces discharging.
+    path = Path(__file__).parent / "fixtures" / "agile_low_solar.json"
+    model, fixture = load_fixture(path, monkeypatch)
+    model.optimised_force(log=False, **CASES["Optimised Charging"])
+    assert len(model.stage1["slots"]) > 0
+
+    model, fixture = load_fixture(path, monkeypatch)
+    flows = model.optimised_force(log=False, **CASES["Forced Discharge"])
+    assert (flows["forced"] > 0).any()
+    assert (flows["forced"] < 0).any()
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("soc", GOLDEN_SOCS)
+@pytest.mark.parametrize("path", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_heuristic_plan_unchanged(path, soc, case, monkeypatch):
+    # Ensure that the heuristic still makes exactly the plan it made before its phases were sped up.
+    model, fixture = load_fixture(path, monkeypatch)
+    model.initial_soc = soc
+    flows = model.optimised_force(log=False, **CASES[case])
+
+    golden = GOLDEN[Path(path).stem][str(soc)][case]
+    np.testing.assert_allclose(flows["forced"].to_numpy(dtype=float), golden["forced"], rtol=0, atol=0.1)
+    np.testing.assert_allclose(flows["soc"].to_numpy(dtype=float), golden["soc"], rtol=0, atol=0.01)
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("path", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_lp_no_worse_than_dp_or_heuristic(path, case, monkeypatch):
+    # Ensure that the LP plan, which is exact for the simulated flows, is no more expensive than the DP or
+    # heuristic plan for every fixture and case.
+    pytest.importorskip("scipy")
+    costs = {}
+    for engine in ["heuristic", "dp", "lp"]:
+        model, fixture = load_fixture(path, monkeypatch, optimiser_engine=engine)
+        costs[engine] = model.contract.net_cost(model.optimised_force(log=False, **CASES[case]))
+
+    assert costs["lp"] <= costs["dp"]
+    assert costs["lp"] <= costs["heuristic"]
+
+
+@pytest.mark.parametrize("path", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_lp_discharge_no_worse_than_export(path, monkeypatch):
+    # Ensure that allowing the LP to discharge never gives a more expensive plan than only exporting.
+    pytest.importorskip("scipy")
+    costs = {}
+    for case in ["Optimised PV Export", "Forced Discharge"]:
+        model, fixture = load_fixture(path, monkeypatch, optimiser_engine="lp")
+        costs[case] = model.contract.net_cost(model.optimised_force(log=False, **CASES[case]))
+
+    assert costs["Forced Discharge"] <= costs["Optimised PV Export"]
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("path", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_flow_no_worse_than_heuristic(path, case, monkeypatch):
+    # Ensure that the min-cost-flow plan is no more expensive than the heuristic's.
+    costs = {}
+    for engine in ["heuristic", "flow"]:
+        model, fixture = load_fixture(path, monkeypatch, optimiser_engine=engine)
+        costs[engine] = model.contract.net_cost(model.optimised_force(log=False, **CASES[case]))
+
+    assert costs["flow"] <= costs["heuristic"] + 0.05
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("stem", ["iog", "saving_session"])
+def test_flow_no_worse_than_heuristic_low_solar(stem, case, monkeypatch):
+    # Ensure that with little solar and an empty battery, so that charge has to be carried past several imports,
+    # the min-cost-flow plan is no more expensive than the heuristic's.
+    costs = {}
+    for engine in ["heuristic", "flow"]:
+        model, fixture = load_fixture(Path(__file__).parent / "fixtures" / f"{stem}.json", monkeypatch)
+        model.host.config["optimiser_engine"] = engine
+        model.static_flows["solar"] *= 0.1
+        model.initial_soc = 10
+        costs[engine] = model.contract.net_cost(model.optimised_force(log=False, **CASES[case]))
+
+    assert costs["flow"] <= costs["heuristic"] + 0.05
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("path", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_optimiser_benchmark(benchmark, path, case, monkeypatch):
+    model, fixture = load_fixture(path, monkeypatch)
+    timer = profile(model)
+    benchmark.group = Path(path).stem
+
+    flows = benchmark.pedantic(model.optimised_force, kwargs={"log": False} | CASES[case], rounds=3, iterations=1)
+
+    assert timer.calls["net_cost"] > 0
+    for name, seconds in timer.seconds.items():
+        benchmark.extra_info[f"{name}_seconds"] = round(seconds / 3, 4)
+    for name, n in timer.calls.items():
+        benchmark.extra_info[f"{name}_calls"] = n // 3
+    benchmark.extra_info["net_cost"] = model.contract.net_cost(flows)
+    benchmark.extra_info["base_cost"] = model.base_cost
+    benchmark.extra_info["slots"] = int((flows["forced"] != 0).sum())
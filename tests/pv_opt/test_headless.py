@@ -0,0 +1,216 @@
+from concurrent.futures import Future
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("appdaemon")
+
+from tests.pv_opt.headless import HeadlessPVOpt, load_snapshot, pvpy  # noqa: E402
+
+SNAPSHOT = Path(__file__).parent / "fixtures" / "headless" / "eco7_solis.json"
+
+
+@pytest.fixture
+def app():
+    app = HeadlessPVOpt(load_snapshot(SNAPSHOT))
+    app.run()
+    yield app
+    app.terminate()
+
+
+def test_load_snapshot_moves_to_today():
+    snapshot = load_snapshot(SNAPSHOT, now=pd.Timestamp("2025-01-15 18:00", tz="UTC"))
+    forecast = snapshot["states"]["sensor.solcast_pv_forecast_forecast_today"]["attributes"]["detailedForecast"]
+
+    assert pd.Timestamp(snapshot["now"]).date() == pd.Timestamp("2025-01-15").date()
+    assert pd.Timestamp(forecast[0]["period_start"]) == pd.Timestamp("2025-01-15", tz="UTC")
+    assert snapshot["args"]["octopus_import_tariff_code"] == "E-2R-VAR-22-11-01-A"
+
+
+def test_optimise_end_to_end(app):
+    # Ensure that initialise and the first optimisation run from the snapshot alone and publish a plan.
+    assert app.missing == set()
+    assert not any(level == "ERROR" for level, _ in app.log_lines)
+
+    written = {entity_id for entity_id, _, _ in app.set_states}
+    assert {"sensor.solis_opt_cost", "sensor.solis_base_cost", "sensor.solis_optimiser_elapsed"} <= written
+    assert float(app.get_state("sensor.solis_opt_cost")) <= float(app.get_state("sensor.solis_base_cost"))
+
+
+def test_optimiser_elapsed_breakdown(app):
+    # Ensure that the time in each stage of optimise() and the simulation and costing counts are published.
+    attributes = app.get_state("sensor.solis_optimiser_elapsed", attribute="all")["attributes"]
+
+    for stage in ["tariffs", "solcast", "consumption", "optimiser", "write_output", "inverter", "high_cost_swaps"]:
+        assert attributes[f"{stage}_seconds"] >= 0
+    assert attributes["calculate_flows_calls"] > 0
+    assert attributes["net_cost_calls"] > 0
+    assert attributes["total_seconds"] >= attributes["optimiser_seconds"]
+
+
+def test_config_entities_created_over_mqtt(app):
+    # Ensure that the config entities pv_opt creates with MQTT discovery can be read back as it would from HA.
+    assert app.get_state("select.solis_optimiser_engine") == "heuristic"
+    assert app.get_state("switch.solis_read_only") == "off"
+    assert any(topic.endswith("/config") for topic, _ in app.get_plugin_api("MQTT").published)
+
+
+def test_optimise_again_records_service_calls(app):
+    calls = len(app.services)
+    app.optimise_again()
+
+    assert app.missing == set()
+    assert all(
+        service.split("/")[0] in ["number", "select", "switch", "button", "time"] for service, _ in app.services
+    )
+    assert len(app.services) >= calls
+
+
+def test_cases_sent_to_pool_before_selected_case_runs(app):
+    # Ensure that with workers the cases that aren't selected are submitted before the selected one is optimised
+    # here, so that they run at the same time as it.
+    events = []
+
+    class Pool:
+        def submit(self, fn, model, kwargs):
+            events.append(("submit", kwargs["use_export"], kwargs["discharge"]))
+            future = Future()
+            future.set_result(fn(model, kwargs))
+            return future
+
+    optimised_force = pvpy.PVsystemModel.optimised_force
+
+    def local(model, *args, **kwargs):
+        if model is app.pv_system:
+            events.append(("local", kwargs["use_export"], kwargs["discharge"]))
+        return optimised_force(model, *args, **kwargs)
+
+    with mock.patch.object(app, "_optimiser_pool", return_value=Pool()), mock.patch.object(
+        pvpy.PVsystemModel, "optimised_force", local
+    ):
+        app.optimise()
+
+    selected = {
+        "Optimised Charging": (False, False),
+        "Optimised PV Export": (True, False),
+        "Forced Discharge": (True, True),
+    }[app.selected_case]
+    assert [kind for kind, *_ in events] == ["submit", "submit", "local"]
+    assert events[-1] == ("local", *selected)
+    assert app.optimised_cost[app.selected_case].sum() <= app.optimised_cost["Base"].sum()
+
+
+def test_idle_slots_become_charge_windows(app):
+    # Ensure that slots an LP or DP plan leaves idle, which are forced to charge at MIN_FORCED_POWER, are written as
+    # an ordinary charge window rather than a car window.
+    idle = app.opt.index[app.opt["forced"] == 0][:3]
+    app.opt.loc[idle, "forced"] = pvpy.MIN_FORCED_POWER
+    app._create_windows()
+
+    window = app.windows[app.windows["start"] == idle[0].tz_convert(app.tz)]
+    assert len(window) == 1
+    assert window["hold_soc"].iloc[0] != "<=Car"
+    assert not (app.windows["hold_soc"] == "<=Car").any()
+
+
+def test_restart_offline_from_rate_cache(tmp_path):
+    # Ensure that after a restart the app can load its contract and optimise from the rate cache with no network.
+    cache = tmp_path / "rates.sqlite"
+    app = HeadlessPVOpt(load_snapshot(SNAPSHOT), rate_cache=str(cache))
+    app.run()
+    app.terminate()
+
+    snapshot = load_snapshot(SNAPSHOT)
+    snapshot["http"] = {}
+    app = HeadlessPVOpt(snapshot, rate_cache=str(cache))
+    app.run()
+    app.terminate()
+
+    assert app.missing == set()
+    assert not any(level == "ERROR" for level, _ in app.log_lines)
+    assert float(app.get_state("sensor.solis_opt_cost")) <= float(app.get_state("sensor.solis_base_cost"))
+
+
+def test_prefetch_swaps_contract_between_runs(tmp_path):
+    # Ensure that tariffs are downloaded by the prefetch timer, which queues a reload once one is due, and that
+    # optimise() doesn't download anything itself.
+    app = HeadlessPVOpt(load_snapshot(SNAPSHOT), rate_cache=str(tmp_path / "rates.sqlite"))
+    app.run()
+    prefetch = next(
+        kwargs for _, kind, kwargs in app.handles_created if kwargs.get("callback") == app._prefetch_tariffs
+    )
+    contract = app.contract
+
+    requests = []
+
+    def http_get(url, *args, **kwargs):
+        requests.append(url)
+        return app._http_get(url, *args, **kwargs)
+
+    # Nothing is downloaded until a reload is due
+    with mock.patch.object(pvpy.http_client, "get", http_get):
+        prefetch["callback"]({})
+    assert not any(kind == "run_in" for _, kind, _ in app.handles_created)
+    assert requests == []
+
+    app.contract_last_loaded -= pd.Timedelta(hours=7)
+    with mock.patch.object(pvpy.http_client, "get", http_get):
+        prefetch["callback"]({})
+    swap = next(kwargs for _, kind, kwargs in app.handles_created if kind == "run_in")
+    assert swap["reload"] == "reload"
+
+    # and a reload that is still due is served from the cache while it is fresh
+    requests.clear()
+    with mock.patch.object(pvpy.http_client, "get", http_get):
+        prefetch["callback"]({})
+    assert requests == []
+
+    # The rates are now in the cache so the swap and the next optimisation work without the network
+    app.http = {}
+    swap["callback"](swap)
+    app.optimise_again()
+    app.terminate()
+
+    assert app.contract is not contract
+    assert not any("Unable to prefetch" in line for _, line in app.log_lines)
+    assert app.missing == set()
+    assert not any(level == "ERROR" for level, _ in app.log_lines)
+
+
+def test_swap_contract_without_cache_downloads_nothing():
+    # Ensure that with the rate cache off the new contract is downloaded by the prefetch timer and the swap under
+    # the app lock only puts it in place.
+    app = HeadlessPVOpt(load_snapshot(SNAPSHOT), rate_cache=False)
+    app.run()
+    prefetch = next(
+        kwargs for _, kind, kwargs in app.handles_created if kwargs.get("callback") == app._prefetch_tariffs
+    )
+    contract = app.contract
+
+    requests = []
+
+    def http_get(url, *args, **kwargs):
+        requests.append(url)
+        return app._http_get(url, *args, **kwargs)
+
+    app.contract_last_loaded -= pd.Timedelta(hours=7)
+    with mock.patch.object(pvpy.http_client, "get", http_get):
+        prefetch["callback"]({})
+    swap = next(kwargs for _, kind, kwargs in app.handles_created if kind == "run_in")
+    assert len(requests) > 0
+    assert swap["contract"] is not None and swap["contract"] is not contract
+
+    requests.clear()
+    with mock.patch.object(pvpy.http_client, "get", http_get):
+        swap["callback"](swap)
+    assert requests == []
+
+    app.optimise_again()
+    app.terminate()
+
+    assert app.contract is swap["contract"]
+    assert app.contract_last_loaded > pd.Timestamp.now(tz="UTC") - pd.Timedelta(hours=1)
+    assert app.missing == set()
+    assert not any(level == "ERROR" for level, _ in app.log_lines)
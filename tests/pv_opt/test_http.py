@@ -0,0 +1,307 @@
+import json
+import pickle
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+import pytest
+import requests
+
+from apps.pv_opt import pvpy as pv
+from tests.pv_opt.conftest import FakeHost
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Serves server.responses by path. server.failures[path] requests fail with 503 before it succeeds and
+    # server.delay is a wait before every response.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        server.requests.append((self.client_address, self.path))
+        time.sleep(server.delay)
+
+        if server.failures.get(path, 0) > 0:
+            server.failures[path] -= 1
+            status, body = 503, b"{}"
+        elif path in server.responses:
+            status, body = 200, json.dumps(server.responses[path]).encode()
+        else:
+            status, body = 404, b"{}"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.responses = {}
+    server.failures = {}
+    server.requests = []
+    server.delay = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client():
+    client = pv.HttpClient(timeout=0.5, retries=2, backoff=0.01)
+    yield client
+    client.close()
+
+
+def test_connections_are_reused(server, client):
+    server.responses["/rates/"] = {"results": [1, 2, 3]}
+    for _ in range(3):
+        assert client.get(f"{server.url}/rates/").json() == {"results": [1, 2, 3]}
+
+    assert len({address for address, _ in server.requests}) == 1
+    assert client.stats() == {"calls": 3, "retries": 0, "errors": 0, "bytes": 3 * len('{"results": [1, 2, 3]}')}
+
+
+def test_retries_with_backoff(server, client):
+    server.responses["/rates/"] = {"results": []}
+    server.failures["/rates/"] = 2
+
+    assert client.get(f"{server.url}/rates/").status_code == 200
+    assert client.stats()["calls"] == 3
+    assert client.stats()["retries"] == 2
+    assert client.stats()["errors"] == 2
+
+    # Once the retries are used up the last response is returned
+    server.failures["/rates/"] = 3
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get(f"{server.url}/rates/").raise_for_status()
+
+
+def test_timeout(server, client):
+    server.delay = 1
+    t0 = time.time()
+    with pytest.raises(requests.exceptions.Timeout):
+        client.get(f"{server.url}/rates/")
+
+    assert time.time() - t0 < 3
+    assert client.stats()["errors"] == 3
+
+
+def test_tariff_loads_through_client(server, client, monkeypatch):
+    # Ensure that a Tariff is downloaded through the shared client from a stub of the Octopus product API.
+    fixture = json.loads((Path(__file__).parent / "fixtures" / "agile.json").read_text())
+    server.responses = {f"/{path}": data for path, data in fixture["octopus"].items()}
+    monkeypatch.setattr(pv, "OCTOPUS_PRODUCT_URL", f"{server.url}/")
+    monkeypatch.setattr(pv, "http_client", client)
+
+    tariff = pv.Tariff(fixture["import"], host=FakeHost())
+
+    assert len(tariff.unit) > 0
+    assert client.stats()["calls"] == len(server.requests)
+    assert client.stats()["bytes"] > 0
+
+
+def test_client_is_not_pickled():
+    with pytest.raises(TypeError):
+        pickle.dumps(pv.http_client)
+
+
+def test_tariffs_download_concurrently(server, client, monkeypatch):
+    # Ensure that an Economy 7 tariff's three endpoints and several tariffs are fetched in about one round trip.
+    rate = {"value_inc_vat": 20.0, "valid_from": "2024-06-01T00:00:00Z", "payment_method": "DIRECT_DEBIT"}
+    for code in ["E-2R-TEST-24-01-01-A", "E-1R-TEST-24-01-01-A"]:
+        for endpoint in ["standing-charges", "day-unit-rates", "night-unit-rates", "standard-unit-rates"]:
+            server.responses[f"/TEST-24-01-01/electricity-tariffs/{code}/{endpoint}/"] = {"results": [rate]}
+    server.delay = 0.3
+    monkeypatch.setattr(pv, "OCTOPUS_PRODUCT_URL", f"{server.url}/")
+    monkeypatch.setattr(pv, "http_client", client)
+
+    t0 = time.time()
+    tariffs = pv.load_tariffs(
+        {
+            "import": {"name": "E-2R-TEST-24-01-01-A"},
+            "export": {"name": "E-1R-TEST-24-01-01-A", "export": True},
+        },
+        host=FakeHost(),
+    )
+
+    assert time.time() - t0 < 0.55
+    assert client.stats()["calls"] == 4
+    assert tariffs["import"].eco7 and len(tariffs["import"].night) == 1
+    assert tariffs["export"].fixed is None and len(tariffs["export"].unit) == 1
+
+
+def test_tariff_refresh_appends_new_rates(server, client, monkeypatch):
+    # Ensure that a tariff downloads only a recent window of rates and a refresh only asks for rates after end().
+    url = "/AGILE-24-04-03/electricity-tariffs/E-1R-AGILE-24-04-03-A"
+    start = pd.Timestamp.now(tz="UTC").normalize() - pv.RATE_HISTORY
+
+    def rates(start, n):
+        times = pd.date_range(start, periods=n + 1, freq="30min")
+        return {
+            "results": [
+                {"value_inc_vat": float(i), "valid_from": t0.isoformat(), "valid_to": t1.isoformat()}
+                for i, (t0, t1) in enumerate(zip(times[:-1], times[1:]))
+            ]
+        }
+
+    standing = {"value_inc_vat": 50.0, "valid_from": start.isoformat(), "payment_method": "DIRECT_DEBIT"}
+    server.responses[f"{url}/standing-charges/"] = {"results": [standing]}
+    server.responses[f"{url}/standard-unit-rates/"] = rates(start, 96)
+    monkeypatch.setattr(pv, "OCTOPUS_PRODUCT_URL", f"{server.url}/")
+    monkeypatch.setattr(pv, "http_client", client)
+
+    tariff = pv.Tariff("E-1R-AGILE-24-04-03-A", host=FakeHost())
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(server.requests[-1][1]).query)
+    assert pd.Timestamp(query["period_from"][0]).date() == start.date()
+    assert tariff.end() == start + pd.Timedelta(hours=48)
+
+    # The next day's rates, with the last of the current ones repeated
+    server.requests.clear()
+    server.responses[f"{url}/standard-unit-rates/"] = rates(tariff.end() - pd.Timedelta("30min"), 49)
+    assert tariff.refresh() == 48
+
+    path, query = server.requests[0][1].split("?")
+    assert path == f"{url}/standard-unit-rates/" and len(server.requests) == 1
+    assert pd.Timestamp(urllib.parse.parse_qs(query)["period_from"][0]) == start + pd.Timedelta(hours=48)
+    assert len(tariff.unit) == 144
+    assert tariff.end() == start + pd.Timedelta(hours=72)
+    assert tariff.to_df(start, tariff.end() - pd.Timedelta("30min"), day_ahead=False)["unit"].iloc[-1] == 48
+
+    server.responses[f"{url}/standard-unit-rates/"] = {"results": []}
+    assert tariff.refresh() == 0
+
+
+def test_rate_cache_downloads_only_new_rates(server, client, monkeypatch, tmp_path):
+    # Ensure that cached rates are reused after a restart, only later rates are downloaded and that the cache is
+    # used on its own when the API fails.
+    url = "/AGILE-24-04-03/electricity-tariffs/E-1R-AGILE-24-04-03-A"
+    start = pd.Timestamp.now(tz="UTC").normalize() - pv.RATE_HISTORY
+    times = pd.date_range(start, periods=97, freq="30min")
+    unit = [
+        {"value_inc_vat": float(i), "valid_from": t0.isoformat(), "valid_to": t1.isoformat(), "payment_method": None}
+        for i, (t0, t1) in enumerate(zip(times[:-1], times[1:]))
+    ]
+    standing = {"value_inc_vat": 50.0, "valid_from": start.isoformat(), "payment_method": "DIRECT_DEBIT"}
+    server.responses[f"{url}/standing-charges/"] = {"results": [standing]}
+    server.responses[f"{url}/standard-unit-rates/"] = {"results": unit}
+    monkeypatch.setattr(pv, "OCTOPUS_PRODUCT_URL", f"{server.url}/")
+    monkeypatch.setattr(pv, "http_client", client)
+    monkeypatch.setattr(pv, "rate_cache", pv.RateCache(tmp_path / "rates.sqlite"))
+
+    first = pv.Tariff("E-1R-AGILE-24-04-03-A", host=FakeHost())
+
+    # A new Tariff, as after a restart, makes no requests while the cache is fresh
+    server.requests.clear()
+    pv.Tariff("E-1R-AGILE-24-04-03-A", host=FakeHost())
+    assert server.requests == []
+
+    # and once it isn't it asks only for rates after the last cached one
+    server.responses[f"{url}/standard-unit-rates/"] = {"results": unit[-1:]}
+    second = pv.Tariff("E-1R-AGILE-24-04-03-A", host=FakeHost(), max_age=pd.Timedelta(0))
+
+    query = {
+        path: urllib.parse.parse_qs(query)["period_from"][0]
+        for path, query in (request.split("?") for _, request in server.requests)
+    }
+    assert pd.Timestamp(query[f"{url}/standard-unit-rates/"]) == times[-1]
+    assert list(second.unit.value) == list(first.unit.value) and len(second.unit) == 96
+    assert list(second.fixed.value) == [50.0]
+
+    # With the API down the cached rates are used
+    server.failures = {f"{url}/standing-charges/": 10, f"{url}/standard-unit-rates/": 10}
+    third = pv.Tariff("E-1R-AGILE-24-04-03-A", host=FakeHost(), max_age=pd.Timedelta(0))
+    assert list(third.unit.value) == list(first.unit.value)
+
+    # but a tariff that has never been downloaded can't be loaded
+    with pytest.raises(Exception):
+        pv.Tariff("E-1R-AGILE-24-04-03-B", host=FakeHost())
+
+
+def test_load_tariffs_updates_host_after_downloads(server, client, monkeypatch):
+    # Ensure that the IOG prices loaded for an Intelligent import tariff aren't cleared by the export tariff
+    # however the downloads finish.
+    rate = {"value_inc_vat": 20.0, "valid_from": "2024-06-01T00:00:00Z", "payment_method": "DIRECT_DEBIT"}
+    for code in ["E-1R-INTELLI-VAR-22-10-14-A", "E-1R-OUTGOING-FIX-12M-19-05-13-A"]:
+        for endpoint in ["standing-charges", "standard-unit-rates"]:
+            server.responses[f"/{code[5:-2]}/electricity-tariffs/{code}/{endpoint}/"] = {"results": [rate]}
+    monkeypatch.setattr(pv, "OCTOPUS_PRODUCT_URL", f"{server.url}/")
+    monkeypatch.setattr(pv, "http_client", client)
+
+    class IOGHost(FakeHost):
+        def get_config(self, item, default=None):
+            return item == "octopus_auto" or default
+
+        def get_state_retry(self, entity_id):
+            return {"event.octopus_energy_electricity_xxx_current_day_rates": {}}
+
+        def get_io_tariffs(self, entity_id):
+            return {"loaded_from": entity_id}
+
+    for _ in range(5):
+        host = IOGHost()
+        pv.load_tariffs(
+            {
+                "import": {"name": "E-1R-INTELLI-VAR-22-10-14-A"},
+                "export": {"name": "E-1R-OUTGOING-FIX-12M-19-05-13-A", "export": True},
+            },
+            host=host,
+        )
+        assert host.io_prices == {"loaded_from": "event.octopus_energy_electricity_xxx_current_day_rates"}
+
+
+def test_second_prefetch_uses_cache(server, client, monkeypatch, tmp_path):
+    # Ensure that prefetching again inside the cache's max age makes no requests.
+    rate = {"value_inc_vat": 20.0, "valid_from": "2024-06-01T00:00:00Z", "payment_method": "DIRECT_DEBIT"}
+    for code in ["E-1R-AGILE-24-04-03-A", "E-1R-AGILE-OUTGOING-19-05-13-A"]:
+        for endpoint in ["standing-charges", "standard-unit-rates"]:
+            server.responses[f"/{code[5:-2]}/electricity-tariffs/{code}/{endpoint}/"] = {"results": [rate]}
+    monkeypatch.setattr(pv, "OCTOPUS_PRODUCT_URL", f"{server.url}/")
+    monkeypatch.setattr(pv, "http_client", client)
+    monkeypatch.setattr(pv, "rate_cache", pv.RateCache(tmp_path / "rates.sqlite"))
+    codes = {"E-1R-AGILE-24-04-03-A": False, "E-1R-AGILE-OUTGOING-19-05-13-A": True}
+
+    pv.prefetch_rates(codes, host=FakeHost())
+    downloaded = len(server.requests)
+    assert downloaded > 0
+
+    server.requests.clear()
+    pv.prefetch_rates(codes, host=FakeHost())
+    assert server.requests == []
+
+    pv.prefetch_rates(codes, host=FakeHost(), max_age=pd.Timedelta(0))
+    assert len(server.requests) == downloaded
+
+
+def test_rate_cache_closes_connections(monkeypatch, tmp_path):
+    # Ensure that every connection the cache opens is closed again so that none leak from the prefetch timer.
+    connections = []
+    connect = pv.sqlite3.connect
+
+    def tracked(*args, **kwargs):
+        connections.append(connect(*args, **kwargs))
+        return connections[-1]
+
+    monkeypatch.setattr(pv.sqlite3, "connect", tracked)
+    cache = pv.RateCache(tmp_path / "rates.sqlite")
+    rate = {"value_inc_vat": 20.0, "valid_from": "2024-06-01T00:00:00Z", "payment_method": "DIRECT_DEBIT"}
+    cache.store("E-1R-AGILE-24-04-03-A", "standing-charges", [rate], None)
+    assert cache.load("E-1R-AGILE-24-04-03-A", "standing-charges") != []
+    cache.since("E-1R-AGILE-24-04-03-A", "standing-charges", None)
+
+    assert len(connections) == 4
+    for db in connections:
+        with pytest.raises(pv.sqlite3.ProgrammingError):
+            db.execute("SELECT 1")
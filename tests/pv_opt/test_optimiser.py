@@ -0,0 +1,306 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from apps.pv_opt import pvpy as pv
+from tests.pv_opt.conftest import FakeHost
+
+START = pd.Timestamp("2024-06-01 00:00", tz="UTC")
+
+
+def _model(**config):
+    # Two days at 30p/kWh with a cheap 7.5p/kWh window from 00:30 to 04:30, a flat 15p/kWh export and an evening peak
+    host = FakeHost(**config)
+    index = pd.date_range(START - pd.Timedelta("1D"), START + pd.Timedelta("3D"), freq="30min", inclusive="left")
+    hours = index.hour + index.minute / 60
+    price = np.where((hours >= 0.5) & (hours < 4.5), 7.5, 30.0)
+
+    imp = pv.Tariff("E-1R-TEST-A", octopus=False, host=host)
+    imp.unit = [
+        {"value_inc_vat": p, "valid_from": t.isoformat(), "valid_to": (t + pd.Timedelta("30min")).isoformat()}
+        for t, p in zip(index, price)
+    ]
+    imp.fixed = [{"value_inc_vat": 50.0, "valid_from": index[0].isoformat(), "valid_to": None}]
+    exp = pv.Tariff("E-1R-TESTEXP-A", export=True, octopus=False, host=host, unit=15.0, valid_from=index[0])
+
+    model = pv.PVsystemModel("test", pv.InverterModel(), pv.BatteryModel(capacity=10000), host=host)
+    model.contract = pv.Contract("test", imp=imp, exp=exp, host=host)
+
+    index = pd.date_range(START, START + pd.Timedelta("2D"), freq="30min", inclusive="left")
+    hours = index.hour + index.minute / 60
+    model.static_flows = pd.DataFrame(
+        {
+            "solar": np.clip(3000 * np.sin((hours - 5) / 16 * np.pi), 0, None),
+            "consumption": 400 + 1500 * ((hours >= 17) & (hours < 20)),
+        },
+        index=index,
+    )
+    model.initial_soc = 30
+    return model
+
+
+def test_heuristic_beats_base():
+    # Ensure that the heuristic finds a cheaper plan than doing nothing.
+    model = _model()
+    flows = model.optimised_force(log=False, use_export=True, discharge=True)
+
+    assert model.contract.net_cost(flows) < model.base_cost
+
+
+def test_lp_at_least_as_good_as_heuristic():
+    # Ensure that the LP engine returns the same columns as the heuristic and a plan that is no more expensive.
+    pytest.importorskip("scipy")
+    model = _model()
+    heuristic = model.optimised_force(log=False, use_export=True, discharge=False)
+
+    model.host.config["optimiser_engine"] = "lp"
+    lp = model.optimised_force(log=False, use_export=True, discharge=False)
+
+    assert list(lp.columns) == list(heuristic.columns)
+    assert model.contract.net_cost(lp) <= model.contract.net_cost(heuristic)
+
+
+@pytest.mark.parametrize("engine", ["lp", "dp"])
+def test_idle_slots_are_plain_charges(engine, capfd):
+    # Ensure that the LP and DP engines only return ordinary forced slots, with no token or hold powers, and that the
+    # solver prints nothing.
+    if engine == "lp":
+        pytest.importorskip("scipy")
+    model = _model(optimiser_engine=engine)
+    for use_export, discharge in [(False, False), (True, False), (True, True)]:
+        flows = model.optimised_force(log=False, use_export=use_export, discharge=discharge)
+        forced = flows["forced"][flows["forced"] != 0]
+
+        assert (forced.abs() >= pv.MIN_FORCED_POWER).all()
+        assert "hold" not in flows.columns
+        assert model.best_cost == model.contract.net_cost(flows)
+    assert capfd.readouterr().out == ""
+
+
+def test_dp_at_least_as_good_as_heuristic():
+    # Ensure that the DP engine returns a plan that is no more expensive and keeps within maximum_soc when charging.
+    model = _model()
+    heuristic = model.optimised_force(log=False, use_export=True, discharge=True)
+
+    model.host.config["optimiser_engine"] = "dp"
+    dp = model.optimised_force(log=False, use_export=True, discharge=True)
+
+    assert list(dp.columns) == list(heuristic.columns)
+    assert model.contract.net_cost(dp) <= model.contract.net_cost(heuristic)
+
+    model.host.config["maximum_soc"] = 80
+    dp = model.optimised_force(log=False, use_export=True, discharge=True)
+    assert dp["soc_end"][dp["forced"] > 0].max() <= 80.5
+
+
+def test_flow_swaps_respect_pass_threshold():
+    # Ensure that the min-cost-flow pass only keeps its slots if they save more than pass_threshold_p.
+    model = _model()
+    model.host.config["optimiser_engine"] = "flow"
+    flows = model.optimised_force(log=False, use_export=False)
+
+    assert model.contract.net_cost(flows) <= model.base_cost
+    assert (flows["forced"] >= 0).all()
+
+    model.host.config["pass_threshold_p"] = 1e6
+    flows = model.optimised_force(log=False, use_export=False)
+    assert model.slots == []
+    assert (flows["forced"] == 0).all()
+
+
+def test_de_polish_never_worse_than_init():
+    # Ensure that differential evolution keeps within its budget and only replaces the plan with a cheaper one.
+    model = _model()
+    heuristic = model.optimised_force(log=False, use_export=True, discharge=True)
+    init = heuristic["forced"].to_numpy()
+    cost = model.contract.net_cost(heuristic)
+
+    t0 = time.time()
+    polished = model.optimised_force_de(log=False, use_export=True, discharge=True, init=init, max_seconds=1, seed=0)
+
+    assert time.time() - t0 < 3
+    assert model.contract.net_cost(polished) <= cost
+    assert list(polished.columns) == list(heuristic.columns)
+
+
+def test_de_polishes_the_given_case():
+    # Ensure that polishing a case's flows after another case has run keeps that case's prices.
+    model = _model()
+    model.host.config["optimiser_engine"] = "lp"
+    selected = model.optimised_force(log=False, use_export=False).copy()
+    model.optimised_force(log=False, use_export=True, discharge=True)
+
+    polished = model.optimised_force_de(
+        log=False, use_export=False, discharge=False, flows=selected, max_seconds=0.5, seed=0
+    )
+
+    assert (polished["export"] == selected["export"]).all()
+    assert (polished["export"] == 0).all()
+    assert model.contract.net_cost(polished) <= model.contract.net_cost(selected)
+
+
+def test_detached_model_in_worker_process():
+    # Ensure that a detached model can be optimised in a spawned process and gives the same plan as the original.
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    model = _model()
+    kwargs = {"use_export": True, "discharge": True}
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        remote, plans, budget_hit, timer = pool.submit(pv.optimise_case, model.detached(), kwargs).result()
+
+    local = model.optimised_force(log=False, **kwargs)
+    assert model.contract.net_cost(remote) == model.contract.net_cost(local)
+    assert (remote["forced"] == local["forced"]).all()
+    assert list(plans) == [model._plan_key(True, True, "heuristic")]
+    assert not budget_hit
+    assert timer.calls["calculate_flows"] > 0
+
+
+def test_stage_timer_counts_optimiser_calls():
+    # Ensure that the optimiser phases and the simulation and costing calls are booked to the host's timer.
+    model = _model()
+    model.host.timer = pv.StageTimer()
+    model.optimised_force(log=False, use_export=True, discharge=True)
+
+    attributes = model.host.timer.attributes()
+    assert attributes["calculate_flows_calls"] > 0
+    assert attributes["net_cost_calls"] > 0
+    assert {"high_cost_swaps_seconds", "low_cost_charging_seconds", "discharging_seconds"} <= set(attributes)
+    assert attributes["total_seconds"] >= attributes["high_cost_swaps_seconds"]
+
+
+def test_candidate_costs_match_sequential_costs():
+    # Ensure that costing the charge and discharge candidates together gives the cost of adding each one on its own.
+    model = _model()
+    model.optimised_force(log=False, use_export=True, discharge=True)
+    slots = list(model.slots)
+    model.calculate_flows(slots=slots)
+    candidates = [(k, power) for k in range(0, 96, 7) for power in [1500.7, -2000.2]]
+    costs = model._candidate_costs(candidates)
+
+    for (k, power), cost in zip(candidates, costs):
+        model.calculate_flows(slots=slots + [(model.static_flows.index[k], power)])
+        assert cost == model.net_cost
+
+
+def test_charging_phases_cost_candidates_in_batches():
+    # Ensure that the charging and discharging phases cost their candidate slots with net_cost_batch.
+    model = _model()
+    model.host.timer = pv.StageTimer()
+    model.optimised_force(log=False, use_export=True, discharge=True)
+
+    records = model.trace.records()
+    tried = np.isin(records["phase"], [pv.DecisionTrace.PHASES.index(p) for p in ["low_cost_charging", "discharging"]])
+    assert 0 < model.host.timer.calls["net_cost_batch"] < tried.sum()
+
+
+def test_decision_trace_renders_logged_lines():
+    # Ensure that the trace recorded without logging renders the same lines that are logged with log=True.
+    model = _model()
+    model.optimised_force(log=False, use_export=True, discharge=True)
+    records = model.trace.records()
+
+    logged = []
+    model.log = logged.append
+    model.optimised_force(log=True, use_export=True, discharge=True)
+
+    assert len(records) > 0
+    assert set(pv.DecisionTrace.PHASES[p] for p in records["phase"]) == set(pv.DecisionTrace.PHASES)
+    assert set(model.trace.render("high_cost_swaps")) <= set(logged)
+    assert set(model.trace.render(accepted_only=True)) <= set(logged)
+
+
+def test_shared_stage1_matches_full_run():
+    # Ensure that reusing the high cost usage swaps from the charging case gives the same plans as repeating them.
+    model = _model()
+    full = model.optimised_force(log=False, use_export=True, discharge=True).copy()
+
+    model.optimised_force(log=False, use_export=False, discharge=False)
+    shared = model.optimised_force(log=False, use_export=True, discharge=True, stage1=model.stage1)
+
+    pd.testing.assert_frame_equal(shared, full)
+
+
+def test_plan_cache_reuses_shifted_plan():
+    # Ensure that a plan is moved onto the next half hour when nothing has changed but not when the SOC has.
+    model = _model()
+    flows = model.optimised_force(log=False, use_export=True, discharge=True, plan_cache=True)
+    key = model._plan_key(True, True, "heuristic")
+    soc = flows["soc_end"].iloc[0]
+    expected = [(t, p) for t, p in flows["forced"].iloc[1:].items() if p != 0]
+
+    model.static_flows = model.static_flows.iloc[1:]
+    model.initial_soc = soc
+    model.optimised_force(log=False, use_export=True, discharge=True, plan_cache=True)
+    assert model.last_plans[key]["reused"] == 1
+    assert model.slots == expected
+
+    model.static_flows = model.static_flows.iloc[1:]
+    model.initial_soc = soc + 10
+    model.optimised_force(log=False, use_export=True, discharge=True, plan_cache=True)
+    assert model.last_plans[key]["reused"] == 0
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda model: setattr(model.battery, "capacity", model.battery.capacity * 2),
+        lambda model: setattr(model.inverter, "charger_power", 2000),
+        lambda model: model.host.config.update(slot_threshold_p=5.0),
+        lambda model: model.host.config.update(maximum_soc=80),
+    ],
+    ids=["capacity", "charger_power", "slot_threshold", "maximum_soc"],
+)
+def test_plan_cache_not_reused_after_input_change(change):
+    # Ensure that a plan isn't re-used once any of the other inputs to the optimiser have changed.
+    model = _model()
+    model.host.config["optimiser_engine"] = "dp"
+    flows = model.optimised_force(log=False, use_export=True, discharge=True, plan_cache=True)
+    model.static_flows = model.static_flows.iloc[1:]
+    model.initial_soc = flows["soc_end"].iloc[0]
+
+    change(model)
+    model.optimised_force(log=False, use_export=True, discharge=True, plan_cache=True)
+
+    key = model._plan_key(True, True, "dp")
+    assert list(model.last_plans) == [key]
+    assert model.last_plans[key]["reused"] == 0
+
+
+def test_plan_cache_keeps_small_charges():
+    # Ensure that a re-used LP plan keeps the MIN_FORCED_POWER charges in the slots it leaves idle.
+    model = _model()
+    model.host.config["optimiser_engine"] = "lp"
+    flows = model.optimised_force(log=False, use_export=False, plan_cache=True)
+    expected = [(t, p) for t, p in flows["forced"].iloc[1:].items() if p != 0]
+    assert pv.MIN_FORCED_POWER in [p for t, p in expected]
+
+    model.static_flows = model.static_flows.iloc[1:]
+    model.initial_soc = flows["soc_end"].iloc[0]
+    model.optimised_force(log=False, use_export=False, plan_cache=True)
+
+    assert model.last_plans[model._plan_key(False, False, "lp")]["reused"] == 1
+    assert model.slots == expected
+
+
+def test_deadline_keeps_best_plan_so_far():
+    # Ensure that a passed deadline stops the optimiser cleanly with a valid plan that isn't kept in the plan cache.
+    model = _model()
+    flows = model.optimised_force(log=False, use_export=True, discharge=True, deadline=time.time() - 1)
+
+    assert model.budget_hit
+    assert model.contract.net_cost(flows) <= model.base_cost
+    assert model.last_plans == {}
+
+    model.optimised_force(log=False, use_export=True, discharge=True, deadline=time.time() + 60)
+    assert not model.budget_hit
+
+
+def test_slots_outside_index_raise():
+    # Ensure that a slot whose time isn't in static_flows raises rather than being added to another slot.
+    model = _model()
+    with pytest.raises(KeyError):
+        model.calculate_flows(slots=[(START + pd.Timedelta("10min"), 1000)])
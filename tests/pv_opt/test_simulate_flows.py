@@ -0,0 +1,78 @@
+import numpy as np
+
+from apps.pv_opt.pvpy import simulate_flows, simulate_flows_batch
+
+
+def _simulate(forced, initial_chg=5000, **kwargs):
+    n = len(forced)
+    args = dict(
+        solar=np.zeros(n),
+        consumption=np.full(n, 1000.0),
+        forced=np.array(forced),
+        dt_hours=np.full(n, 0.5),
+        initial_chg=initial_chg,
+        capacity=10000,
+        max_dod=0.15,
+        inverter_efficiency=0.97,
+        charger_efficiency=0.91,
+    )
+    args.update(kwargs)
+    return simulate_flows(**args)
+
+
+def test_forced_charge_is_clipped_at_capacity():
+    # Ensure that charging never takes the battery above its capacity.
+    sim = _simulate([3000] * 10, initial_chg=9000)
+
+    assert sim["chg_end"].max() == 10000
+    assert sim["soc_end"][-1] == 100
+
+
+def test_discharge_is_clipped_at_max_dod():
+    # Ensure that meeting consumption from the battery stops at max_dod and the grid picks up the rest.
+    sim = _simulate([0] * 20, initial_chg=2000)
+
+    assert sim["chg_end"].min() == 1500
+    assert sim["grid"][-1] == 1000
+
+
+def test_battery_flow_includes_efficiencies():
+    # Ensure that a forced charge draws the AC power from the grid and stores it less the charger losses.
+    sim = _simulate([2000])
+
+    assert sim["battery"][0] == -2000
+    assert sim["grid"][0] == 3000
+    assert sim["chg_end"][0] == 5000 + 2000 * 0.91 * 0.5
+
+
+def test_resume_matches_full_simulation():
+    # Ensure that resuming from an earlier chg_path gives the same result as simulating from the start.
+    base = _simulate([0] * 8 + [3000] * 4 + [0] * 8)
+    forced = [0] * 8 + [3000] * 4 + [0, 0, -2000, 0] + [0] * 4
+    full = _simulate(forced)
+    resumed = _simulate(forced, start=14, chg_path=base["chg_path"])
+
+    for key in ["chg", "chg_end", "battery", "grid", "soc_end"]:
+        assert np.array_equal(full[key], resumed[key])
+
+
+def test_batch_matches_single_simulations():
+    # Ensure that each row of a batched simulation matches simulating that plan on its own.
+    plans = np.array([[0] * 6, [3000, 3000, 0, 0, 0, 0], [0, 0, 0, -2500, -2500, 0]])
+    n = plans.shape[1]
+    args = dict(
+        solar=np.zeros(n),
+        consumption=np.full(n, 1000.0),
+        dt_hours=np.full(n, 0.5),
+        initial_chg=5000,
+        capacity=10000,
+        max_dod=0.15,
+        inverter_efficiency=0.97,
+        charger_efficiency=0.91,
+    )
+    batch = simulate_flows_batch(forced=plans, **args)
+
+    for i, plan in enumerate(plans):
+        single = simulate_flows(forced=plan, **args)
+        assert np.array_equal(batch["grid"][i], single["grid"])
+        assert np.array_equal(batch["chg_end"][i], single["chg_end"])
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+from apps.pv_opt.pvpy import Tariff
+from tests.pv_opt.conftest import FakeHost
+
+START = pd.Timestamp("2024-06-01 00:00", tz="UTC")
+
+
+def _tariff(host):
+    tariff = Tariff("E-1R-TEST-A", octopus=False, host=host)
+    index = pd.date_range(START, periods=96, freq="30min")
+    tariff.unit = [
+        {
+            "value_inc_vat": float(i % 48),
+            "valid_from": t.isoformat(),
+            "valid_to": (t + pd.Timedelta("30min")).isoformat(),
+        }
+        for i, t in enumerate(index)
+    ]
+    tariff.fixed = [{"value_inc_vat": 50.0, "valid_from": START.isoformat(), "valid_to": None}]
+    tariff.clear_cache()
+    return tariff
+
+
+def test_to_df_is_read_only():
+    # Ensure that the cached prices can't be changed by a caller.
+    tariff = _tariff(FakeHost())
+    df = tariff.to_df(START, START + pd.Timedelta("12h"), day_ahead=False)
+
+    with pytest.raises(ValueError):
+        df.loc[df.index[0], "unit"] = 100
+
+    assert tariff.to_df(START, START + pd.Timedelta("12h"), day_ahead=False)["unit"].iloc[0] == 0
+
+
+def test_to_df_cache_invalidated_by_saving_event():
+    # Ensure that a new saving event is applied to a window that has already been cached.
+    host = FakeHost()
+    tariff = _tariff(host)
+    end = START + pd.Timedelta("12h")
+    before = tariff.to_df(START, end, day_ahead=False)["unit"].sum()
+
+    host.saving_events[1] = {
+        "start": (START + pd.Timedelta("2h")).isoformat(),
+        "end": (START + pd.Timedelta("3h")).isoformat(),
+        "octopoints_per_kwh": 800,
+    }
+    after = tariff.to_df(START, end, day_ahead=False)["unit"].sum()
+
+    assert after == before + 2 * 100
+
+
+def test_rate_table_start_end_and_lookup():
+    # Ensure that the rate in force is the last one to start at or before each time.
+    tariff = _tariff(FakeHost())
+
+    assert tariff.start() == START
+    assert tariff.end() == START + pd.Timedelta("48h")
+
+    times = [START - pd.Timedelta("1h"), START, START + pd.Timedelta("45min")]
+    values = tariff.unit.lookup(times)
+    assert pd.isna(values[0])
+    assert list(values[1:]) == [0, 1]